@@ -8,10 +8,15 @@ from os.path import isfile, isdir, exists, dirname, basename
 
 import json
 import time
+import sqlite3
 import logging
+import threading
 from pprint import pprint as pp
 
 logger = None
+FILE_FIELDS = ['checksum', 'members']   # describe the file in progress - dropped when the next starts
+DB_KEEP_SECONDS = 7 * 86400   # completed per-file rows are kept this long by the sqlite backend
+DB_PRUNE_FILES  = 1000        # files completed between prunes of those rows
 
 
 class FeedAuditor(object):
@@ -19,17 +24,47 @@ class FeedAuditor(object):
         reads data back.
 	Used to determine when to next poll as well as to help
 	in recoveries.
+
+        Two backends are supported:
+            - json - rewrites the entire audit file on every write
+            - journal - appends a compact record per write to a journal,
+              fsyncing once per batch of journal_batch records, and
+              periodically compacts the journal into the audit file
+              (which then serves as its snapshot).
+            - sqlite - keeps the records in a sqlite database in wal mode,
+              so each write is a single-row update, along with a row per
+              file per record - so that the files left incomplete can be
+              found with a single indexed query.  Safe for many threads &
+              processes to write concurrently.
+        A read_only auditor writes nothing at all, not even on close - so
+        that it can look at a feed another mover may be running.
     """
-    def __init__(self, feed_name, data_dir, config_name, verbose=False):
+    def __init__(self, feed_name, data_dir, config_name, verbose=False,
+                 backend='json', journal_batch=12, journal_compact=1000, read_only=False):
 
         setup_logging('__main__')
         if verbose:
             logger.debug('FeedAuditor starting now')
 
+        assert backend in ['json', 'journal', 'sqlite']
         self.feed_name       = feed_name
         self.data_dir        = data_dir
         self.audit_fqfn      = pjoin(data_dir, '%s_audit.json' % config_name)
+        self.journal_fqfn    = pjoin(data_dir, '%s_audit.journal' % config_name)
+        self.db_fqfn         = pjoin(data_dir, '%s_audit.sqlite' % config_name)
+        self.db              = None              # sqlite connection, once opened
+        self.db_complete_cnt = 0                 # files completed since the last prune
+        self.backend         = backend
+        self.read_only       = read_only
+        self.journal_batch   = journal_batch     # records per fsync
+        self.journal_compact = journal_compact   # records per compaction
+        self.journal         = None              # journal file, once opened
+        self.journal_cnt     = 0                 # records since last compaction
+        self.journal_end     = 0                 # bytes of complete journal records
+        self.journal_torn    = False             # true if a torn record follows them
+        self.unsynced_cnt    = 0                 # records since last fsync
         self.start_time      = time.time()
+        self.lock            = threading.RLock()
         if verbose:
             logger.debug('audit_fqfn: %s', self.audit_fqfn)
         if not isdir(dirname(self.audit_fqfn)):
@@ -38,36 +73,109 @@ class FeedAuditor(object):
 
         self.feed_status = self.read()
         self.status          = self.feed_status[self.feed_name]   # just a shortcut
-        if (self.status['step'] in [0, 6]
-            and self.status['status'] == 'stop'
-            and self.status['result'] == 'pass'):
+        if is_complete(self.status):
             self.mode            = 'normal'
         else:
             self.mode            = 'recovery'
+        if self.backend == 'json' and self.journal_cnt and not self.read_only:
+            # left over from the journal backend - fold it into the json file:
+            self._compact()
 
     def read(self):
 	"""Read entire feed_status json file into class dictionary.
            If the file doesn't exist, set up a minimal default.
+           Any journal records are then replayed on top of it.
+           The sqlite backend reads its database instead - unless it's
+           new, in which case it starts from the json file & journal.
 	"""
+        if self.backend == 'sqlite' and not (self.read_only and not exists(self.db_fqfn)):
+            self.db     = open_db(self.db_fqfn, self.read_only)
+            feed_status = read_db(self.db)
+            if feed_status:
+                feed_status.setdefault(self.feed_name, default_status())
+                return feed_status
+            if self.read_only:
+                # nothing in it yet - the json file & journal are all there is:
+                self.db.close()
+                self.db = None
         try:
             with open(self.audit_fqfn, 'r') as f:
-                return json.load(f)
+                feed_status = json.load(f)
         except IOError, e:
             if e.errno == 2:
-                feed_status_rec = {}
-                feed_status_rec[self.feed_name] = {'step'       : 0,
-                                                   'status'     : 'stop',
-                                                   'time'       : time.time(),
-                                                   'result'     : 'pass',
-                                                   'fn'         : '',
-                                                   'empty_audit': True}
-                return feed_status_rec
+                feed_status = {}
+                feed_status[self.feed_name] = default_status()
             else:
                 logger.critical('feed audit file could not be loaded')
                 logger.critical(e)
                 sys.exit(1)
+        self._replay_journal(feed_status)
+        if self.db:
+            for (key, rec) in feed_status.items():
+                self._write_db(key, rec)
+        return feed_status
+
+    def _replay_journal(self, feed_status):
+        """ Applies every journal record to feed_status.  Since each record
+            holds the complete state of one status record replaying is
+            idempotent - so a journal left behind by a crash during
+            compaction is harmless.  A torn final record from a crash
+            mid-append is ignored - and cut off before the next append, so
+            that it doesn't run on into it.  A corrupt record within the
+            journal, as one written onto the end of a torn record before
+            they were cut off, is skipped.
+        """
+        self.journal_cnt  = 0
+        self.journal_end  = 0
+        self.journal_torn = False
+        try:
+            with open(self.journal_fqfn, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        logger.warning('ignoring incomplete audit journal record: %s' % line)
+                        self.journal_torn = True
+                        break
+                    self.journal_end += len(line)
+                    try:
+                        fields = json.loads(line)
+                    except ValueError:
+                        logger.warning('ignoring corrupt audit journal record: %s' % line)
+                        continue
+                    (key, step, status, rec_time, result, fn) = fields[:6]
+                    rec = feed_status.setdefault(key, default_status())
+                    rec['step']        = step
+                    rec['status']      = status
+                    rec['time']        = rec_time
+                    rec['result']      = result
+                    if fn is not None:
+                        rec['fn']      = fn
+                    if step == 1 and status == 'start':
+                        for field in FILE_FIELDS:
+                            rec.pop(field, None)
+                    if len(fields) > 6:
+                        rec.update(fields[6])
+                    rec['empty_audit'] = False
+                    self.journal_cnt  += 1
+        except IOError, e:
+            if e.errno != 2:
+                logger.critical('feed audit journal could not be loaded')
+                logger.critical(e)
+                sys.exit(1)
 
-    def write(self, step, status, result='tbd', fn=None):
+    def write(self, step, status, result='tbd', fn=None, checksum=None, members=None,
+              delivered=None):
+        self.write_rec(self.feed_name, step, status, result, fn, checksum, members, delivered)
+
+    def write_rec(self, key, step, status, result='tbd', fn=None, checksum=None,
+                  members=None, delivered=None):
+        """ Updates a single status record - either the feed's own or that
+            of one of its worker slots - then persists it.
+            The checksum, and the member files of a bundle, belong to the file
+            in progress - so are dropped when the next file starts.  The
+            files a destination has been delivered, while the source still
+            holds them, are kept across files.
+        """
+        assert not self.read_only
         assert 10 > step >= 0
         assert status in ['start','stop']
         assert result in ['pass', 'fail', 'tbd', True, False]
@@ -78,17 +186,259 @@ class FeedAuditor(object):
         if status == 'start':
             result = 'tbd'
 
-        self.status['step']        = step
-        self.status['status']      = status
-        self.status['time']        = time.time()
-        self.status['result']      = result
-        if fn is not None:
-            self.status['fn']      = fn
-        self.status['empty_audit'] = False
+        with self.lock:
+            rec = self.feed_status[key]
+            rec['step']        = step
+            rec['status']      = status
+            rec['time']        = time.time()
+            rec['result']      = result
+            if fn is not None:
+                rec['fn']      = fn
+            if step == 1 and status == 'start':
+                for field in FILE_FIELDS:
+                    rec.pop(field, None)
+            file_fields = {}
+            if checksum is not None:
+                file_fields['checksum'] = checksum
+            if members is not None:
+                file_fields['members']  = members
+            if delivered is not None:
+                file_fields['delivered'] = delivered
+            rec.update(file_fields)
+            rec['empty_audit'] = False
+
+            if self.backend == 'journal':
+                self._append_journal(key, rec, fn, file_fields)
+            elif self.backend == 'sqlite':
+                self._write_db(key, rec)
+            else:
+                with open(self.audit_fqfn, 'w') as f:
+                    f.write(json.dumps(self.feed_status))
+
+    def _append_journal(self, key, rec, fn, file_fields):
+        """ Every record goes straight to the os so that it survives a crash
+            of the process, but records are only fsynced in batches.
+        """
+        if self.journal is None:
+            self.journal = open(self.journal_fqfn, 'a')
+            if self.journal_torn:
+                self.journal.truncate(self.journal_end)
+                self.journal_torn = False
+        fields = [key, rec['step'], rec['status'], rec['time'], rec['result'], fn]
+        if file_fields:
+            fields.append(file_fields)
+        self.journal.write(json.dumps(fields, separators=(',', ':')) + '\n')
+        self.journal.flush()
+        self.journal_cnt  += 1
+        self.unsynced_cnt += 1
+        if self.journal_cnt >= self.journal_compact:
+            self._compact()
+        elif self.unsynced_cnt >= self.journal_batch:
+            self.sync()
+
+    def _write_db(self, key, rec):
+        """ Replaces the status record, and the row for its file, in a
+            single transaction.
+        """
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO status (key, rec) VALUES (?, ?)',
+                            (key, json.dumps(rec)))
+            if rec['fn']:
+                self.db.execute('INSERT OR REPLACE INTO files '
+                                '(feed, key, fn, step, status, result, time, checksum, complete) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (self.feed_name, key, rec['fn'], rec['step'], rec['status'],
+                                 rec['result'], rec['time'], rec.get('checksum'),
+                                 int(is_complete(rec))))
+        if rec['fn'] and rec['step'] == 6 and is_complete(rec):
+            # so that a mover that runs for months doesn't keep a row per file:
+            self.db_complete_cnt += 1
+            if self.db_complete_cnt >= DB_PRUNE_FILES:
+                self._prune_db()
 
-        with open(self.audit_fqfn, 'w') as f:
+    def _prune_db(self):
+        """ Drops the per-file rows of files completed over DB_KEEP_SECONDS
+            ago.
+        """
+        with self.db:
+            self.db.execute('DELETE FROM files WHERE complete = 1 AND time < ?',
+                            (time.time() - DB_KEEP_SECONDS,))
+        self.db_complete_cnt = 0
+
+    def sync(self):
+        """ Forces any journal records not yet fsynced to disk.
+        """
+        with self.lock:
+            if self.journal is not None and self.unsynced_cnt:
+                os.fsync(self.journal.fileno())
+            self.unsynced_cnt = 0
+
+    def _compact(self):
+        """ Atomically replaces the audit file with the current state,
+            then empties the journal.
+        """
+        temp_fqfn = '%s.temp' % self.audit_fqfn
+        with open(temp_fqfn, 'w') as f:
             f.write(json.dumps(self.feed_status))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_fqfn, self.audit_fqfn)
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if exists(self.journal_fqfn):
+            os.remove(self.journal_fqfn)
+        self.journal_cnt  = 0
+        self.unsynced_cnt = 0
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.sync()
+                self.journal.close()
+                self.journal = None
+            if self.db is not None:
+                if not self.read_only:
+                    # old rows go, and the json file gets a snapshot - so that
+                    # switching back to another backend picks up from here:
+                    self._prune_db()
+                    self._compact()
+                self.db.close()
+                self.db = None
+
+    def slot_auditor(self, slot):
+        """ Returns the auditor for a single worker slot.  Each slot keeps
+            its own status record within this feed's audit file.
+        """
+        return SlotAuditor(self, slot)
+
+    def dest_auditor(self, dest_name):
+        """ Returns the auditor for one destination of a fanned-out feed.
+            Each destination keeps its own status record within this feed's
+            audit file.
+        """
+        return DestAuditor(self, dest_name)
+
+    def incomplete_files(self):
+        """ Returns the sorted names of the files left part way through by
+            any of this feed's records - the feed's own, its worker slots'
+            or its destinations'.
+        """
+        with self.lock:
+            if self.db is not None:
+                return sorted([row[0] for row in self.db.execute(
+                                   'SELECT DISTINCT fn FROM files WHERE feed = ? AND complete = 0',
+                                   (self.feed_name,))])
+            return sorted(set([rec['fn'] for (key, rec) in self.feed_status.items()
+                               if (key == self.feed_name or key.startswith(self.feed_name + '.'))
+                               and rec['fn'] and not is_complete(rec)]))
+
+    def incomplete_slots(self):
+        """ Returns a dictionary of slot number to file name for every worker
+            slot that was left in the middle of moving a file.
+        """
+        results = {}
+        with self.lock:
+            for key, rec in self.feed_status.items():
+                slot = get_slot(self.feed_name, key)
+                if slot is not None and rec['fn'] and not is_complete(rec):
+                    results[slot] = rec['fn']
+        return results
+
+
+
+class SlotAuditor(object):
+    """ Provides the status & write interface of a FeedAuditor for a single
+        worker slot.  Records are kept in the parent's feed_status under
+        '<feed_name>.slot<n>' and written with it.
+    """
+    def __init__(self, parent, slot):
+        self.parent    = parent
+        self.slot      = slot
+        self.feed_name = parent.feed_name
+        self.key       = slot_key(parent.feed_name, slot)
+        with parent.lock:
+            self.status = parent.feed_status.setdefault(self.key, default_status())
 
+    def write(self, step, status, result='tbd', fn=None, checksum=None, members=None,
+              delivered=None):
+        self.parent.write_rec(self.key, step, status, result, fn, checksum, members, delivered)
+
+
+
+class DestAuditor(SlotAuditor):
+    """ Provides the status & write interface of a FeedAuditor for a single
+        destination of a fanned-out feed.  Records are kept in the parent's
+        feed_status under '<feed_name>.dest-<name>' and written with it.
+    """
+    def __init__(self, parent, dest_name):
+        self.parent    = parent
+        self.slot      = None
+        self.dest_name = dest_name
+        self.feed_name = parent.feed_name
+        self.key       = dest_key(parent.feed_name, dest_name)
+        with parent.lock:
+            self.status = parent.feed_status.setdefault(self.key, default_status())
+
+
+
+def default_status():
+    return {'step'       : 0,
+            'status'     : 'stop',
+            'time'       : time.time(),
+            'result'     : 'pass',
+            'fn'         : '',
+            'empty_audit': True}
+
+
+def is_complete(status):
+    """ Returns True if the status record shows no file in progress.
+    """
+    return (status['step'] in [0, 6]
+            and status['status'] == 'stop'
+            and status['result'] == 'pass')
+
+
+def open_db(db_fqfn, read_only=False):
+    """ Opens the sqlite audit database - creating its tables if need be,
+        unless read_only.  The connection is shared by the feed's threads,
+        under its lock.
+    """
+    db = sqlite3.connect(db_fqfn, timeout=30, check_same_thread=False)
+    if read_only:
+        return db
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')   # safe against a crash of the process with wal
+    with db:
+        db.execute('CREATE TABLE IF NOT EXISTS status (key TEXT PRIMARY KEY, rec TEXT NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS files '
+                   '(feed TEXT NOT NULL, key TEXT NOT NULL, fn TEXT NOT NULL, step INTEGER, '
+                   ' status TEXT, result TEXT, time REAL, checksum TEXT, complete INTEGER, '
+                   ' PRIMARY KEY (feed, key, fn))')
+        db.execute('CREATE INDEX IF NOT EXISTS files_incomplete ON files (feed) WHERE complete = 0')
+    return db
+
+
+def read_db(db):
+    return dict((key, json.loads(rec)) for (key, rec) in db.execute('SELECT key, rec FROM status'))
+
+
+def slot_key(feed_name, slot):
+    return '%s.slot%d' % (feed_name, slot)
+
+
+def dest_key(feed_name, dest_name):
+    return '%s.dest-%s' % (feed_name, dest_name)
+
+
+def get_slot(feed_name, key):
+    """ Returns the slot number of a feed_status key, or None if the key
+        doesn't belong to one of this feed's worker slots.
+    """
+    prefix = '%s.slot' % feed_name
+    if key.startswith(prefix) and key[len(prefix):].isdigit():
+        return int(key[len(prefix):])
+    return None
 
 
 def setup_logging(log_name):
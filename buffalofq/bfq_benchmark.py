@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+""" Measures mover throughput without any outside services: each scenario
+    generates a source directory of files, starts a loopback sftp server in
+    this process (see bfq_sftp_server) and moves the files with
+    HandleOneFeed - reporting files/sec, MB/sec, per-step latency and audit
+    overhead as json, along with the feed's own operation metrics.
+    The startup scenario instead times whole buffalofq_mover runs over an
+    empty source_dir - what most cron-driven runs amount to.
+
+    Usage:
+        $ python -m buffalofq.bfq_benchmark --scenario mixed
+        $ python -m buffalofq.bfq_benchmark --scenario small --scale 0.1 \\
+              --feed max_workers=4 --feed audit_backend=journal --output small.json
+        $ python -m buffalofq.bfq_benchmark --scenario startup --startup-runs 20
+
+    Note that the server shares this process (and its gil) with the mover, so
+    results are for comparing one change against another - not for predicting
+    what a real ssh host will do.
+"""
+
+from __future__ import division
+import os
+import sys
+import time
+import json
+import math
+import shutil
+import getpass
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import collections
+import distutils.spawn
+from os.path import join as pjoin
+from pprint import pprint as pp
+
+import paramiko
+
+#--- our modules -------------------
+import bfq_auditor
+import bfq_buffguts
+import bfq_sftp_server
+
+KB = 1024
+MB = 1024 * KB
+
+# scenario name -> list of (file count, file size):
+SCENARIOS = {'small': [(100000, 1 * KB)],
+             'large': [(10, 100 * MB)],
+             'mixed': [(5000, 1 * KB), (500, 1 * MB), (5, 100 * MB)]}
+STARTUP_RUNS = 10
+
+logger = None
+
+
+
+def main():
+    args = get_args()
+    setup_logging(args.log_level)
+
+    if args.file_count:
+        scenarios = {'custom': [(args.file_count, args.file_size)]}
+    elif args.scenario == 'all':
+        scenarios = SCENARIOS
+    elif args.scenario == 'startup':
+        scenarios = {}
+    else:
+        scenarios = {args.scenario: SCENARIOS[args.scenario]}
+
+    results = {}
+    if args.scenario in ('startup', 'all') and not args.file_count:
+        logger.warning('benchmark scenario startup starting: %d runs', args.startup_runs)
+        results['startup'] = run_startup(args.startup_runs, args.temp_dir)
+    for name in sorted(scenarios):
+        distribution = scale_distribution(scenarios[name], args.scale)
+        logger.warning('benchmark scenario %s starting: %s', name, distribution)
+        results[name] = run_scenario(distribution, args.feed, args.temp_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+
+def run_scenario(distribution, feed_overrides=None, temp_dir=None):
+    """ Moves a freshly-generated set of files through a loopback sftp
+        server and returns the measurements.
+        distribution is a list of (file count, file size).
+    """
+    root_dir = tempfile.mkdtemp(prefix='bfq_bench_', dir=temp_dir)
+    server   = None
+    try:
+        source_dir = pjoin(root_dir, 'source')
+        dest_dir   = pjoin(root_dir, 'dest')
+        audit_dir  = pjoin(root_dir, 'audit')
+        for dir_name in (source_dir, dest_dir, audit_dir):
+            os.mkdir(dir_name)
+        (file_cnt, byte_cnt) = make_files(source_dir, distribution)
+
+        key          = paramiko.RSAKey.generate(2048)
+        key_filename = pjoin(root_dir, 'id_bench_rsa')  # absolute, so not read from ~/.ssh
+        key.write_private_key_file(key_filename)
+        server = bfq_sftp_server.LoopbackSFTPServer(key).start()
+
+        feed = make_feed(source_dir, dest_dir, server.port)
+        feed.update(feed_overrides or {})
+        feed_handler = bfq_buffguts.HandleOneFeed(feed, audit_dir, limit_total=0,
+                                                  config_name=None,
+                                                  key_filename=key_filename)
+        with StepTimer() as timer:
+            start_time = time.time()
+            feed_handler.run(force=True)
+            duration   = time.time() - start_time
+
+        return {'feed':          dict(feed_overrides or {}),
+                'distribution':  [list(x) for x in distribution],
+                'files':         file_cnt,
+                'bytes':         byte_cnt,
+                'files_moved':   len(os.listdir(dest_dir)),
+                'seconds':       round(duration, 6),
+                'files_per_sec': round(file_cnt / duration, 3) if duration else None,
+                'mb_per_sec':    round(byte_cnt / MB / duration, 3) if duration else None,
+                'steps':         timer.step_summary(),
+                'operations':    feed_handler.metrics.summary(),
+                'audit':         timer.audit_summary(duration)}
+    finally:
+        if server:
+            server.close()
+        shutil.rmtree(root_dir, ignore_errors=True)
+
+
+
+def run_startup(runs=STARTUP_RUNS, temp_dir=None):
+    """ Times buffalofq_mover runs, each in a new process, over an empty
+        source_dir - & the interpreter's own startup for comparison.  The
+        first run validates & caches the config, so it's reported apart
+        from the rest.
+    """
+    assert runs >= 2
+    mover    = find_mover()
+    root_dir = tempfile.mkdtemp(prefix='bfq_bench_', dir=temp_dir)
+    try:
+        dirs = dict((x, pjoin(root_dir, x)) for x in ('source', 'dest', 'log'))
+        for dir_name in dirs.values():
+            os.mkdir(dir_name)
+        config = {'name':               'startup',
+                  'polling_seconds':    1,
+                  'log_dir':            dirs['log'],
+                  'source_dir':         dirs['source'],
+                  'source_fn':          'bench_*',
+                  'source_post_action': None,
+                  'source_post_dir':    None,
+                  'dest_host':          'localhost',
+                  'dest_dir':           dirs['dest'],
+                  'dest_post_action':   None}
+        config_fqfn = pjoin(root_dir, 'startup.yml')
+        with open(config_fqfn, 'w') as f:
+            json.dump(config, f)     # json is also yaml
+        command   = [sys.executable, mover, '--config-fqfn', config_fqfn, '--no-console-log']
+        durations = [time_command(command) for _ in range(runs)]
+        cached    = sorted(durations[1:])
+        return {'runs':                runs,
+                'first_seconds':       round(durations[0], 6),
+                'median_seconds':      round(percentile(cached, 50), 6),
+                'max_seconds':         round(cached[-1], 6),
+                'interpreter_seconds': round(min(time_command([sys.executable, '-c', 'pass'])
+                                                 for _ in range(3)), 6)}
+    finally:
+        shutil.rmtree(root_dir, ignore_errors=True)
+
+
+
+def find_mover():
+    """ Returns the buffalofq_mover script - from the source tree, or else
+        as installed on the path.
+    """
+    mover = pjoin(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                  'scripts', 'buffalofq_mover')
+    if not os.path.isfile(mover):
+        mover = distutils.spawn.find_executable('buffalofq_mover')
+    if not mover:
+        raise RuntimeError('buffalofq_mover could not be found')
+    return mover
+
+
+
+def time_command(command):
+    start_time = time.time()
+    status     = subprocess.call(command)
+    if status:
+        raise RuntimeError('%s failed with status %d' % (' '.join(command), status))
+    return time.time() - start_time
+
+
+
+class StepTimer(object):
+    """ Times every HandleOneFile step and every audit write while in use,
+        by wrapping them - so nothing in the mover needs to know about it.
+        Steps run on several threads when max_workers > 1, hence the lock.
+    """
+    def __init__(self):
+        self.lock          = threading.Lock()
+        self.step_times    = collections.defaultdict(list)
+        self.audit_writes  = 0
+        self.audit_seconds = 0.0
+        self.originals     = []
+
+    def __enter__(self):
+        self._wrap(bfq_buffguts.HandleOneFile, '_step_runner', self._add_step)
+        self._wrap(bfq_auditor.FeedAuditor, 'write_rec', self._add_audit)
+        self._wrap(bfq_auditor.FeedAuditor, 'close', self._add_audit)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for (cls, name, original) in self.originals:
+            setattr(cls, name, original)
+        self.originals = []
+
+    def _wrap(self, cls, name, record):
+        original = cls.__dict__[name]
+        def timed(instance, *args, **kwargs):
+            start_time = time.time()
+            try:
+                return original(instance, *args, **kwargs)
+            finally:
+                record(time.time() - start_time, *args, **kwargs)
+        setattr(cls, name, timed)
+        self.originals.append((cls, name, original))
+
+    def _add_step(self, duration, step, *args, **kwargs):
+        with self.lock:
+            self.step_times[step].append(duration)
+
+    def _add_audit(self, duration, *args, **kwargs):
+        with self.lock:
+            self.audit_writes  += 1
+            self.audit_seconds += duration
+
+    def step_summary(self):
+        summary = {}
+        for (step, durations) in self.step_times.items():
+            durations = sorted(durations)
+            summary[str(step)] = {'count':     len(durations),
+                                  'seconds':   round(sum(durations), 6),
+                                  'mean_ms':   round(sum(durations) / len(durations) * 1000, 3),
+                                  'p50_ms':    round(percentile(durations, 50) * 1000, 3),
+                                  'p95_ms':    round(percentile(durations, 95) * 1000, 3),
+                                  'max_ms':    round(durations[-1] * 1000, 3)}
+        return summary
+
+    def audit_summary(self, duration):
+        return {'writes':  self.audit_writes,
+                'seconds': round(self.audit_seconds, 6),
+                'pct':     round(self.audit_seconds / duration * 100, 2) if duration else None}
+
+
+
+def percentile(sorted_values, pct):
+    """ Returns the nearest-rank percentile of an already-sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(pct / 100 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+
+def scale_distribution(distribution, scale):
+    return [(max(int(count * scale), 1), size) for (count, size) in distribution]
+
+
+
+def make_files(source_dir, distribution):
+    """ Writes the files, named so that they sort in creation order.
+        Returns the file count & total bytes.
+    """
+    block    = os.urandom(MB)
+    file_cnt = 0
+    byte_cnt = 0
+    for (count, size) in distribution:
+        for _ in range(count):
+            with open(pjoin(source_dir, 'bench_%08d.dat' % file_cnt), 'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    f.write(block[:remaining])
+                    remaining -= len(block)
+            file_cnt += 1
+            byte_cnt += size
+    return file_cnt, byte_cnt
+
+
+
+def make_feed(source_dir, dest_dir, port):
+    user = getpass.getuser()
+    return {'name':               'benchmark',
+            'status':             'enabled',
+            'polling_seconds':    0,
+            'sort_key':           'name',
+            'source_host':        '127.0.0.1',
+            'source_user':        user,
+            'source_dir':         source_dir,
+            'source_fn':          'bench_*',
+            'source_post_action': None,
+            'source_post_dir':    None,
+            'dest_host':          '127.0.0.1',
+            'dest_user':          user,
+            'dest_dir':           dest_dir,
+            'dest_fn':            None,
+            'dest_post_action':   None,
+            'dest_post_dir':      None,
+            'port':                port}
+
+
+
+def parse_feed_setting(setting):
+    """ Turns key=value into (key, value) - with the value parsed as json
+        where possible so that numbers & booleans come through typed.
+    """
+    (key, sep, value) = setting.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('feed settings must look like key=value: %s' % setting)
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Measures mover throughput over a loopback sftp server')
+    parser.add_argument('--scenario',
+                        choices=sorted(SCENARIOS) + ['startup', 'all'],
+                        default='mixed',
+                        help='file count & size distribution to move - or startup')
+    parser.add_argument('--scale',
+                        type=float,
+                        default=1.0,
+                        help='multiplies the file counts of the scenario - ex: 0.01 for a quick run')
+    parser.add_argument('--file-count',
+                        type=int,
+                        help='runs a custom scenario of this many files instead')
+    parser.add_argument('--file-size',
+                        type=int,
+                        default=KB,
+                        help='size in bytes of each file in the custom scenario')
+    parser.add_argument('--feed',
+                        type=parse_feed_setting,
+                        action='append',
+                        default=[],
+                        help='overrides a feed config item - ex: max_workers=4 - may be repeated')
+    parser.add_argument('--startup-runs',
+                        type=int,
+                        default=STARTUP_RUNS,
+                        help='mover runs timed by the startup scenario - at least 2')
+    parser.add_argument('--temp-dir',
+                        help='where files are generated - defaults to the system temp dir')
+    parser.add_argument('--output',
+                        help='writes the json results here rather than to stdout')
+    parser.add_argument('--log-level',
+                        default='warning',
+                        choices=['debug', 'info', 'warning', 'error', 'critical'])
+    args = parser.parse_args()
+    args.feed = dict(args.feed)
+    return args
+
+
+
+def setup_logging(log_level):
+    global logger
+    logger  = logging.getLogger('__main__.benchmark')
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s : %(name)-12s : %(levelname)-8s : %(message)s'))
+    for log_name in ('__main__', 'paramiko'):
+        logging.getLogger(log_name).addHandler(handler)
+        logging.getLogger(log_name).setLevel(log_level.upper())
+    bfq_buffguts.setup_logging('__main__')
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
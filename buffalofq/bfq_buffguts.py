@@ -2,22 +2,59 @@
 
 import os, sys, time
 import errno
+import stat
+import socket
 import logging
+import threading
+import Queue
 import os.path
 from os.path import dirname, basename, exists, isdir, isfile, join as pjoin
 
+import re
 import fnmatch
+import heapq
+import itertools
+import hashlib
+import binascii
+import pipes
+import tarfile
 import paramiko
 from pprint import pprint as pp
+try:
+    from os import scandir              # python 3.5+
+except ImportError:
+    try:
+        from scandir import scandir     # the backport - see requirements.txt
+    except ImportError:
+        scandir = None
 
 #--- our modules -------------------
 import bfq_auditor
+import bfq_connection
+import bfq_dedup
+import bfq_delta
+import bfq_metrics
+import bfq_sourcefile
+import bfq_throttle
+import bfq_transport
+import bfq_watcher
 
 
 FAIL_STEP    = -1     # used by test-harness to force fails, -1 == no fail
 FAIL_SUBSTEP = -1     # used by test-harness to force fails, -1 == no fail
 FAIL_CATCH   = False  # used by test-harness to force fails
+BUFFER_SIZE  = 1048576  # default size of blocks read from source files
+SFTP_REQUEST_SIZE = paramiko.SFTPFile.MAX_REQUEST_SIZE  # largest write paramiko sends in one request
+RESUME_CHECK_SIZE = 65536  # size of dest temp file tail compared to source before resuming
+FANOUT_QUEUE_BLOCKS = 16  # blocks a destination may fall behind the fastest before it's detached
+SORT_TYPES   = ['str', 'int', 'float', 'ts']  # types of sort_key fields
+FIELDS_CACHE = {}     # filename -> {field: value} - see get_filename_fields
+FIELDS_CACHE_MAX = 100000  # entries kept before the cache is cleared
 logger       = None   # will get set to logging api later
+STREAM_EOF      = object()  # ChunkStream queue markers
+STREAM_ABORT    = object()
+STREAM_DETACHED = object()
+LISTDIR_LOGGED  = False     # whether scan_dir has said it's falling back to listdir
 
 
 
@@ -28,28 +65,106 @@ class HandleOneFeed(object):
                  audit_dir,
                  limit_total,
                  config_name,
-                 key_filename):
+                 key_filename,
+                 connection_pool=None):
 
         self.feed            = feed
-        self.auditor         = bfq_auditor.FeedAuditor(self.feed['name'], audit_dir, config_name=config_name)
+        self.auditor         = bfq_auditor.FeedAuditor(self.feed['name'], audit_dir, config_name=config_name,
+                                                       backend=self.feed.get('audit_backend') or 'json')
         self.limit_total     = limit_total
+        incomplete_files     = self.auditor.incomplete_files()
+        if incomplete_files:
+            logger.info('files left incomplete by a prior run - will be recovered first: %s',
+                        ', '.join(incomplete_files))
         self.state_good      = None
         self.poll_good       = None  # true if it is time to poll again
         self.poll_last_time  = 0
+        self.poll_interval   = PollInterval(self.feed['polling_seconds'],
+                                            self.feed.get('polling_min_seconds'))
         self.files           = None
         self.transport       = None
         self.sftp            = None
         self.key_filename    = key_filename
-        self.mykey           = None
+        # pulling connects to the source_host & moves files to the local
+        # dest_dir - pushing connects to the dest_host:
+        self.pull            = self.feed.get('direction') == 'pull'
+        self.file_class      = PullOneFile if self.pull else HandleOneFile
+        self.connections     = bfq_transport.get_connections(
+                                   self.feed['source_host' if self.pull else 'dest_host'],
+                                   self.feed['port'],
+                                   self.feed['source_user' if self.pull else 'dest_user'],
+                                   key_filename,
+                                   transport=self.feed.get('transport') or 'sftp',
+                                   pool=connection_pool,
+                                   keepalive_seconds=self.feed.get('keepalive_seconds', 30),
+                                   window_size=self.feed.get('window_size'),
+                                   max_packet_size=self.feed.get('max_packet_size'))
+        # with destinations each file is fanned out to all of them - each
+        # with its own connection:
+        self.destinations    = [Destination(self.feed, x, self.auditor, key_filename,
+                                            connection_pool)
+                                for x in self.feed.get('destinations') or []]
         self.file_cnt        = 0
+        self.max_workers     = self.feed.get('max_workers', 1) or 1
+        self.recovery_mode   = False  # true if files only holds a failed file
+        self.slot_recovery   = {}     # slot -> fn left in progress by a worker
+        self.cnt_lock        = threading.Lock()
+        self.watcher         = None
+        self.files_arrived   = False  # true if the watcher saw a file land
+        self.bundle_max_files = self.feed.get('bundle_max_files') or 0
+        self.bundle_max_bytes = self.feed.get('bundle_max_bytes') or 0
+        # the local transport has nothing for bundles or deltas to save:
+        self.local           = isinstance(self.connections, bfq_transport.LocalConnectionManager)
+        if (self.pull or self.local) and self.bundle_max_files:
+            logger.warning('bundles are not supported when pulling or moving locally - '
+                           'will move files one at a time')
+            self.bundle_max_files = 0
+        if self.destinations and (self.pull or self.bundle_max_files or self.max_workers > 1):
+            logger.warning('destinations only support pushing one file at a time - '
+                           'will ignore direction, bundles & max_workers')
+        self.metrics         = bfq_metrics.FeedMetrics(self.feed['name'],
+                                   metrics_file=self.feed.get('metrics_file'),
+                                   metrics_format=self.feed.get('metrics_format') or 'prometheus',
+                                   write_seconds=self.feed.get('metrics_seconds') or 60)
+        self.dedup           = None
+        if self.feed.get('dedup'):
+            if self.pull or self.destinations or self.bundle_max_files:
+                logger.warning('dedup is only supported when pushing files one at a time - '
+                               'will send every file')
+            else:
+                self.dedup   = bfq_dedup.DedupIndex(pjoin(audit_dir, '%s_dedup.sqlite' % config_name),
+                                   keep_days=self.feed.get('dedup_keep_days', 30),
+                                   max_entries=self.feed.get('dedup_max_entries', 1000000))
+        self.delta           = None
+        if self.feed.get('delta'):
+            if self.pull or self.local or self.destinations or self.bundle_max_files:
+                logger.warning('delta is only supported when pushing files one at a time over sftp - '
+                               'will send whole files')
+            else:
+                self.delta   = bfq_delta.DeltaCache(pjoin(audit_dir, '%s_delta' % config_name))
 
 
     def file_check(self, force=False):
         self._check_prereqs()
+        if self.files_arrived:
+            # no need to wait out polling_seconds for a file we know is there:
+            self.poll_good     = True
+            self.files_arrived = False
         if self.poll_good or force:
-            self.files = self._get_files_to_move()
-            self.mykey = self._get_key()
-            (self.transport, self.sftp) = self._setup_connection()
+            if self.pull:
+                # the remote source_dir can't be listed without it:
+                with self.metrics.timer('setup_connection'):
+                    (self.transport, self.sftp) = self._setup_connection()
+            with self.metrics.timer('get_files_to_move'):
+                self.files = self._get_files_to_move()
+            self.poll_interval.update(bool(self.files))
+            if self.files and self.destinations:
+                with self.metrics.timer('setup_connection'):
+                    for destination in self.destinations:
+                        destination.connect()
+            elif self.files and not self.pull:
+                with self.metrics.timer('setup_connection'):
+                    (self.transport, self.sftp) = self._setup_connection()
 
     def _check_prereqs(self):
         """ Checks all feed prerequisites:
@@ -59,14 +174,24 @@ class HandleOneFeed(object):
         # todo: confirm that both source & dest have sufficient disk space
         self.state_good = self._check_state()
         if self.auditor.status['empty_audit']:
-            self.poll_good  = self._check_polling(self.poll_last_time, self.feed['polling_seconds'])
+            self.poll_good  = self._check_polling(self.poll_last_time, self.poll_interval.seconds)
         else:
-            self.poll_good  = self._check_polling(self.auditor.status['time'], self.feed['polling_seconds'])
+            self.poll_good  = self._check_polling(self.auditor.status['time'], self.poll_interval.seconds)
 
     def close(self):
-        if self.sftp:
-            self.sftp.close()
-            self.transport.close()
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
+        self.metrics.write()
+        self.connections.close()
+        for destination in self.destinations:
+            destination.close()
+        if self.dedup:
+            self.dedup.close()
+            self.dedup = None
+        self.auditor.close()
+        self.transport = None
+        self.sftp      = None
 
 
     def run(self, force, suppcheck=None):
@@ -74,6 +199,13 @@ class HandleOneFeed(object):
         processed_last_time = 0
         logger.info('HandleOneFeeds run starting')
 
+        # the watch must be in place before the first scan so that no
+        # arrivals are missed between them:
+        if (self.feed.get('source_watcher') == 'inotify' and self.limit_total == -1
+                and not self.pull):
+            self.watcher = bfq_watcher.get_watcher(self.feed['source_dir'],
+                                                   self.feed['source_fn'])
+
         while True:
 
             if suppcheck:  # suppcheck will be None for testing
@@ -81,24 +213,19 @@ class HandleOneFeed(object):
                     logger.warning('feed has been suppressed - will terminate')
                     break
 
-            self.file_check(force)
-
-            if self.poll_good:
-                if self.files:
-                    self.do_all_files()
-                processed_last_time = time.time()
-            elif force:
-                if self.files:
-                    logger.info('Insufficient polling duration - will force anyway')
-                    self.do_all_files()
+            if self.run_once(force):
                 processed_last_time = time.time()
             else:
                 # after 5 minutes of polling write a log message:
                 if (time.time() - processed_last_time) > 300:
                     logger.info('polling continuing')
                     processed_last_time = time.time()
-                # can safely sleep for a few:
-                time.sleep(self.feed['polling_seconds'])
+                # can safely sleep for a few - or until the watcher sees
+                # a file land, with polling kept as a safety net:
+                if self.watcher:
+                    self.files_arrived = self.watcher.wait(self.poll_interval.seconds)
+                else:
+                    time.sleep(self.poll_interval.seconds)
 
             # Quit if not running continuously:
             if self.limit_total > -1:
@@ -107,17 +234,66 @@ class HandleOneFeed(object):
         self.close()
 
 
+    def run_once(self, force=False):
+        """ Makes a single pass: moves any files found if the feed is due to
+            be polled (or forced).  Returns False if it wasn't due.
+        """
+        self.file_check(force)
+        if not self.poll_good and not force:
+            return False
+        if self.files:
+            if not self.poll_good:
+                logger.info('Insufficient polling duration - will force anyway')
+            self.do_all_files()
+        return True
+
+
+    def next_poll_time(self):
+        """ Returns when the feed is next due to be polled - as judged by
+            _check_prereqs.
+        """
+        if self.auditor.status['empty_audit']:
+            return self.poll_last_time + self.poll_interval.seconds
+        return self.auditor.status['time'] + self.poll_interval.seconds
+
+
     def do_all_files(self):
         """ if any tasks for any files fail - skip all remaining
             processing.
         """
+        if self.destinations:
+            self._do_all_files_fanout()
+            return
         # todo: should probably log if not self.sftp...
         if self.sftp:
+            if self.recovery_mode and self.auditor.status.get('members'):
+                handle_one_bundle = HandleOneBundle(self.feed,
+                                                    self.auditor.status['fn'],
+                                                    self.auditor.status['members'],
+                                                    self.auditor,
+                                                    self.sftp,
+                                                    self.metrics)
+                if handle_one_bundle.run_all_steps():
+                    self.file_cnt += len(handle_one_bundle.members)
+                return
+            if self.slot_recovery and not self.recovery_mode:
+                # finishes what worker slots left - whatever max_workers now is:
+                self._do_all_files_parallel()
+                return
+            if self.bundle_max_files > 1 and not self.recovery_mode:
+                self._do_all_bundles()
+                return
+            if self.max_workers > 1 and not self.recovery_mode:
+                self._do_all_files_parallel()
+                return
             for one_file in self.files:
-                handle_one_file = HandleOneFile(self.feed,
+                handle_one_file = self.file_class(self.feed,
                                                 one_file,
                                                 self.auditor,
-                                                self.sftp)
+                                                self.sftp,
+                                                self.metrics,
+                                                self.dedup,
+                                                self.delta)
                 if not handle_one_file.run_all_steps():
                     break
                 self.file_cnt += 1
@@ -126,6 +302,146 @@ class HandleOneFeed(object):
                     break
 
 
+    def _do_all_files_fanout(self):
+        """ Moves each file to every destination - see FanOutOneFile.  A
+            destination that fails only holds up its own files, and those
+            stay in the source until it has them - so only files that leave
+            the source are counted.  A failure of the feed's own steps skips
+            all remaining files, as with a single destination.
+        """
+        for destination in self.destinations:
+            destination.forget_missing()
+        for one_file in self.files:
+            handle_one_file = FanOutOneFile(self.feed,
+                                            one_file,
+                                            self.auditor,
+                                            self.destinations,
+                                            self.metrics)
+            if not handle_one_file.run_all_steps():
+                break
+            if handle_one_file.held:
+                continue
+            self.file_cnt += 1
+            if self.limit_total > 0 and self.file_cnt >= self.limit_total:
+                logger.debug('limit_total reached, file movement stopped')
+                break
+
+
+    def _do_all_bundles(self):
+        """ Moves files in bundles of up to bundle_max_files files - or fewer
+            once they reach bundle_max_bytes.  Each bundle is a single
+            transfer, and is audited as one unit.
+        """
+        for members in self._get_bundles():
+            bundle_name = 'bundle_%s' % members[0]
+            handle_one_bundle = HandleOneBundle(self.feed,
+                                                bundle_name,
+                                                members,
+                                                self.auditor,
+                                                self.sftp,
+                                                self.metrics)
+            if not handle_one_bundle.run_all_steps():
+                break
+            self.file_cnt += len(members)
+
+
+    def _get_bundles(self):
+        """ Groups self.files into bundles - stopping at limit_total.
+        """
+        members   = []
+        byte_cnt  = 0
+        file_cnt  = self.file_cnt
+        for one_file in self.files:
+            if self.limit_total > 0 and file_cnt >= self.limit_total:
+                break
+            members.append(one_file)
+            file_cnt += 1
+            if self.bundle_max_bytes:
+                byte_cnt += os.path.getsize(pjoin(self.feed['source_dir'], one_file))
+            if (len(members) >= self.bundle_max_files
+                or (self.bundle_max_bytes and byte_cnt >= self.bundle_max_bytes)):
+                yield members
+                members  = []
+                byte_cnt = 0
+        if members:
+            yield members
+
+
+    def _do_all_files_parallel(self):
+        """ Moves files concurrently - each of max_workers threads gets its
+            own sftp channel on the shared transport and its own audit slot,
+            so every in-flight file can be recovered independently.
+            Files left in progress by a slot are finished by that same slot
+            before it takes any new files - a slot beyond max_workers, as
+            when max_workers has been lowered, only finishes its own file.
+            As with the serial path, a failure of any file stops all
+            workers from taking new files.
+        """
+        file_queue = Queue.Queue()
+        for one_file in self.files:
+            if one_file not in self.slot_recovery.values():
+                file_queue.put(one_file)
+        stop_event = threading.Event()
+        errors     = []
+        workers    = []
+        # a slot left in progress must run even if max_workers was lowered:
+        for slot in sorted(set(range(self.max_workers)) | set(self.slot_recovery)):
+            worker = threading.Thread(target=self._worker,
+                                      name='bfq_worker_%d' % slot,
+                                      args=(slot, file_queue, stop_event, errors))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        self.slot_recovery = {}
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+
+
+    def _worker(self, slot, file_queue, stop_event, errors):
+        auditor      = self.auditor.slot_auditor(slot)
+        recovery_fn  = self.slot_recovery.get(slot)
+        sftp         = None
+        try:
+            sftp = self._open_sftp()
+            while not stop_event.is_set():
+                if recovery_fn:
+                    (one_file, recovery_fn) = (recovery_fn, None)
+                elif slot >= self.max_workers:
+                    break
+                else:
+                    try:
+                        one_file = file_queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                if not self._reserve_file_cnt():
+                    logger.debug('limit_total reached, file movement stopped')
+                    break
+                handle_one_file = self.file_class(self.feed, one_file, auditor, sftp,
+                                                  self.metrics, self.dedup, self.delta)
+                if not handle_one_file.run_all_steps():
+                    stop_event.set()
+                    break
+        except:
+            errors.append(sys.exc_info())
+            stop_event.set()
+        finally:
+            if sftp:
+                sftp.close()
+
+
+    def _reserve_file_cnt(self):
+        """ Counts a file against limit_total before a worker starts on it.
+            Returns False if the limit has already been reached.
+        """
+        with self.cnt_lock:
+            if self.limit_total > 0 and self.file_cnt >= self.limit_total:
+                return False
+            self.file_cnt += 1
+            return True
+
+
     def _check_state(self):
 
         if (self.auditor.status['step']    == 6
@@ -154,59 +470,108 @@ class HandleOneFeed(object):
             file system.  In a recovery scenario it only gets the file
             name that previously failed.
         """
-        # todo: need to support both pushing & pulling files
         step = 0
         self.poll_last_time = time.time()
         # shouldn't this just check for recovery_mode?!?
         if (self.auditor.status['fn']
             and (not self.state_good
                  or not good_to_run(step, self.auditor.status))):
+            self.recovery_mode = True
             return [self.auditor.status['fn']]
         else:
+            self.recovery_mode = False
             self.auditor.write(step=step, status='start', fn='')
-            source_files   = os.listdir(self.feed['source_dir'])
-            filtered_files = fnmatch.filter(source_files,
-                                            self.feed['source_fn'])
-            sorted_filtered_files = self._sort_files(filtered_files)
+            if self.pull:
+                filtered_files = scan_remote_dir(self.sftp,
+                                                 self.feed['source_dir'],
+                                                 self.feed['source_fn'])
+            else:
+                filtered_files = scan_dir(self.feed['source_dir'],
+                                          self.feed['source_fn'])
+            # with a limit only the next batch is selected - so a backlog
+            # of millions of files is never held in memory or fully sorted:
+            if self.limit_total > 0:
+                limit = max(self.limit_total - self.file_cnt, 0)
+            else:
+                limit = None
+            sorted_filtered_files = self._sort_files(filtered_files, limit)
+            # files left in progress by workers go first, whether or not
+            # they're still in the source_dir - or max_workers is still > 1:
+            self.slot_recovery = self.auditor.incomplete_slots()
+            if self.slot_recovery:
+                recovery_files = sorted(self.slot_recovery.values())
+                sorted_filtered_files = (recovery_files
+                                         + [x for x in sorted_filtered_files
+                                            if x not in recovery_files])
             fail_check(step)
             self.auditor.write(step=step, status='stop', result='pass')
             return sorted_filtered_files
 
 
-    def _sort_files(self, files):
+    def _sort_files(self, files, limit=None):
         """ Uses self.feed['sort_key']:
                 - None = no sort
                 - name = alphabetic on name
                 - 'field:?' = looks for this key in filename, sorts by associated value
+                - 'field:?:type' = as above, but typed - see parse_sort_key
+                - a comma-separated list of the above, each optionally
+                  followed by asc or desc - ex: field:date:ts,field:seq:int,desc
+            Files can be any iterable.  If a limit is provided only the
+            first limit files are returned - picked with a heap rather than
+            a full sort.
         """
         if self.feed['sort_key'] is None:
-            return files
-        elif self.feed['sort_key'] == 'name':
-            return sorted(files)
-        elif self.feed['sort_key'].startswith('field:'):
-            parts = self.feed['sort_key'].split(':')
-            return sort_files_by_fields(files, parts[1])
-        else:
-            msg = 'Invalid sort_key: %s' % self.feed['sort_key']
-            logger.critical(msg)
-            raise ValueError(msg)
+            if limit is None:
+                return list(files)
+            return list(itertools.islice(files, limit))
+        try:
+            terms = parse_sort_key(self.feed['sort_key'])
+        except ValueError as e:
+            logger.critical(str(e))
+            raise
+        key = None if terms == [(None, 'str', False)] else files_sort_key(terms)
+        if limit is None:
+            return sorted(files, key=key)
+        return heapq.nsmallest(limit, files, key=key)
 
 
-    def _get_key(self):
-        # private key must not be encrypted (must not have a passphrase):
-        pkfile = os.path.expanduser('~/.ssh/%s' % self.key_filename)
-        return paramiko.RSAKey.from_private_key_file(pkfile)
+    def _setup_connection(self):
+        """ Returns the feed's (transport, sftp) - which are kept open across
+            polls and only reconnected if the session has died.
+        """
+        return self.connections.get()
+
+
+    def _open_sftp(self):
+        """ Opens an additional sftp channel on the feed's transport.
+        """
+        return self.connections.open_sftp()
 
 
-    def _setup_connection(self):
 
-        transport = paramiko.Transport((self.feed['dest_host'],
-                                             self.feed['port']))
 
-        transport.connect(username=self.feed['dest_user'],
-                          pkey=self.mykey)
-        sftp = paramiko.SFTPClient.from_transport(transport)
-        return transport, sftp
+
+class PollInterval(object):
+    """ The time between polls of the source_dir.  Fixed at polling_seconds
+        unless a polling_min_seconds is given - in which case it halves
+        (down to polling_min_seconds) after each poll that finds files, and
+        doubles (up to polling_seconds) after each one that doesn't.  So a
+        busy feed is polled often, and an idle one barely at all.
+    """
+    def __init__(self, max_seconds, min_seconds=None):
+        self.max_seconds = float(max_seconds)
+        self.min_seconds = min(float(min_seconds or max_seconds), self.max_seconds)
+        self.seconds     = self.min_seconds
+
+    def update(self, found_files):
+        if found_files:
+            seconds = max(self.seconds / 2, self.min_seconds)
+        else:
+            seconds = min(self.seconds * 2, self.max_seconds)
+        if seconds != self.seconds:
+            logger.info('polling interval is now %.1f seconds', seconds)
+            self.seconds = seconds
+        return seconds
 
 
 
@@ -214,15 +579,29 @@ class HandleOneFeed(object):
 
 class HandleOneFile(object):
 
-    def __init__(self, feed, one_file, auditor, sftp):
+    def __init__(self, feed, one_file, auditor, sftp, metrics=None, dedup=None, delta=None):
         assert one_file == basename(one_file)
         self.feed           = feed
         self.fn             = one_file
         self.auditor        = auditor
         self.sftp           = sftp
+        self.metrics        = metrics or bfq_metrics.FeedMetrics(feed['name'])
         self.source_fqfn    = pjoin(self.feed['source_dir'], self.fn)
         self.dest_fqfn      = pjoin(self.feed['dest_dir'], self.fn)
         self.dest_temp_fqfn = '%s.temp' % self.dest_fqfn
+        self.checksum_type  = self.feed.get('checksum_type') or 'sha256'
+        self.checksum       = None  # hex digest of source - computed during copy
+        self.members        = None  # only used by bundles
+        self.throttle       = bfq_throttle.get_throttle(feed)  # None if unlimited
+        self.dedup          = dedup  # DedupIndex - None unless deduping
+        self.duplicate_of   = None   # where the same content was already delivered
+        self.dedup_checked  = False
+        self.delta          = delta  # DeltaCache - None unless sending deltas
+        self.signature      = None   # bfq_delta.SignatureBuilder fed by the copy
+        # a copy (step 3) or rename (step 4) of this file was cut short:
+        self.resuming       = (self.auditor.status['fn'] == one_file
+                               and self.auditor.status['step'] in [3, 4]
+                               and self.auditor.status['result'] != 'pass')
         logger.debug('Moving file: %s' % one_file)
 
 
@@ -243,9 +622,15 @@ class HandleOneFile(object):
         if self._step_runner(4, self._rename_dest_file) is False:
             return False
 
-        if self._step_runner(5, self._do_dest_post_actions) is False:
+        delivered = self._step_runner(5, self._do_dest_post_actions)
+        if delivered is False:
             return False
 
+        # only once delivered in this pass - a recovery that starts at step 6
+        # may find the source already moved or deleted:
+        if delivered and (self.dedup or self.delta):
+            self._record_delivered()
+
         if self._step_runner(6, self._do_source_post_actions) is False:
             return False
 
@@ -264,17 +649,22 @@ class HandleOneFile(object):
         fail_check(step, substep='a')
         if good_to_run(step, self.auditor.status):
             fail_check(step, substep='b')
-            self.auditor.write(step=step, status='start', fn=self.fn)
+            with self.metrics.timer('audit_write'):
+                self.auditor.write(step=step, status='start', fn=self.fn,
+                                   members=self.members)
             fail_check(step, substep='c')
 
             # run main task
-            result = task()
+            with self.metrics.timer(bfq_metrics.step_operation(step)):
+                result = task()
             assert result is not None
             if fail_check(step, substep='d'):
                 result = False
 
             assert(result is not None)
-            self.auditor.write(step=step, status='stop', result=result)
+            with self.metrics.timer('audit_write'):
+                self.auditor.write(step=step, status='stop', result=result,
+                                   checksum=self.checksum)
             fail_check(step, substep='e')
         else:
             logger.info('HandleOneFile._step_runner: step was bypassed: %d' % step)
@@ -298,23 +688,168 @@ class HandleOneFile(object):
 
 
     def _copy_file(self):
-        self.sftp.put(self.source_fqfn, self.dest_temp_fqfn)
+        """ Streams the source file to the dest temp file in buffer_size
+            blocks - read into a single reused buffer, see bfq_sourcefile.
+            With pipelining the sftp writes don't wait on their acks - which
+            are collected when the file is closed - so throughput isn't
+            bound by the round-trip time.
+            When recovering a copy that was cut short, the upload resumes
+            from the end of the dest temp file.
+            With the local transport the data is copied within the kernel -
+            unless a checksum is needed, in which case it's read as usual.
+        """
+        if self.dedup:
+            with self.metrics.timer('dedup_check'):
+                duplicate_of = self._find_duplicate()
+            if duplicate_of:
+                return self._deliver_duplicate()
+        if self.delta and self._copy_file_delta():
+            return True
+        start_time  = time.time()
+        buffer_size = self.feed.get('buffer_size') or BUFFER_SIZE
+        # a delta writes the temp file out of order - so it can't be resumed:
+        offset      = self._get_resume_offset() if self.resuming and not self.delta else 0
+        byte_cnt    = 0
+        # for crccheck & dedup the checksum is computed on the blocks as
+        # they're sent, so that the source is never read twice:
+        hasher      = None
+        # likewise the delta signature of what's sent - offset is always 0 here:
+        builder     = self._signature_builder() if self.delta else None
+        if self.feed.get('dest_post_action') == 'crccheck' or self.dedup:
+            hasher  = hashlib.new(self.checksum_type)
+        elif bfq_transport.is_local(self.sftp):
+            # nothing needs to see the data - so the kernel can copy it:
+            byte_cnt = self.sftp.copy_file(self.source_fqfn, self.dest_temp_fqfn, offset,
+                                           consume=self._throttle if self.throttle else None)
+            log_throughput(self.fn, byte_cnt, time.time() - start_time)
+            return True
+        with bfq_sourcefile.SourceFile(self.source_fqfn, buffer_size,
+                                       drop_cache=self.feed.get('drop_source_cache', True)) as source_file:
+            if offset:
+                dest_file = self.sftp.open(self.dest_temp_fqfn, 'r+b')
+                if hasher:
+                    # the resumed-over prefix still needs to be in the checksum:
+                    while byte_cnt < offset:
+                        data = source_file.read_view(min(buffer_size, offset - byte_cnt))
+                        hasher.update(data)
+                        byte_cnt += len(data)
+                source_file.seek(offset)
+                dest_file.seek(offset)
+                byte_cnt = offset
+            else:
+                dest_file = self.sftp.open(self.dest_temp_fqfn, 'wb')
+            with dest_file:
+                dest_file.set_pipelined(self.feed.get('pipelined', True))
+                while True:
+                    data = source_file.read_view()
+                    if not data:
+                        break
+                    if self.throttle:
+                        self._throttle(len(data))
+                    write_blocks(dest_file, data)
+                    if hasher:
+                        hasher.update(data)
+                    if builder:
+                        builder.update(data)
+                    byte_cnt += len(data)
+        self.signature = builder
+        dest_size = self.sftp.stat(self.dest_temp_fqfn).st_size
+        if dest_size != byte_cnt:
+            raise IOError('size mismatch in copy: %d != %d' % (dest_size, byte_cnt))
+        if hasher:
+            self.checksum = hasher.hexdigest()
+        log_throughput(self.fn, byte_cnt - offset, time.time() - start_time)
         return True
 
 
-    def _rename_dest_file(self):
+    def _throttle(self, byte_cnt):
+        """ Waits until byte_cnt bytes may be sent under the feed's & host's
+            max_bytes_per_sec - counting any wait in the metrics.
+        """
+        waited = self.throttle.consume(byte_cnt)
+        if waited:
+            self.metrics.observe('throttle_wait', waited)
+
+
+    def _copy_file_delta(self):
+        """ Sends only what's changed since the version last delivered
+            under this name - see bfq_delta.  Returns False, for a full copy
+            instead, if there's no usable prior version or if the delta
+            doesn't reproduce the source at the dest.
+        """
+        signature = self.delta.get(self._dest_id(), self.dest_fqfn)
+        if not signature:
+            return False
+        try:
+            attr = self.sftp.stat(signature['fqfn'])
+        except IOError:
+            return False
+        if attr.st_size != signature['size'] or attr.st_mtime != signature['mtime']:
+            logger.info('prior version was changed at the dest - will send all of %s', self.fn)
+            return False
+        start_time = time.time()
+        builder         = self._signature_builder()
+        (ops, checksum) = bfq_delta.compute_delta(self.source_fqfn, signature, self.checksum_type,
+                                                  builder)
+        run_cnt         = bfq_delta.copy_runs(ops)
+        if not run_cnt or run_cnt > bfq_delta.MAX_RUNS:
+            return False
+        try:
+            byte_cnt = bfq_delta.apply_delta(self.sftp, signature['fqfn'], self.dest_temp_fqfn,
+                                             self.source_fqfn, ops,
+                                             pipelined=self.feed.get('pipelined', True),
+                                             consume=self._throttle if self.throttle else None)
+            dest_checksum = get_remote_checksum_by_cmd(self.sftp, self.dest_temp_fqfn,
+                                                       self.checksum_type)
+        except (IOError, paramiko.SSHException) as e:
+            logger.warning('delta failed - will send all of %s: %s', self.fn, e)
+            return False
+        if dest_checksum != checksum:
+            logger.warning('delta did not reproduce the source - will send all of %s', self.fn)
+            return False
+        self.checksum  = checksum
+        self.signature = builder
+        log_throughput('%s (delta of %d bytes)' % (self.fn, os.path.getsize(self.source_fqfn)),
+                       byte_cnt, time.time() - start_time)
+        return True
+
+
+    def _signature_builder(self):
+        return bfq_delta.SignatureBuilder(os.path.getsize(self.source_fqfn),
+                                          self.feed.get('delta_block_size') or 65536)
+
+
+    def _get_resume_offset(self):
+        """ Returns the offset to resume an interrupted copy from - which is
+            the size of the dest temp file, provided that its last block
+            matches the source.  Otherwise returns 0 so the copy starts over.
+        """
         try:
-            self.sftp.rename(self.dest_temp_fqfn, self.dest_fqfn)
-        except IOError, e:
-            #print 'errno:          %d' % e.errno
-            #print 'file:           %s' % file
-            #print 'dest_fqfn:      %s' % dest_fqfn
-            #print 'dest_temp_fqfn: %s' % dest_temp_fqfn
-            #print 'dest dir: '
-            #pp(glob.glob(pjoin(self.feed['dest_dir'],'*')))
-            logger.error('_rename_dest_file got IOError - will remove dest and repeat rename')
-            self.sftp.remove(self.dest_fqfn)
-            self.sftp.rename(self.dest_temp_fqfn, self.dest_fqfn)
+            dest_size = self.sftp.stat(self.dest_temp_fqfn).st_size
+        except IOError:
+            return 0  # copy never got as far as creating it
+        if not dest_size or dest_size > os.path.getsize(self.source_fqfn):
+            return 0
+        check_size = min(RESUME_CHECK_SIZE, dest_size)
+        with self.sftp.open(self.dest_temp_fqfn, 'rb') as dest_file:
+            dest_file.seek(dest_size - check_size)
+            dest_tail = dest_file.read(check_size)
+        with open(self.source_fqfn, 'rb') as source_file:
+            source_file.seek(dest_size - check_size)
+            source_tail = source_file.read(check_size)
+        if dest_tail != source_tail:
+            logger.warning('dest temp file does not match source - will copy from start: %s'
+                           % self.dest_temp_fqfn)
+            return 0
+        logger.info('resuming copy of %s at byte %d', self.fn, dest_size)
+        return dest_size
+
+
+    def _rename_dest_file(self):
+        if self.dedup and self._skips_dest():
+            return True
+        # replaces any existing dest file - in a single round trip:
+        task_replace_dest_files(self.sftp, [(self.dest_temp_fqfn, self.dest_fqfn)])
         return True
 
 
@@ -322,9 +857,18 @@ class HandleOneFile(object):
     def _do_dest_post_actions(self):
         # todo: remove temp dir?
         # todo: change privs?
+        if self.dedup and self._skips_dest():
+            return True
         if self.feed.get('dest_post_action', 'unk') == 'crccheck':
-            logger.error('dest_post_actions of crccheck not yet implemented')
-            raise ValueError
+            # after a recovery the checksum comes from the audit of step 3:
+            checksum = self.checksum or self.auditor.status.get('checksum')
+            if not checksum:
+                logger.warning('no checksum from copy - will read source to get it')
+                checksum = get_file_checksum(self.source_fqfn, self.checksum_type)
+            return task_verify_dest_checksum(self.sftp,
+                                             self.dest_fqfn,
+                                             self.checksum_type,
+                                             checksum)
         elif self.feed.get('dest_post_action', 'unk') == 'symlink':
             return task_make_dest_symlink(self.sftp,
                                           self.feed['dest_dir'],
@@ -343,6 +887,93 @@ class HandleOneFile(object):
 
 
 
+    def _find_duplicate(self):
+        """ Returns where a file with the same content as the source was
+            already delivered to this destination - or None.  The source is
+            only hashed if a delivered file has the same size.
+            Checked once per file - or once again after a recovery, which
+            gets the same answer unless the delivered file has since gone.
+        """
+        if not self.dedup_checked:
+            self.dedup_checked = True
+            size = os.path.getsize(self.source_fqfn)
+            if self.dedup.has_size(self._dest_id(), size):
+                checksum = get_file_checksum(self.source_fqfn, self.checksum_type)
+                key      = '%s:%s' % (self.checksum_type, checksum)
+                entry    = self.dedup.find(self._dest_id(), key)
+                if entry:
+                    (fqfn, size, mtime) = entry
+                    try:
+                        attrs = self.sftp.stat(fqfn)
+                    except IOError:
+                        logger.info('delivered file has gone - will send %s: %s', self.fn, fqfn)
+                        self.dedup.remove(self._dest_id(), key)
+                    else:
+                        if attrs.st_size != size or (mtime is not None and attrs.st_mtime != mtime):
+                            logger.info('delivered file has changed - will send %s: %s', self.fn, fqfn)
+                            self.dedup.remove(self._dest_id(), key)
+                        else:
+                            self.duplicate_of = fqfn
+                            self.checksum     = checksum
+        return self.duplicate_of
+
+
+    def _skips_dest(self):
+        """ Returns True if the file is a duplicate that leaves nothing at
+            the dest - because dedup is skip, or because it's the very file
+            already there.
+        """
+        return bool(self._find_duplicate()
+                    and (self.feed['dedup'] == 'skip' or self.duplicate_of == self.dest_fqfn))
+
+
+    def _deliver_duplicate(self):
+        if self._skips_dest():
+            logger.info('skipped %s - already delivered as %s', self.fn, self.duplicate_of)
+        else:
+            # renamed into place by step 4 like any other temp file:
+            task_make_dest_symlinks(self.sftp, [(self.duplicate_of, self.dest_temp_fqfn)])
+            logger.info('symlinked %s to %s - already delivered', self.fn, self.duplicate_of)
+        return True
+
+
+    def _record_delivered(self):
+        """ Records where the file's content ended up - for dedup to compare
+            later files against, and for delta to diff its next version with.
+        """
+        if self.duplicate_of:
+            return
+        if self.feed.get('dest_post_action') == 'move':
+            fqfn = pjoin(self.feed['dest_post_dir'], self.feed['dest_post_fn'] or self.fn)
+        else:
+            fqfn = self.dest_fqfn
+        checksum = self.checksum or self.auditor.status.get('checksum')
+        if self.dedup and checksum:
+            try:
+                # as it is at the dest - to tell later whether it's been replaced:
+                attrs = self.sftp.stat(fqfn)
+                self.dedup.add(self._dest_id(), '%s:%s' % (self.checksum_type, checksum),
+                               attrs.st_size, fqfn, attrs.st_mtime)
+            except (IOError, OSError) as e:
+                logger.warning('delivery not recorded - a later copy will be sent: %s', e)
+        if self.delta:
+            try:
+                signature = self.signature.signature() if self.signature else None
+                if signature is None:
+                    # step 3 ran in an earlier process - so read the source again:
+                    signature = bfq_delta.file_signature(self.source_fqfn,
+                                                         self.feed.get('delta_block_size') or 65536)
+                signature['fqfn']  = fqfn
+                signature['mtime'] = self.sftp.stat(fqfn).st_mtime
+                self.delta.put(self._dest_id(), self.dest_fqfn, signature)
+            except (IOError, OSError) as e:
+                logger.warning('delta signature not saved - next version will be sent whole: %s', e)
+
+
+    def _dest_id(self):
+        return '%s@%s:%s' % (self.feed['dest_user'], self.feed['dest_host'], self.feed['port'])
+
+
     def _do_source_post_actions(self):
         if self.feed.get('source_post_action', 'unk') == 'delete':
             return task_delete_source_file(self.source_fqfn)
@@ -354,10 +985,693 @@ class HandleOneFile(object):
 
 
 
+class HandleOneBundle(HandleOneFile):
+    """ Moves many small files as a single unit - through the same six steps
+        and with a single audit record that lists the member files:
+            - step 3 streams every member as one tar archive into a single
+              remote tar command, which unpacks them into a temp directory
+              within the dest_dir
+            - step 4 moves every member from the temp directory into the
+              dest_dir with a single remote command
+            - steps 5 & 6 then run the post actions for each member.
+        This replaces a round of sftp requests & audit writes per file with
+        one per bundle - and so requires that the dest host run commands.
+    """
+
+    def __init__(self, feed, bundle_name, members, auditor, sftp, metrics=None):
+        HandleOneFile.__init__(self, feed, bundle_name, auditor, sftp, metrics)
+        self.members        = members
+        self.dest_temp_dir  = '%s.temp' % self.dest_fqfn
+        self.checksums      = {}    # member -> hex digest, computed during copy
+        self.transport      = sftp.get_channel().get_transport()
+
+
+    def _copy_file(self):
+        """ Any temp directory left by an interrupted copy is replaced, since
+            tar can't resume part way through an archive.
+        """
+        start_time  = time.time()
+        buffer_size = self.feed.get('buffer_size') or BUFFER_SIZE
+        byte_cnt    = [0]
+        crccheck    = self.feed.get('dest_post_action') == 'crccheck'
+
+        def write_tar(stdin):
+            tar = tarfile.open(fileobj=stdin, mode='w|', bufsize=buffer_size)
+            for member in self.members:
+                source_fqfn = pjoin(self.feed['source_dir'], member)
+                tarinfo     = tar.gettarinfo(source_fqfn, arcname=member)
+                with open(source_fqfn, 'rb') as source_file:
+                    if self.throttle:
+                        source_file = ThrottledFile(source_file, self._throttle)
+                    if crccheck:
+                        hasher = hashlib.new(self.checksum_type)
+                        tar.addfile(tarinfo, HashingReader(source_file, hasher))
+                        self.checksums[member] = hasher.hexdigest()
+                    else:
+                        tar.addfile(tarinfo, source_file)
+                byte_cnt[0] += tarinfo.size
+            tar.close()
+
+        temp_dir = pipes.quote(self.dest_temp_dir)
+        cmd      = 'rm -rf %s && mkdir %s && tar -xf - -C %s' % (temp_dir, temp_dir, temp_dir)
+        (status, _) = bfq_connection.run_command(self.transport, cmd, stdin_writer=write_tar)
+        if status != 0:
+            logger.error('bundle copy failed with status %d: %s', status, self.fn)
+            return False
+        log_throughput('%s (%d files)' % (self.fn, len(self.members)),
+                       byte_cnt[0], time.time() - start_time)
+        return True
+
+
+    def _rename_dest_file(self):
+        """ Moves all members into the dest_dir in one remote command - which
+            is a no-op if a prior attempt already got as far as removing the
+            temp directory.
+        """
+        temp_dir = pipes.quote(self.dest_temp_dir)
+        cmd = ('if [ -d %s ]; then '
+               'cd %s && find . -mindepth 1 -maxdepth 1 -exec mv -f -t .. -- {} + '
+               '&& cd .. && rmdir %s; fi' % (temp_dir, temp_dir, temp_dir))
+        (status, _) = bfq_connection.run_command(self.transport, cmd)
+        if status != 0:
+            logger.error('bundle rename failed with status %d: %s', status, self.fn)
+            return False
+        return True
+
+
+    def _do_dest_post_actions(self):
+        """ Symlinks & moves for every member are sent as one pipelined
+            batch - since the bundle is audited as a unit there's no need
+            to wait on each member's.
+        """
+        if self.feed.get('dest_post_action', 'unk') == 'crccheck':
+            return self._verify_dest_checksums()
+        elif self.feed.get('dest_post_action', 'unk') == 'symlink':
+            task_make_dest_symlinks(self.sftp,
+                                    [(pjoin(self.feed['dest_dir'], member),
+                                      pjoin(self.feed['dest_post_dir'],
+                                            self.feed['dest_post_fn'] or member))
+                                     for member in self.members])
+            return True
+        elif self.feed.get('dest_post_action', 'unk') == 'move':
+            task_replace_dest_files(self.sftp,
+                                    [(pjoin(self.feed['dest_dir'], member),
+                                      pjoin(self.feed['dest_post_dir'],
+                                            self.feed['dest_post_fn'] or member))
+                                     for member in self.members])
+            return True
+        for member in self.members:
+            one_file = HandleOneFile(self.feed, member, self.auditor, self.sftp,
+                                     self.metrics)
+            if not one_file._do_dest_post_actions():
+                return False
+        return True
+
+
+    def _verify_dest_checksums(self):
+        """ Gets the checksums of every member with a single remote command.
+            After a recovery the source checksums have to be read again.
+        """
+        for member in self.members:
+            if member not in self.checksums:
+                self.checksums[member] = get_file_checksum(pjoin(self.feed['source_dir'], member),
+                                                           self.checksum_type)
+        cmd = 'cd %s && %ssum -- %s' % (pipes.quote(self.feed['dest_dir']),
+                                        self.checksum_type,
+                                        ' '.join([pipes.quote(x) for x in self.members]))
+        (status, stdout) = bfq_connection.run_command(self.transport, cmd)
+        if status != 0:
+            logger.error('bundle checksum command failed with status %d: %s', status, self.fn)
+            return False
+        remote_checksums = {}
+        for line in stdout.splitlines():
+            (checksum, member) = line.split(None, 1)
+            remote_checksums[member.lstrip('*')] = checksum
+        for member in self.members:
+            if remote_checksums.get(member) != self.checksums[member]:
+                logger.critical('checksum mismatch on %s: source %s != dest %s', member,
+                                self.checksums[member], remote_checksums.get(member))
+                return False
+        return True
+
+
+    def _do_source_post_actions(self):
+        for member in self.members:
+            one_file = HandleOneFile(self.feed, member, self.auditor, self.sftp,
+                                     self.metrics)
+            if not one_file._do_source_post_actions():
+                return False
+        return True
+
+
+
+class PullOneFile(HandleOneFile):
+    """ Moves a single file from the source_dir of a remote source_host to
+        the local dest_dir - through the same six steps, audit & recovery
+        as a push:
+            - step 3 downloads the file with paramiko's prefetching getfo
+              (which keeps many read requests in flight) into a local temp
+              file - fsynced before step 4 renames it into place
+            - step 5's post actions are local, and step 6's remote.
+        An interrupted download starts over rather than resuming.
+    """
+
+    def _copy_file(self):
+        start_time = time.time()
+        hasher     = None
+        if self.feed.get('dest_post_action') == 'crccheck':
+            hasher = hashlib.new(self.checksum_type)
+        with open(self.dest_temp_fqfn, 'wb') as dest_file:
+            writer   = HashingWriter(dest_file, hasher) if hasher else dest_file
+            if self.throttle:
+                writer = ThrottledFile(writer, self._throttle)
+            byte_cnt = self.sftp.getfo(self.source_fqfn, writer)
+            dest_file.flush()
+            os.fsync(dest_file.fileno())
+        dest_size = os.path.getsize(self.dest_temp_fqfn)
+        if dest_size != byte_cnt:
+            raise IOError('size mismatch in copy: %d != %d' % (dest_size, byte_cnt))
+        if hasher:
+            self.checksum = hasher.hexdigest()
+        log_throughput(self.fn, byte_cnt, time.time() - start_time)
+        return True
+
+
+    def _rename_dest_file(self):
+        os.rename(self.dest_temp_fqfn, self.dest_fqfn)
+        return True
+
+
+    def _do_dest_post_actions(self):
+        if self.feed.get('dest_post_action', 'unk') == 'crccheck':
+            # the checksum of what was downloaded - against the source's:
+            checksum = self.checksum or self.auditor.status.get('checksum')
+            if not checksum:
+                checksum = get_file_checksum(self.dest_fqfn, self.checksum_type)
+            return task_verify_dest_checksum(self.sftp,
+                                             self.source_fqfn,
+                                             self.checksum_type,
+                                             checksum)
+        elif self.feed.get('dest_post_action', 'unk') == 'symlink':
+            symlink_fqfn = pjoin(self.feed['dest_post_dir'],
+                                 self.feed['dest_post_fn'] or self.fn)
+            if os.path.lexists(symlink_fqfn):
+                os.remove(symlink_fqfn)
+            os.symlink(self.dest_fqfn, symlink_fqfn)
+            return True
+        elif self.feed.get('dest_post_action', 'unk') == 'move':
+            return task_move_source_file(self.dest_fqfn,
+                                         pjoin(self.feed['dest_post_dir'],
+                                               self.feed['dest_post_fn'] or self.fn))
+        else:
+            return True
+
+
+    def _do_source_post_actions(self):
+        if self.feed.get('source_post_action', 'unk') == 'delete':
+            return task_delete_remote_source_file(self.sftp, self.source_fqfn)
+        elif self.feed.get('source_post_action', 'unk') == 'move':
+            return task_move_remote_source_file(self.sftp, self.source_fqfn,
+                           pjoin(self.feed['source_post_dir'], self.fn))
+        else:
+            return True
+
+
+
+class Destination(object):
+    """ One destination of a fanned-out feed: the feed's settings overridden
+        by the destination's own, plus its connection & audit record.
+    """
+    def __init__(self, feed, dest_config, auditor, key_filename, connection_pool=None):
+        self.name        = dest_config['name']
+        self.feed        = dict(feed)
+        self.feed.update((k, v) for (k, v) in dest_config.items() if k != 'name')
+        del self.feed['destinations']
+        self.auditor     = auditor.dest_auditor(self.name)
+        self.sftp        = None
+        self.connections = bfq_transport.get_connections(
+                               self.feed['dest_host'],
+                               self.feed['port'],
+                               self.feed['dest_user'],
+                               key_filename,
+                               transport=self.feed.get('transport') or 'sftp',
+                               pool=connection_pool,
+                               keepalive_seconds=self.feed.get('keepalive_seconds', 30),
+                               window_size=self.feed.get('window_size'),
+                               max_packet_size=self.feed.get('max_packet_size'))
+
+    def connect(self):
+        """ A destination that can't be reached is left unconnected - so
+            that the others still get their files.
+        """
+        try:
+            (_, self.sftp) = self.connections.get()
+        except (socket.error, EOFError, paramiko.SSHException) as e:
+            logger.error('destination %s is unreachable: %s', self.name, e)
+            self.sftp = None
+
+    def delivered_files(self):
+        """ Returns the files this destination has that the source still
+            holds, waiting on other destinations.
+        """
+        return self.auditor.status.get('delivered') or []
+
+    def add_delivered(self, fn):
+        if fn not in self.delivered_files():
+            self._write_delivered(self.delivered_files() + [fn])
+
+    def forget_delivered(self, fn):
+        if fn in self.delivered_files():
+            self._write_delivered([x for x in self.delivered_files() if x != fn])
+
+    def forget_missing(self):
+        """ Forgets files that have left the source some other way - so that
+            a new file of the same name isn't taken as already delivered.
+        """
+        remaining = [x for x in self.delivered_files()
+                     if exists(pjoin(self.feed['source_dir'], x))]
+        if remaining != self.delivered_files():
+            self._write_delivered(remaining)
+
+    def _write_delivered(self, fns):
+        # leaves the record's state as it is - it may be part way through another file:
+        status = self.auditor.status
+        self.auditor.write(step=status['step'], status=status['status'], result=status['result'],
+                           delivered=fns)
+
+    def close(self):
+        self.connections.close()
+        self.sftp = None
+
+
+
+class FanOutOneFile(HandleOneFile):
+    """ Moves a single file to every destination of a fanned-out feed -
+        reading the source only once:
+            - each destination that doesn't already have the file runs
+              all six steps on its own thread and audit record (see
+              FanOutDestFile) - so one that's slow or fails doesn't hold up
+              the others
+            - step 3 reads the source into a ChunkStream that every
+              destination's copy writes from
+            - the feed's own steps 2-5 pass once every destination has
+              finished them, whether it passed or failed
+            - step 6's source post actions only run once every destination
+              has the file.  Until then the file is held in the source and
+              each destination's audit record lists it as delivered - so
+              that later polls send it only to those still without it.
+        A destination that fails resumes the file from its own audit record
+        on the next poll, and skips any other file until it has.
+    """
+
+    def __init__(self, feed, one_file, auditor, destinations, metrics=None):
+        # the last run left this very file incomplete:
+        self.recovering   = (auditor.status['fn'] == one_file
+                             and not bfq_auditor.is_complete(auditor.status))
+        HandleOneFile.__init__(self, feed, one_file, auditor, None, metrics)
+        self.destinations = destinations
+        self.stream       = None
+        self.dest_files   = []
+        self.failed_dests = set()  # names of those that have failed a step
+        self.held         = False  # true if left in the source for some destinations
+
+
+    def run_all_steps(self):
+
+        if self._step_runner(1, self._do_source_pre_actions) is False:
+            return False
+
+        targets = [x for x in self.destinations if self._wants_file(x)]
+        hasher  = None
+        if [x for x in targets if x.feed.get('dest_post_action') == 'crccheck']:
+            hasher = hashlib.new(self.checksum_type)
+        self.stream     = ChunkStream(self.source_fqfn,
+                                      self.feed.get('buffer_size') or BUFFER_SIZE,
+                                      hasher=hasher)
+        self.dest_files = [FanOutDestFile(x, self.fn, self.stream, self.metrics)
+                           for x in targets]
+        for dest_file in self.dest_files:
+            dest_file.start()
+        try:
+            if not self._run_dest_steps():
+                return False
+        finally:
+            self.stream.abort()   # a no-op unless the stream never ran
+            for dest_file in self.dest_files:
+                dest_file.join()
+
+        if self._step_runner(6, self._do_source_post_actions) is False:
+            return False
+
+        return True # success
+
+
+    def _wants_file(self, destination):
+        """ Returns False if the destination already has the file - or
+            can't take it yet.
+        """
+        status = destination.auditor.status
+        if self.recovering and status['fn'] == self.fn and bfq_auditor.is_complete(status):
+            # it finished just before the last run stopped:
+            destination.add_delivered(self.fn)
+        if self.fn in destination.delivered_files():
+            logger.info('destination %s already has %s', destination.name, self.fn)
+            return False
+        elif destination.sftp is None:
+            logger.error('destination %s is not connected - will skip %s',
+                         destination.name, self.fn)
+            return False
+        elif status['fn'] != self.fn and not bfq_auditor.is_complete(status):
+            logger.error('destination %s audit is part way through %s - will skip %s',
+                         destination.name, status['fn'], self.fn)
+            return False
+        return True
+
+
+    def _run_dest_steps(self):
+        """ Runs the feed's steps 2-5.
+        """
+        for step in (2, 3, 4, 5):
+            if step == 3:
+                task = self._copy_file
+            else:
+                task = lambda: self._wait_for_dests(step)
+            if self._step_runner(step, task) is False:
+                return False
+        return True
+
+
+    def _copy_file(self):
+        self.stream.run()
+        self.checksum = self.stream.checksum
+        return self._wait_for_dests(3)
+
+
+    def _wait_for_dests(self, step):
+        """ Waits for every destination to finish the step - those that fail
+            it are left to catch up on a later poll.
+        """
+        for dest_file in self.dest_files:
+            name = dest_file.destination.name
+            if not dest_file.wait_for_step(step) and name not in self.failed_dests:
+                logger.error('destination %s failed step %d on %s', name, step, self.fn)
+                self.failed_dests.add(name)
+        return True
+
+
+    def _do_source_post_actions(self):
+        waiting = [x.name for x in self.destinations if self.fn not in x.delivered_files()]
+        if waiting:
+            logger.warning('%s held in the source until destinations have it: %s',
+                           self.fn, ', '.join(waiting))
+            self.held = True
+            return True
+        # forgotten first - should the post actions fail, a file sent twice
+        # beats a later file of the same name being taken as delivered:
+        for destination in self.destinations:
+            destination.forget_delivered(self.fn)
+        return HandleOneFile._do_source_post_actions(self)
+
+
+
+class FanOutDestFile(HandleOneFile):
+    """ Moves a single file to one destination of a fanned-out feed - on its
+        own thread, and through all six steps of the destination's own audit
+        record.  Steps 1 & 6 are no-ops since the source belongs to the feed,
+        and step 3 writes what the feed's ChunkStream reads rather than
+        reading the source itself.  Passing step 6 adds the file to the
+        destination's delivered files.
+    """
+
+    def __init__(self, destination, one_file, stream, metrics=None):
+        HandleOneFile.__init__(self, destination.feed, one_file, destination.auditor,
+                               destination.sftp, metrics)
+        self.destination  = destination
+        self.stream       = stream
+        self.consumer     = stream.add_consumer()
+        self.resuming     = False  # the stream always starts at the beginning
+        self.step_results = {}
+        self.step_cond    = threading.Condition()
+        self.thread       = threading.Thread(target=self._run,
+                                             name='bfq_dest_%s' % destination.name)
+
+    def start(self):
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+    def wait_for_step(self, step):
+        """ Returns True once this destination has passed the step - or False
+            once it's failed it or any before it.
+        """
+        with self.step_cond:
+            while step not in self.step_results:
+                self.step_cond.wait()
+            return self.step_results[step]
+
+    def _set_step_result(self, step, result):
+        with self.step_cond:
+            self.step_results.setdefault(step, result)
+            self.step_cond.notify_all()
+
+
+    def _run(self):
+        try:
+            self.run_all_steps()
+        except Exception:
+            logger.exception('destination %s failed on %s', self.destination.name, self.fn)
+        finally:
+            self.consumer.close()
+            # any step not yet reached has failed:
+            for step in range(1, 7):
+                self._set_step_result(step, False)
+
+
+    def _step_runner(self, step, task):
+        result = HandleOneFile._step_runner(self, step, task)
+        if step == 6 and result:
+            self.destination.add_delivered(self.fn)
+        # a bypassed step (None) was passed by an earlier run:
+        self._set_step_result(step, result is not False)
+        return result
+
+
+    def _copy_file(self):
+        start_time = time.time()
+        byte_cnt   = 0
+        try:
+            with self.sftp.open(self.dest_temp_fqfn, 'wb') as dest_file:
+                dest_file.set_pipelined(self.feed.get('pipelined', True))
+                for data in self.consumer.chunks():
+                    if self.throttle:
+                        self._throttle(len(data))
+                    dest_file.write(data)
+                    byte_cnt += len(data)
+        finally:
+            self.consumer.close()
+        dest_size = self.sftp.stat(self.dest_temp_fqfn).st_size
+        if dest_size != byte_cnt:
+            raise IOError('size mismatch in copy: %d != %d' % (dest_size, byte_cnt))
+        if self.feed.get('dest_post_action') == 'crccheck':
+            self.stream.done.wait()
+            self.checksum = self.stream.checksum
+        log_throughput('%s to %s' % (self.fn, self.destination.name),
+                       byte_cnt, time.time() - start_time)
+        return True
+
+
+    def _do_source_pre_actions(self):
+        return True
+
+
+    def _do_source_post_actions(self):
+        return True
+
+
+
+class ChunkStream(object):
+    """ Reads a source file once, handing each block to every consumer
+        through the consumer's own queue.  The read waits while even the
+        fastest consumer has max_blocks queued - so consumers that are all
+        slow just slow the read.  A consumer that falls more than max_blocks
+        behind the fastest is detached rather than allowed to stall the
+        others - and reads the rest of the file from the source itself.
+        If given a hasher the checksum is computed on the single read.
+    """
+    def __init__(self, source_fqfn, buffer_size=BUFFER_SIZE,
+                 max_blocks=FANOUT_QUEUE_BLOCKS, hasher=None):
+        self.source_fqfn = source_fqfn
+        self.buffer_size = buffer_size
+        self.max_blocks  = max_blocks
+        self.hasher      = hasher
+        self.consumers   = []
+        self.checksum    = None
+        self.byte_cnt    = 0
+        self.done        = threading.Event()
+        self.taken       = threading.Condition()  # notified as consumers take blocks
+
+    def add_consumer(self):
+        consumer = StreamConsumer(self)
+        self.consumers.append(consumer)
+        return consumer
+
+    def run(self):
+        end = STREAM_ABORT
+        try:
+            with open(self.source_fqfn, 'rb') as source_file:
+                while True:
+                    data = source_file.read(self.buffer_size)
+                    if not data:
+                        break
+                    if self.hasher:
+                        self.hasher.update(data)
+                    self.byte_cnt += len(data)
+                    self._wait_for_room()
+                    for consumer in self.consumers:
+                        consumer.offer(data)
+            if self.hasher:
+                self.checksum = self.hasher.hexdigest()
+            end = STREAM_EOF
+        finally:
+            for consumer in self.consumers:
+                consumer.end(end)
+            self.done.set()
+
+    def _wait_for_room(self):
+        """ Waits until the fastest consumer has room for another block -
+            then detaches those too far behind it.
+        """
+        with self.taken:
+            while True:
+                active = [x for x in self.consumers if not x.ended]
+                if not active:
+                    return
+                fastest = min(x.queue.qsize() for x in active)
+                if fastest < self.max_blocks:
+                    break
+                self.taken.wait()
+        for consumer in active:
+            if consumer.queue.qsize() - fastest > self.max_blocks:
+                logger.info('fan-out consumer fell behind - will read the rest of %s itself',
+                            self.source_fqfn)
+                consumer.end(STREAM_DETACHED)
+
+    def _notify_taken(self):
+        with self.taken:
+            self.taken.notify()
+
+    def abort(self):
+        """ Ends any consumer still waiting on a stream that won't run.
+        """
+        for consumer in self.consumers:
+            consumer.end(STREAM_ABORT)
+        self.done.set()
+
+
+
+class StreamConsumer(object):
+    """ One consumer's side of a ChunkStream.  Only the stream's thread puts
+        to the queue - and it never lets the queue grow much beyond twice
+        max_blocks, so it needn't be bounded.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.queue  = Queue.Queue()
+        self.ended  = False   # true once the end marker is queued or it's closed
+
+    def offer(self, data):
+        if not self.ended:
+            self.queue.put(data)
+
+    def end(self, marker):
+        if not self.ended:
+            self.ended = True
+            self.queue.put(marker)
+
+    def close(self):
+        """ Stops the stream from handing over any more blocks.
+        """
+        self.ended = True
+        self.stream._notify_taken()   # the stream may be waiting on this one
+
+    def chunks(self):
+        """ Yields the file's blocks in order.  Raises IOError if the stream
+            failed.
+        """
+        offset = 0
+        while True:
+            data = self.queue.get()
+            self.stream._notify_taken()
+            if data is STREAM_EOF:
+                return
+            elif data is STREAM_ABORT:
+                raise IOError('source stream failed: %s' % self.stream.source_fqfn)
+            elif data is STREAM_DETACHED:
+                with open(self.stream.source_fqfn, 'rb') as source_file:
+                    source_file.seek(offset)
+                    while True:
+                        data = source_file.read(self.stream.buffer_size)
+                        if not data:
+                            return
+                        yield data
+            offset += len(data)
+            yield data
+
+
+
+class ThrottledFile(object):
+    """ Wraps a file - passing the size of everything read from or written
+        to it to consume first.
+    """
+    def __init__(self, fileobj, consume):
+        self.fileobj = fileobj
+        self.consume = consume
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data:
+            self.consume(len(data))
+        return data
+
+    def write(self, data):
+        self.consume(len(data))
+        self.fileobj.write(data)
+
+
+
+class HashingReader(object):
+    """ Wraps a file - adding everything read from it to the hasher.
+    """
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher  = hasher
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+
+
+class HashingWriter(object):
+    """ Wraps a file - adding everything written to it to the hasher.
+    """
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher  = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.fileobj.write(data)
+
+
+
 def task_delete_source_file(source_fqfn):
     try:
         os.remove(source_fqfn)
-    except IOError as e:
+    except (IOError, OSError) as e:
+        # already gone - as when recovering:
         if e.errno == errno.ENOENT:
             return True
         else:
@@ -385,6 +1699,33 @@ def task_move_source_file(old_fqfn, new_fqfn):
 
 
 
+def task_delete_remote_source_file(sftp, source_fqfn):
+    try:
+        sftp.remove(source_fqfn)
+    except IOError as e:
+        # already gone - as when recovering:
+        return e.errno == errno.ENOENT
+    return True
+
+
+
+def task_move_remote_source_file(sftp, old_fqfn, new_fqfn):
+    try:
+        task_replace_dest_files(sftp, [(old_fqfn, new_fqfn)])
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            # already moved - as when recovering:
+            try:
+                sftp.stat(new_fqfn)
+                return True
+            except IOError:
+                pass
+        logger.error('move of remote source file failed: %s' % e)
+        return False
+    return True
+
+
+
 def task_make_dest_symlink(sftp, source_dir, source_fn, dest_dir, dest_fn=None):
     """ Creates a symbolic link
         - note - needs new process for removing old symbolic links.
@@ -394,28 +1735,120 @@ def task_make_dest_symlink(sftp, source_dir, source_fn, dest_dir, dest_fn=None):
 
     source_fqfn  = pjoin(source_dir, source_fn)
     symlink_fqfn = pjoin(dest_dir, dest_fn)
-    try:
-        sftp.remove(symlink_fqfn)
-    except IOError:
-        pass # could be non-existing file which is ok
-    sftp.symlink(source_fqfn, symlink_fqfn)
+    task_make_dest_symlinks(sftp, [(source_fqfn, symlink_fqfn)])
     return True
 
 
+def task_make_dest_symlinks(sftp, symlinks):
+    """ Creates each (source_fqfn, symlink_fqfn) symbolic link - replacing
+        any existing one - with every remove & symlink pipelined into a
+        single round trip.
+        Raises IOError if any symlink fails.
+    """
+    batch = bfq_transport.open_batch(sftp)
+    for (source_fqfn, symlink_fqfn) in symlinks:
+        batch.remove(symlink_fqfn)
+        batch.symlink(source_fqfn, symlink_fqfn)
+    results = batch.wait()
+    for error in results[1::2]:  # failed removes are ok - may not have existed
+        if error:
+            raise error
+
+
 def task_move_dest_file(sftp, dest_dir, dest_fn, dest_post_dir, dest_post_fn):
-    """ Moves destination file
+    """ Moves destination file - replacing any existing dest_post file.
     """
     dest_fqfn      = pjoin(dest_dir, dest_fn)
     dest_post_fqfn = pjoin(dest_post_dir, dest_post_fn)
+    task_replace_dest_files(sftp, [(dest_fqfn, dest_post_fqfn)])
+    return True
+
+
+def task_replace_dest_files(sftp, renames):
+    """ Renames each (old_fqfn, new_fqfn) - replacing any existing new_fqfn
+        - with every request pipelined into a single round trip.
+        Uses the posix-rename extension, which replaces atomically, where
+        the server has it.  Otherwise falls back to a remove & rename.
+        Raises IOError if any rename fails.
+    """
+    if bfq_connection.has_posix_rename(sftp):
+        batch = bfq_transport.open_batch(sftp)
+        for (old_fqfn, new_fqfn) in renames:
+            batch.posix_rename(old_fqfn, new_fqfn)
+        errors = [x for x in batch.wait() if x]
+        if not errors:
+            return
+        if errors[0].errno != errno.ENOSYS:
+            raise errors[0]
+        logger.info('server lacks posix-rename - will remove & rename instead')
+        bfq_connection.set_no_posix_rename(sftp)
+    batch = bfq_transport.open_batch(sftp)
+    for (old_fqfn, new_fqfn) in renames:
+        batch.remove(new_fqfn)
+        batch.rename(old_fqfn, new_fqfn)
+    results = batch.wait()
+    for error in results[1::2]:  # failed removes are ok - may not have existed
+        if error:
+            raise error
+
+
+
+def task_verify_dest_checksum(sftp, dest_fqfn, checksum_type, checksum):
+    """ Confirms that the destination file's checksum matches that of the
+        source.  The remote checksum comes from running <checksum_type>sum
+        on the dest host - or if the server won't run commands, from the
+        sftp check-file extension.
+    """
     try:
-        sftp.rename(dest_fqfn, dest_post_fqfn)
-    except IOError, e:
-        logger.error('task_move_dest_file got IOError - will remove dest_post file and repeat move')
-        sftp.remove(dest_post_fqfn)
-        sftp.rename(dest_fqfn, dest_post_fqfn)
+        remote_checksum = get_remote_checksum_by_cmd(sftp, dest_fqfn, checksum_type)
+    except (paramiko.SSHException, IOError) as e:
+        logger.info('checksum command failed - will try check-file extension: %s' % e)
+        try:
+            with sftp.open(dest_fqfn, 'rb') as dest_file:
+                remote_checksum = binascii.hexlify(dest_file.check(checksum_type))
+        except IOError as e:
+            logger.error('no way to get dest checksum: %s' % e)
+            return False
+    if remote_checksum != checksum:
+        logger.critical('checksum mismatch on %s: source %s != dest %s',
+                        dest_fqfn, checksum, remote_checksum)
+        return False
+    logger.debug('checksum verified on %s: %s', dest_fqfn, checksum)
     return True
 
 
+def write_blocks(dest_file, data):
+    """ Writes data to an sftp file one request's worth at a time.  Given a
+        larger block, paramiko copies whatever is left of it after every
+        request it sends - which adds up to many copies of each byte.
+    """
+    for offset in range(0, len(data), SFTP_REQUEST_SIZE):
+        dest_file.write(bfq_sourcefile.view(data, offset, SFTP_REQUEST_SIZE))
+
+
+
+def get_remote_checksum_by_cmd(sftp, fqfn, checksum_type):
+    if bfq_transport.is_local(sftp):
+        return get_file_checksum(fqfn, checksum_type)
+    transport = sftp.get_channel().get_transport()
+    (status, stdout) = bfq_connection.run_command(transport,
+                           '%ssum %s' % (checksum_type, pipes.quote(fqfn)))
+    if status != 0 or not stdout.strip():
+        raise IOError('%ssum failed with status %d' % (checksum_type, status))
+    return stdout.split()[0].lstrip('\\')
+
+
+def get_file_checksum(fqfn, checksum_type, buffer_size=BUFFER_SIZE):
+    hasher = hashlib.new(checksum_type)
+    with open(fqfn, 'rb') as f:
+        while True:
+            data = f.read(buffer_size)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
 
 def fail_check(step, substep=None):
     """ Inputs:
@@ -466,29 +1899,158 @@ def good_to_run(new_step, old_status):
             return False
 
 
+def log_throughput(fn, byte_cnt, duration):
+    mb_per_sec = (byte_cnt / 1048576.0) / duration if duration > 0 else 0.0
+    logger.info('copied %s: %d bytes in %.3f seconds (%.2f MB/s)',
+                fn, byte_cnt, duration, mb_per_sec)
+
+
 def setup_logging(log_name):
     global logger
     logger = logging.getLogger(log_name + '.buffguts')
 
 
-def sort_files_by_fields(files, *keys):
+def scan_dir(dir_name, fn_pattern):
+    """ Yields the names within dir_name that match the fn_pattern wild-card
+        - lazily, using scandir where it's available, and matching against a
+        single precompiled pattern.
+    """
+    global LISTDIR_LOGGED
+    match = re.compile(fnmatch.translate(fn_pattern)).match
+    if scandir:
+        names = (entry.name for entry in scandir(dir_name))
+    else:
+        if not LISTDIR_LOGGED:
+            logger.warning('scandir is not installed - listing source dirs with os.listdir')
+            LISTDIR_LOGGED = True
+        names = os.listdir(dir_name)
+    for name in names:
+        if match(name):
+            yield name
+
+
+def scan_remote_dir(sftp, dir_name, fn_pattern):
+    """ Yields the names of the regular files within the remote dir_name that
+        match the fn_pattern wild-card - from a single listdir_attr request.
+    """
+    match = re.compile(fnmatch.translate(fn_pattern)).match
+    for attr in sftp.listdir_attr(dir_name):
+        if match(attr.filename) and stat.S_ISREG(attr.st_mode or 0):
+            yield attr.filename
+
+
+def parse_sort_key(sort_key):
+    """ Parses a sort_key into a list of (field, type, descending) terms -
+        with a field of None for the name itself:
+            - name
+            - field:<field> - a string field
+            - field:<field>:<type> - type is one of SORT_TYPES, where ts is
+              a compact iso-8601 timestamp of any precision, ex: 2015,
+              20150102 or 20150102T030405
+            - asc or desc - applies to the prior term
+        ex: 'field:date:ts,field:seq:int,desc' -> [('date', 'ts', False),
+                                                   ('seq', 'int', True)]
+        Raises ValueError if the sort_key is invalid.
+    """
+    terms = []
+    for part in sort_key.split(','):
+        part = part.strip()
+        if part in ('asc', 'desc') and terms:
+            terms[-1] = terms[-1][:2] + (part == 'desc',)
+        elif part == 'name':
+            terms.append((None, 'str', False))
+        elif part.startswith('field:') and len(part.split(':')) in (2, 3):
+            parts = part.split(':')
+            sort_type = parts[2] if len(parts) == 3 else 'str'
+            if not parts[1] or sort_type not in SORT_TYPES:
+                raise ValueError('Invalid sort_key: %s' % sort_key)
+            terms.append((parts[1], sort_type, False))
+        else:
+            raise ValueError('Invalid sort_key: %s' % sort_key)
+    return terms
+
+
+def files_sort_key(terms):
+    """ Returns a function that turns a filename into a sortable tuple for
+        the parsed sort_key terms.  Missing or unconvertable values sort
+        before all others - or after them when descending.
+    """
     def fn_sort(fn):
-        vals = []
-        for key in keys:
-           vals.append(filename_field_get(fn, key))
-        return  tuple(vals)
-    files.sort(key=fn_sort)
+        fields = get_filename_fields(fn)
+        vals   = []
+        for (field, sort_type, descending) in terms:
+            val = convert_field(fn if field is None else fields.get(field), sort_type)
+            val = (0, None) if val is None else (1, val)
+            vals.append(Descending(val) if descending else val)
+        return tuple(vals)
+    return fn_sort
+
+
+def convert_field(val, sort_type):
+    """ Returns the value converted to the sort_type - or None if it's
+        missing or doesn't convert.
+    """
+    if val is None or sort_type == 'str':
+        return val
+    try:
+        if sort_type == 'int':
+            return int(val)
+        elif sort_type == 'float':
+            return float(val)
+        else:
+            digits = val.upper().rstrip('Z').replace('T', '', 1)
+            if len(digits) < 4 or not digits.isdigit():
+                return None
+            # (year, month, day, hour, min, sec) - for as many as were given:
+            return tuple([int(digits[:4])] + [int(digits[i:i+2]) for i in range(4, len(digits), 2)])
+    except ValueError:
+        return None
+
+
+class Descending(object):
+    """ Wraps a sort value to reverse its ordering within a sort key.
+    """
+    __slots__ = ['val']
+    def __init__(self, val):
+        self.val = val
+    def __eq__(self, other):
+        return self.val == other.val
+    def __ne__(self, other):
+        return self.val != other.val
+    def __lt__(self, other):
+        return other.val < self.val
+    def __le__(self, other):
+        return other.val <= self.val
+    def __gt__(self, other):
+        return other.val > self.val
+    def __ge__(self, other):
+        return other.val >= self.val
+
+
+def sort_files_by_fields(files, *keys):
+    files.sort(key=files_sort_key([(key, 'str', False) for key in keys]))
     return files
 
+def get_filename_fields(filename):
+    """ Returns the filename's key-value fields as a dict - ex:
+        'foo_date-2015_seq-9.csv' -> {'date': '2015', 'seq': '9'}.
+        Each filename is parsed only once, then cached - so repeated sorts
+        & lookups across polls of a large backlog don't re-split it.
+    """
+    fields = FIELDS_CACHE.get(filename)
+    if fields is None:
+        fields = {}
+        for kv in basename(filename).split('.')[0].split('_'):
+            kv_parts = kv.split('-')
+            if len(kv_parts) == 2:
+                fields.setdefault(kv_parts[0], kv_parts[1])
+        if len(FIELDS_CACHE) >= FIELDS_CACHE_MAX:
+            FIELDS_CACHE.clear()
+        FIELDS_CACHE[filename] = fields
+    return fields
+
 def filename_field_get(filename, key):
     assert filename is not None
     assert key is not None
-
-    segments = basename(filename).split('.')
-    kv_pairs = segments[0].split('_')
-    for kv in kv_pairs:
-        kv_parts = kv.split('-')
-        if len(kv_parts) == 2:
-            if kv_parts[0] == key:
-                return kv_parts[1]
+    return get_filename_fields(filename).get(key)
 
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+import os
+import errno
+import socket
+import logging
+import weakref
+import threading
+from pprint import pprint as pp
+
+import paramiko
+from paramiko.common import DEFAULT_WINDOW_SIZE, DEFAULT_MAX_PACKET_SIZE
+from paramiko.sftp import (CMD_STATUS, CMD_REMOVE, CMD_RENAME, CMD_SYMLINK,
+                           CMD_EXTENDED, SFTP_OK, SFTP_NO_SUCH_FILE,
+                           SFTP_PERMISSION_DENIED, SFTP_OP_UNSUPPORTED)
+
+logger    = None
+KEY_CACHE = {}   # fully-qualified key file name -> (mtime, parsed key)
+NO_POSIX_RENAME = weakref.WeakKeyDictionary()  # sftp clients whose server lacks it
+
+
+
+class ConnectionManager(object):
+    """ Keeps a single ssh transport & sftp client open across polls rather
+        than reconnecting every time:
+            - keepalives are sent on the transport so idle sessions survive
+              firewalls & nat timeouts
+            - the session is health-checked before it's handed out, and
+              is only (re)connected when it's actually needed
+            - a dead session is closed before being replaced, so long-running
+              movers don't leak connections
+        window_size & max_packet_size default to paramiko's.  Note that
+        the window is what we advertise - so it limits what the far side can
+        send us without waiting on an ack.
+    """
+    def __init__(self, host, port, user, key_filename, keepalive_seconds=30,
+                 window_size=None, max_packet_size=None):
+
+        setup_logging('__main__')
+        self.host              = host
+        self.port              = port
+        self.user              = user
+        self.key_filename      = key_filename
+        self.keepalive_seconds = keepalive_seconds
+        self.window_size       = window_size
+        self.max_packet_size   = max_packet_size
+        self.transport         = None
+        self.sftp              = None
+        self.connect_cnt       = 0
+
+    def get(self):
+        """ Returns (transport, sftp) - reconnecting first if the current
+            session is missing or dead.
+        """
+        if not self.is_alive():
+            if self.transport:
+                logger.warning('ssh session to %s is dead - will reconnect', self.host)
+            self.close()
+            (self.transport, self.sftp) = self._connect()
+        return self.transport, self.sftp
+
+    def is_alive(self):
+        """ Returns True if the session can still be used.  Beyond checking
+            the transport this makes one cheap round-trip over sftp since
+            a half-open tcp connection can otherwise look active.
+        """
+        if self.transport is None or self.sftp is None:
+            return False
+        if not self.transport.is_active():
+            return False
+        try:
+            self.sftp.normalize('.')
+        except (socket.error, EOFError, IOError, paramiko.SSHException):
+            return False
+        return True
+
+    def open_sftp(self):
+        """ Opens an additional sftp channel on the current transport.
+            Unlike get() this doesn't probe the session - since that would
+            use the main sftp client, which mustn't be shared across the
+            worker threads that call this.
+        """
+        return paramiko.SFTPClient.from_transport(self.transport,
+                                                  window_size=self.window_size,
+                                                  max_packet_size=self.max_packet_size)
+
+    def close(self):
+        if self.sftp:
+            try:
+                self.sftp.close()
+            except (socket.error, EOFError, paramiko.SSHException):
+                pass
+        if self.transport:
+            self.transport.close()
+        self.sftp      = None
+        self.transport = None
+
+    def _connect(self):
+        transport = paramiko.Transport((self.host, self.port),
+                                       default_window_size=self.window_size or DEFAULT_WINDOW_SIZE,
+                                       default_max_packet_size=self.max_packet_size or DEFAULT_MAX_PACKET_SIZE)
+        try:
+            transport.connect(username=self.user,
+                              pkey=get_key(self.key_filename))
+            if self.keepalive_seconds:
+                transport.set_keepalive(self.keepalive_seconds)
+            sftp = paramiko.SFTPClient.from_transport(transport,
+                                                      window_size=self.window_size,
+                                                      max_packet_size=self.max_packet_size)
+        except:
+            transport.close()
+            raise
+        self.connect_cnt += 1
+        logger.debug('ssh session to %s established', self.host)
+        return transport, sftp
+
+
+
+class ConnectionPool(object):
+    """ Shares ssh transports among feeds run in the same process - one per
+        host, port, user & key, rather than one per feed.  Each feed still
+        gets its own sftp channel on the transport, so that feeds can run
+        on different threads.  Thread-safe.
+    """
+    def __init__(self):
+        setup_logging('__main__')
+        self.managers = {}   # (host, port, user, key_filename) -> (ConnectionManager, lock)
+        self.lock     = threading.Lock()
+
+    def get_connections(self, host, port, user, key_filename, **kwargs):
+        """ Returns a SharedConnection - which has the interface of a
+            ConnectionManager.  kwargs are passed to the ConnectionManager
+            by the first feed to ask for it.
+        """
+        pool_key = (host, port, user, key_filename)
+        with self.lock:
+            if pool_key not in self.managers:
+                self.managers[pool_key] = (ConnectionManager(host, port, user, key_filename, **kwargs),
+                                           threading.Lock())
+            return SharedConnection(*self.managers[pool_key])
+
+    def transport_cnt(self):
+        return len(self.managers)
+
+    def close(self):
+        with self.lock:
+            for (manager, lock) in self.managers.values():
+                with lock:
+                    manager.close()
+            self.managers = {}
+
+
+
+class SharedConnection(object):
+    """ One feed's use of a pooled ConnectionManager.  get() returns the
+        shared transport along with the feed's own sftp channel on it -
+        reopened whenever the transport has been replaced.  close() closes
+        just that channel.
+    """
+    def __init__(self, manager, lock):
+        self.manager   = manager
+        self.lock      = lock       # guards the manager across feeds
+        self.transport = None
+        self.sftp      = None
+
+    def get(self):
+        with self.lock:
+            (transport, _) = self.manager.get()
+            if self.sftp is None or self.transport is not transport:
+                self.close()
+                self.sftp      = self.manager.open_sftp()
+                self.transport = transport
+        return self.transport, self.sftp
+
+    def open_sftp(self):
+        with self.lock:
+            return self.manager.open_sftp()
+
+    @property
+    def connect_cnt(self):
+        return self.manager.connect_cnt
+
+    def close(self):
+        if self.sftp:
+            try:
+                self.sftp.close()
+            except (socket.error, EOFError, paramiko.SSHException):
+                pass
+        self.sftp      = None
+        self.transport = None
+
+
+
+class SFTPBatch(object):
+    """ Sends a batch of sftp metadata requests (remove, rename, symlink)
+        without waiting on each reply, then collects all the replies at
+        once - so n requests cost one round trip rather than n.  Servers
+        handle requests in the order they're sent, so a remove followed by
+        a rename of the same path is safe within a batch.
+        Uses the same async request plumbing within paramiko's SFTPClient
+        that its pipelined file writes do.  Not thread-safe - like the
+        client itself, a batch belongs to a single thread.
+    """
+    def __init__(self, sftp):
+        self.sftp      = sftp
+        self.requests  = []   # request numbers in the order sent
+        self.responses = {}   # request number -> (type, message)
+
+    def remove(self, path):
+        self._send(CMD_REMOVE, self.sftp._adjust_cwd(path))
+
+    def rename(self, oldpath, newpath):
+        """ Fails if newpath exists - on most servers.
+        """
+        self._send(CMD_RENAME, self.sftp._adjust_cwd(oldpath),
+                   self.sftp._adjust_cwd(newpath))
+
+    def posix_rename(self, oldpath, newpath):
+        """ Atomically replaces any existing newpath - only on servers
+            (like openssh) with the posix-rename extension.
+        """
+        self._send(CMD_EXTENDED, 'posix-rename@openssh.com',
+                   self.sftp._adjust_cwd(oldpath), self.sftp._adjust_cwd(newpath))
+
+    def symlink(self, source, dest):
+        self._send(CMD_SYMLINK, source, self.sftp._adjust_cwd(dest))
+
+    def _send(self, request_type, *args):
+        self.requests.append(self.sftp._async_request(self, request_type, *args))
+
+    def _async_response(self, response_type, msg, num):
+        """ Called by the sftp client as each reply arrives.
+        """
+        self.responses[num] = (response_type, msg)
+
+    def wait(self):
+        """ Waits for every reply, then returns a list with the result of
+            each request in the order sent: None if it succeeded, otherwise
+            an IOError - with errno ENOSYS if the server doesn't support it.
+        """
+        while len(self.responses) < len(self.requests):
+            self.sftp._read_response()
+        results = [status_error(*self.responses[num]) for num in self.requests]
+        self.requests  = []
+        self.responses = {}
+        return results
+
+
+
+def status_error(response_type, msg):
+    """ Returns None for a successful status reply, otherwise an IOError.
+    """
+    if response_type != CMD_STATUS:
+        return IOError('unexpected sftp response type: %d' % response_type)
+    code = msg.get_int()
+    text = msg.get_text()
+    if code == SFTP_OK:
+        return None
+    elif code == SFTP_NO_SUCH_FILE:
+        return IOError(errno.ENOENT, text)
+    elif code == SFTP_PERMISSION_DENIED:
+        return IOError(errno.EACCES, text)
+    elif code == SFTP_OP_UNSUPPORTED:
+        return IOError(errno.ENOSYS, text)
+    else:
+        return IOError(text)
+
+
+
+def has_posix_rename(sftp):
+    """ Returns False once the sftp client's server is known to lack the
+        posix-rename extension.
+    """
+    return sftp not in NO_POSIX_RENAME
+
+
+def set_no_posix_rename(sftp):
+    NO_POSIX_RENAME[sftp] = True
+
+
+
+def run_command(transport, cmd, stdin_writer=None):
+    """ Runs a command on the remote host over its own channel of the
+        transport.  Returns the exit status & stdout.
+        If provided, stdin_writer is called with a file object that streams
+        to the command's stdin - which is closed once it returns.
+        Raises paramiko.SSHException if the server won't run commands -
+        as with sftp-only accounts.
+    """
+    channel = transport.open_session()
+    try:
+        channel.exec_command(cmd)
+        if stdin_writer:
+            stdin = channel.makefile('wb')
+            stdin_writer(stdin)
+            stdin.flush()
+            channel.shutdown_write()
+        stdout = channel.makefile('rb').read()
+        return channel.recv_exit_status(), stdout
+    finally:
+        channel.close()
+
+
+
+def get_key(key_filename):
+    """ Returns the parsed private key - from ~/.ssh unless key_filename
+        is an absolute path - reusing the prior parse unless the key file has
+        changed since then.
+        The private key must not be encrypted (must not have a passphrase).
+    """
+    pkfile = os.path.expanduser(os.path.join('~/.ssh', key_filename))
+    mtime  = os.path.getmtime(pkfile)
+    if pkfile not in KEY_CACHE or KEY_CACHE[pkfile][0] != mtime:
+        KEY_CACHE[pkfile] = (mtime, paramiko.RSAKey.from_private_key_file(pkfile))
+    return KEY_CACHE[pkfile][1]
+
+
+
+def setup_logging(log_name):
+    global logger
+    logger = logging.getLogger(log_name + '.connection')
+
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+""" A control socket for a resident mover - so that a producer that has
+    just written a file can have it moved at once, without waiting for the
+    next poll or starting a process of its own.
+    The socket is a unix-domain stream socket, readable & writable only by
+    the user the mover runs as.  Each connection sends one command line and
+    gets back one line of json, with 'ok' true or false:
+        - status          - the state of each feed
+        - poll [feed]     - polls the feed, or every feed, as soon as a
+                            thread is free - whether or not it's due
+        - pause feed      - keeps the feed from starting another poll
+        - resume feed     - undoes pause
+        - drain           - finishes the moves under way, then exits
+    From the shell:
+        python -m buffalofq.bfq_control /path/to/mover.sock poll my_feed
+"""
+
+import os
+import sys
+import json
+import errno
+import socket
+import logging
+import threading
+from pprint import pprint as pp
+
+logger = None
+
+MAX_COMMAND_SIZE = 4096
+CLIENT_TIMEOUT   = 10       # seconds a connection may take to send its command
+ACCEPT_TIMEOUT   = 1        # seconds between checks for close()
+
+
+
+class ControlServer(object):
+    """ Serves the control socket for a bfq_orchestrator.FeedOrchestrator,
+        on a thread of its own.
+    """
+    def __init__(self, socket_fqfn, orchestrator):
+        setup_logging('__main__')
+        self.socket_fqfn  = socket_fqfn
+        self.orchestrator = orchestrator
+        self.closing      = threading.Event()
+        self.server       = None
+        self.thread       = None
+
+
+    def start(self):
+        """ Creates the socket & starts serving it.  Raises socket.error if
+            another mover is already serving it.
+        """
+        self._remove_stale_socket()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)   # no window in which others could connect
+        try:
+            server.bind(self.socket_fqfn)
+        finally:
+            os.umask(old_umask)
+        server.listen(5)
+        server.settimeout(ACCEPT_TIMEOUT)
+        self.server = server
+        self.thread = threading.Thread(target=self._serve, name='bfq_control')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info('control socket listening at %s', self.socket_fqfn)
+
+
+    def _remove_stale_socket(self):
+        """ Removes a socket left by a mover that died - but not one that's
+            still being served.
+        """
+        if not os.path.exists(self.socket_fqfn):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_fqfn)
+        except socket.error as e:
+            if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+            logger.warning('removing stale control socket: %s', self.socket_fqfn)
+            os.remove(self.socket_fqfn)
+        else:
+            raise socket.error(errno.EADDRINUSE, 'control socket is in use: %s' % self.socket_fqfn)
+        finally:
+            probe.close()
+
+
+    def _serve(self):
+        while not self.closing.is_set():
+            try:
+                (conn, _) = self.server.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                if self.closing.is_set():
+                    break
+                raise
+            try:
+                conn.settimeout(CLIENT_TIMEOUT)
+                # whatever bytes are sent, the reply must still be valid json:
+                reply = self.handle(_read_line(conn).decode('utf-8', 'replace'))
+                conn.sendall(json.dumps(reply) + '\n')
+            except socket.error as e:
+                logger.warning('control connection failed: %s', e)
+            except Exception as e:
+                # one bad connection mustn't stop the socket being served:
+                logger.exception('control command failed: %s', e)
+                try:
+                    conn.sendall(json.dumps({'ok': False, 'error': 'command failed: %r' % e}) + '\n')
+                except socket.error:
+                    pass
+            finally:
+                conn.close()
+
+
+    def handle(self, command):
+        """ Runs one command line - returning the reply.
+        """
+        words = command.split()
+        if not words:
+            return {'ok': False, 'error': 'no command'}
+        (verb, args) = (words[0].lower(), words[1:])
+        logger.info('control command: %s', command.strip())
+        try:
+            if verb == 'status':
+                return {'ok':       True,
+                        'draining': self.orchestrator.stopping.is_set(),
+                        'feeds':    self.orchestrator.status()}
+            elif verb == 'poll' and len(args) <= 1:
+                return {'ok': True, 'feeds': self.orchestrator.poll_now(*args)}
+            elif verb == 'pause' and len(args) == 1:
+                self.orchestrator.pause(args[0])
+                return {'ok': True}
+            elif verb == 'resume' and len(args) == 1:
+                self.orchestrator.resume(args[0])
+                return {'ok': True}
+            elif verb == 'drain' and not args:
+                self.orchestrator.stop()
+                return {'ok': True}
+        except KeyError as e:
+            return {'ok': False, 'error': e.args[0]}
+        return {'ok': False, 'error': 'invalid command: %s' % command.strip()}
+
+
+    def close(self):
+        if self.server is None:
+            return
+        self.closing.set()
+        self.thread.join()
+        self.server.close()
+        self.server = None
+        try:
+            os.remove(self.socket_fqfn)
+        except OSError:
+            pass
+
+
+
+def _read_line(conn):
+    data = ''
+    while '\n' not in data and len(data) < MAX_COMMAND_SIZE:
+        chunk = conn.recv(MAX_COMMAND_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    return data.split('\n')[0]
+
+
+
+def send_command(socket_fqfn, command, timeout=CLIENT_TIMEOUT):
+    """ Sends a command to a mover's control socket - returning its reply.
+        Raises socket.error if the mover isn't listening.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(timeout)
+        client.connect(socket_fqfn)
+        client.sendall(command.strip() + '\n')
+        return json.loads(_read_line(client))
+    finally:
+        client.close()
+
+
+
+def main():
+    if len(sys.argv) < 3:
+        print('usage: %s SOCKET COMMAND [FEED]' % os.path.basename(sys.argv[0]))
+        sys.exit(1)
+    try:
+        reply = send_command(sys.argv[1], ' '.join(sys.argv[2:]))
+    except socket.error as e:
+        print('CRITICAL: mover is not listening at %s: %s' % (sys.argv[1], e))
+        sys.exit(1)
+    print(json.dumps(reply, indent=4, sort_keys=True))
+    sys.exit(0 if reply.get('ok') else 1)
+
+
+
+def setup_logging(log_name):
+    global logger
+    logger = logging.getLogger(log_name + '.control')
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+""" A persistent index of the content of files already delivered to each
+    destination - so that a file re-dropped under a new name, or replayed,
+    needn't be sent again.
+
+    Each entry maps (destination, checksum) to where the delivered file
+    ended up, along with its size & mtime there - which are checked before
+    the file is trusted as a copy, since it may since have been replaced.
+    A path holds one entry at a time: delivering new content over it drops
+    the old content's entry.  Since sizes are indexed too, the mover
+    only has to hash a source file before sending it when some delivered
+    file has the same size - unique files are hashed just once, during the
+    copy.  Retention is bounded by age and by entry count, with the oldest
+    entries evicted first.
+"""
+
+import time
+import sqlite3
+import logging
+import threading
+from pprint import pprint as pp
+
+logger = None
+
+
+
+class DedupIndex(object):
+    """ Thread-safe - a feed's workers share one index.
+    """
+    def __init__(self, fqfn, keep_days=30, max_entries=1000000):
+
+        setup_logging('__main__')
+        self.fqfn        = fqfn
+        self.keep_days   = keep_days
+        self.max_entries = max_entries
+        self.lock        = threading.Lock()
+        self.db          = sqlite3.connect(fqfn, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS delivered '
+                            '(dest TEXT NOT NULL, checksum TEXT NOT NULL, size INTEGER NOT NULL, '
+                            ' fqfn TEXT NOT NULL, time REAL NOT NULL, mtime REAL, '
+                            ' PRIMARY KEY (dest, checksum))')
+            columns = [x[1] for x in self.db.execute('PRAGMA table_info(delivered)')]
+            if 'mtime' not in columns:   # an index from before mtimes were kept
+                self.db.execute('ALTER TABLE delivered ADD COLUMN mtime REAL')
+            self.db.execute('CREATE INDEX IF NOT EXISTS delivered_size ON delivered (dest, size)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS delivered_fqfn ON delivered (dest, fqfn)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS delivered_time ON delivered (time)')
+        self.evict()
+
+    def has_size(self, dest, size):
+        """ The fast pre-check: False means no delivered file could match.
+        """
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM delivered WHERE dest = ? AND size = ? LIMIT 1',
+                                   (dest, size)).fetchone() is not None
+
+    def find(self, dest, checksum):
+        """ Returns (fqfn, size, mtime) of where a file with this checksum
+            was delivered - or None.  The mtime is None for entries added
+            before mtimes were kept.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT fqfn, size, mtime FROM delivered '
+                                  'WHERE dest = ? AND checksum = ?',
+                                  (dest, checksum)).fetchone()
+        return tuple(row) if row else None
+
+    def add(self, dest, checksum, size, fqfn, mtime):
+        """ Records a delivery - replacing any entry for other content
+            formerly delivered to the same fqfn.
+        """
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM delivered WHERE dest = ? AND fqfn = ?',
+                                (dest, fqfn))
+                self.db.execute('INSERT OR REPLACE INTO delivered (dest, checksum, size, fqfn, time, mtime) '
+                                'VALUES (?, ?, ?, ?, ?, ?)',
+                                (dest, checksum, size, fqfn, time.time(), mtime))
+
+    def remove(self, dest, checksum):
+        """ Drops an entry whose delivered file has gone.
+        """
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM delivered WHERE dest = ? AND checksum = ?',
+                                (dest, checksum))
+
+    def evict(self):
+        """ Drops entries older than keep_days, then the oldest beyond
+            max_entries.
+        """
+        with self.lock:
+            with self.db:
+                if self.keep_days:
+                    self.db.execute('DELETE FROM delivered WHERE time < ?',
+                                    (time.time() - self.keep_days * 86400,))
+                if self.max_entries:
+                    self.db.execute('DELETE FROM delivered WHERE time <= '
+                                    '(SELECT time FROM delivered ORDER BY time DESC LIMIT 1 OFFSET ?)',
+                                    (self.max_entries,))
+
+    def close(self):
+        if self.db is not None:
+            self.evict()
+            self.db.close()
+            self.db = None
+
+
+
+def setup_logging(log_name):
+    global logger
+    logger = logging.getLogger(log_name + '.dedup')
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+""" Delta transfer - rsync's algorithm over sftp, for feeds that resend a
+    growing or slightly changed version of the same file every poll:
+        - as a file is sent its block signatures (adler32 & md5 of each
+          block) are computed from the data read for the copy, and once
+          it's delivered they're cached locally, by destination & file name
+        - the next version is matched against them with a rolling adler32,
+          which finds blocks even where data was inserted or removed
+        - the dest host rebuilds the file from its prior version with a dd
+          per run of matched blocks (so it must allow commands & have gnu
+          dd), and only the unmatched bytes are sent - over sftp.
+    The caller verifies the result with the dest's checksum, since the
+    prior version could have been changed behind our back.
+"""
+
+import os
+import json
+import zlib
+import mmap
+import pipes
+import hashlib
+import logging
+import tempfile
+from os.path import join as pjoin
+from pprint import pprint as pp
+
+import bfq_connection
+
+logger = None
+
+ADLER_MOD        = 65521
+SEARCH_BYTES     = 4096     # bytes rolled through looking for a match before giving up on a block
+MAX_BLOCKS       = 200000   # blocks per signature - larger files get larger blocks
+MAX_RUNS         = 10000    # matched runs beyond which a full copy is simpler
+COPY_BUFFER_SIZE = 1048576
+
+
+
+class DeltaCache(object):
+    """ Keeps the signature of the version last delivered to each
+        destination file - one small json file apiece.
+    """
+    def __init__(self, dir_name):
+        setup_logging('__main__')
+        self.dir_name = dir_name
+        if not os.path.isdir(dir_name):
+            os.mkdir(dir_name)
+
+    def get(self, dest, dest_fqfn):
+        try:
+            with open(self._fqfn(dest, dest_fqfn)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, dest, dest_fqfn, signature):
+        """ Replaces the signature atomically - a torn one would otherwise
+            send a bad delta.
+        """
+        (fd, temp_fqfn) = tempfile.mkstemp(dir=self.dir_name, prefix='.sig_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(signature, f, separators=(',', ':'))
+        os.rename(temp_fqfn, self._fqfn(dest, dest_fqfn))
+
+    def _fqfn(self, dest, dest_fqfn):
+        return pjoin(self.dir_name, '%s.json' % hashlib.md5('%s\0%s' % (dest, dest_fqfn)).hexdigest())
+
+
+
+def file_signature(fqfn, min_block_size=65536):
+    """ Returns the signature of a file: its size, block size, and the
+        adler32 & md5 of each full block.  A final partial block is left
+        out, since it's just sent as data.
+    """
+    builder = SignatureBuilder(os.path.getsize(fqfn), min_block_size)
+    with open(fqfn, 'rb') as f:
+        while True:
+            data = f.read(COPY_BUFFER_SIZE)
+            if not data:
+                break
+            builder.update(data)
+    return builder.signature()
+
+
+
+class SignatureBuilder(object):
+    """ Builds a file's signature from its data as it's read, in blocks of
+        any size - so that a copy, which reads the file anyway, needn't
+        read it again for the signature.
+    """
+    def __init__(self, size, min_block_size=65536):
+        self.size       = size
+        self.block_size = max(min_block_size, -(-size // MAX_BLOCKS))
+        self.blocks     = []
+        self.partial    = b''    # the start of a block split across updates
+        self.byte_cnt   = 0
+
+    def update(self, data):
+        self.byte_cnt += len(data)
+        offset = 0
+        if self.partial:
+            offset        = self.block_size - len(self.partial)
+            self.partial += bytes(data[:offset])
+            if len(self.partial) < self.block_size:
+                return
+            self._add(self.partial)
+            self.partial = b''
+        while offset + self.block_size <= len(data):
+            self._add(data[offset:offset + self.block_size])
+            offset += self.block_size
+        self.partial = bytes(data[offset:])
+
+    def _add(self, block):
+        self.blocks.append([weak_checksum(block), hashlib.md5(block).hexdigest()])
+
+    def signature(self):
+        """ Returns the signature - or None if the data seen wasn't the size
+            the file was to be, as when it changed while being read.
+        """
+        if self.byte_cnt != self.size:
+            return None
+        return {'size': self.size, 'block_size': self.block_size, 'blocks': self.blocks}
+
+
+def weak_checksum(block):
+    return zlib.adler32(block) & 0xffffffff
+
+
+
+def compute_delta(fqfn, signature, checksum_type, builder=None):
+    """ Matches the file against the signature of its prior version.
+        Returns (ops, checksum) - where ops covers the file in order with
+        ('copy', old_offset, new_offset, length) for runs of matched blocks
+        and ('data', new_offset, length) for everything else, and checksum
+        is that of the whole file.  A SignatureBuilder, if given, is fed the
+        file on the same pass as the checksum.
+        Where a block doesn't match, a rolling adler32 looks for one over
+        the next SEARCH_BYTES offsets - beyond that the block is sent as
+        data, which keeps new data from being rolled through a byte at a
+        time.
+    """
+    block_size = signature['block_size']
+    index      = {}
+    for (i, (weak, strong)) in enumerate(signature['blocks']):
+        index.setdefault(weak, []).append((i, strong))
+    hasher     = hashlib.new(checksum_type)
+    ops        = []
+    size       = os.path.getsize(fqfn)
+    if not size:
+        return ops, hasher.hexdigest()
+
+    def match(block, weak, expected):
+        # the block following the last match is preferred, so runs coalesce:
+        found = None
+        if weak in index:
+            strong = hashlib.md5(block).hexdigest()
+            for (i, candidate) in index[weak]:
+                if candidate == strong:
+                    if i == expected:
+                        return i
+                    if found is None:
+                        found = i
+        return found
+
+    def add_data(start, end):
+        if end > start:
+            ops.append(('data', start, end - start))
+
+    def add_copy(old_offset, new_offset):
+        if ops and ops[-1][0] == 'copy' and ops[-1][1] + ops[-1][3] == old_offset \
+               and ops[-1][2] + ops[-1][3] == new_offset:
+            ops[-1] = ('copy', ops[-1][1], ops[-1][2], ops[-1][3] + block_size)
+        else:
+            ops.append(('copy', old_offset, new_offset, block_size))
+
+    with open(fqfn, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in range(0, size, COPY_BUFFER_SIZE):
+                data = mm[offset:offset + COPY_BUFFER_SIZE]
+                hasher.update(data)
+                if builder:
+                    builder.update(data)
+            pos        = 0
+            data_start = 0
+            expected   = 0
+            while pos + block_size <= size:
+                weak = weak_checksum(mm[pos:pos + block_size])
+                idx  = match(mm[pos:pos + block_size], weak, expected)
+                if idx is None:
+                    (a, b) = (weak & 0xffff, weak >> 16)
+                    limit  = min(pos + min(SEARCH_BYTES, block_size), size - block_size)
+                    search = pos
+                    while search < limit:
+                        out_byte = ord(mm[search])
+                        in_byte  = ord(mm[search + block_size])
+                        a = (a - out_byte + in_byte) % ADLER_MOD
+                        b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                        search += 1
+                        if ((b << 16) | a) in index:
+                            idx = match(mm[search:search + block_size], (b << 16) | a, expected)
+                            if idx is not None:
+                                pos = search
+                                break
+                    if idx is None:
+                        pos += block_size
+                        continue
+                add_data(data_start, pos)
+                add_copy(idx * block_size, pos)
+                pos        += block_size
+                data_start  = pos
+                expected    = idx + 1
+            add_data(data_start, size)
+        finally:
+            mm.close()
+    return ops, hasher.hexdigest()
+
+
+
+def apply_delta(sftp, old_fqfn, temp_fqfn, source_fqfn, ops, pipelined=True, consume=None):
+    """ Builds temp_fqfn on the dest host: the matched runs are copied from
+        old_fqfn there by a single shell script of dd commands, then the
+        rest is written from the source over sftp.  consume, if given, is
+        called with the size of each block sent.
+        Returns the number of bytes sent.  Raises IOError if the copies
+        fail.
+    """
+    script = [': > %s' % pipes.quote(temp_fqfn)]
+    for op in ops:
+        if op[0] == 'copy':
+            script.append('dd if=%s of=%s bs=%d iflag=skip_bytes,count_bytes oflag=seek_bytes '
+                          'conv=notrunc skip=%d seek=%d count=%d 2>/dev/null'
+                          % (pipes.quote(old_fqfn), pipes.quote(temp_fqfn), COPY_BUFFER_SIZE,
+                             op[1], op[2], op[3]))
+    transport   = sftp.get_channel().get_transport()
+    (status, _) = bfq_connection.run_command(transport, 'sh -e',
+                      stdin_writer=lambda stdin: stdin.write('\n'.join(script) + '\n'))
+    if status != 0:
+        raise IOError('delta copy commands failed with status %d' % status)
+
+    byte_cnt = 0
+    with open(source_fqfn, 'rb') as source_file:
+        with sftp.open(temp_fqfn, 'r+b') as dest_file:
+            dest_file.set_pipelined(pipelined)
+            for op in ops:
+                if op[0] != 'data':
+                    continue
+                source_file.seek(op[1])
+                dest_file.seek(op[1])
+                remaining = op[2]
+                while remaining:
+                    data = source_file.read(min(COPY_BUFFER_SIZE, remaining))
+                    if not data:
+                        raise IOError('source file shrank during delta: %s' % source_fqfn)
+                    if consume:
+                        consume(len(data))
+                    dest_file.write(data)
+                    remaining -= len(data)
+                    byte_cnt  += len(data)
+    return byte_cnt
+
+
+def copy_runs(ops):
+    return len([op for op in ops if op[0] == 'copy'])
+
+
+
+def setup_logging(log_name):
+    global logger
+    logger = logging.getLogger(log_name + '.delta')
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import os
+import math
+import time
+import json
+import bisect
+import logging
+import tempfile
+import threading
+from pprint import pprint as pp
+
+logger = None
+
+QUANTILES     = [0.5, 0.95, 0.99]
+BUCKET_GROWTH = 2 ** 0.25   # each bucket bound is ~19% above the prior one
+BUCKET_MIN    = 0.00001     # seconds
+BUCKET_MAX    = 100000      # seconds
+METRICS_FILE_MODE = 0o644   # readable by collectors such as node_exporter's
+STEP_NAMES    = {1: 'source_pre', 2: 'dest_pre', 3: 'copy',
+                 4: 'rename', 5: 'dest_post', 6: 'source_post'}
+
+
+
+class Histogram(object):
+    """ Counts observations into fixed log-scaled buckets - so memory stays
+        constant no matter how long the mover runs, while quantiles can
+        still be estimated to within a bucket's width.
+    """
+    bounds = [BUCKET_MIN * BUCKET_GROWTH ** x
+              for x in range(int(math.log(BUCKET_MAX / BUCKET_MIN, BUCKET_GROWTH)) + 1)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)   # last one is overflow
+        self.count  = 0
+        self.sum    = 0.0
+        self.max    = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum   += value
+        self.max    = max(self.max, value)
+
+    def quantile(self, q):
+        """ Returns the estimated value at quantile q (0-1) - interpolating
+            within the bucket it falls in.
+        """
+        if not self.count:
+            return None
+        rank     = q * self.count
+        cum_cnt  = 0
+        for (i, cnt) in enumerate(self.counts):
+            if cnt and cum_cnt + cnt >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                est   = lower + (upper - lower) * (rank - cum_cnt) / cnt
+                return min(est, self.max)
+            cum_cnt += cnt
+        return self.max
+
+    def summary(self):
+        results = {'count': self.count,
+                   'sum':   round(self.sum, 6),
+                   'max':   round(self.max, 6)}
+        for q in QUANTILES:
+            value = self.quantile(q)
+            results['p%d' % (q * 100)] = None if value is None else round(value, 6)
+        return results
+
+
+
+class FeedMetrics(object):
+    """ Collects timing histograms for a feed - one per operation (each of
+        the six steps, the audit writes, the source scan & the connection
+        setup) - and, if given a metrics_file, rewrites it every
+        write_seconds as either a prometheus textfile (for node_exporter's
+        textfile collector) or json.
+        Thread-safe, since workers observe their steps concurrently.
+    """
+    def __init__(self, feed_name, metrics_file=None, metrics_format='prometheus',
+                 write_seconds=60):
+
+        setup_logging('__main__')
+        assert metrics_format in ('prometheus', 'json')
+        self.feed_name       = feed_name
+        self.metrics_file    = metrics_file
+        self.metrics_format  = metrics_format
+        self.write_seconds   = write_seconds
+        self.histograms      = {}
+        self.lock            = threading.Lock()
+        self.last_write_time = time.time()
+
+    def observe(self, operation, seconds):
+        with self.lock:
+            if operation not in self.histograms:
+                self.histograms[operation] = Histogram()
+            self.histograms[operation].observe(seconds)
+            if (self.metrics_file
+                    and time.time() - self.last_write_time >= self.write_seconds):
+                self._write()
+
+    def timer(self, operation):
+        return OperationTimer(self, operation)
+
+    def summary(self):
+        with self.lock:
+            return dict((op, hist.summary()) for (op, hist) in self.histograms.items())
+
+    def write(self):
+        """ Rewrites the metrics_file now - a no-op without one.
+        """
+        if self.metrics_file:
+            with self.lock:
+                self._write()
+
+    def _write(self):
+        """ Replaces the file atomically so a collector never reads a partial
+            one.  A failure is logged rather than raised - metrics mustn't
+            stop files from moving.
+        """
+        self.last_write_time = time.time()
+        if self.metrics_format == 'json':
+            body = json.dumps({'feed': self.feed_name,
+                               'time': self.last_write_time,
+                               'operations': dict((op, hist.summary())
+                                                  for (op, hist) in self.histograms.items())},
+                              indent=2, sort_keys=True)
+        else:
+            body = self._format_prometheus()
+        try:
+            (fd, temp_fqfn) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.metrics_file)),
+                                               prefix='.bfq_metrics_')
+            # mkstemp's 0600 would keep a collector running as another user out:
+            os.fchmod(fd, METRICS_FILE_MODE)
+            with os.fdopen(fd, 'w') as f:
+                f.write(body)
+            os.rename(temp_fqfn, self.metrics_file)
+        except (IOError, OSError) as e:
+            logger.error('metrics file could not be written: %s', e)
+
+    def _format_prometheus(self):
+        name  = 'buffalofq_operation_seconds'
+        lines = ['# HELP %s Time spent per operation by the mover.' % name,
+                 '# TYPE %s summary' % name]
+        for op in sorted(self.histograms):
+            hist   = self.histograms[op]
+            labels = 'feed="%s",operation="%s"' % (_escape(self.feed_name), _escape(op))
+            for q in QUANTILES:
+                value = hist.quantile(q)
+                lines.append('%s{%s,quantile="%s"} %s' % (name, labels, q,
+                                                          'NaN' if value is None else repr(value)))
+            lines.append('%s_sum{%s} %r' % (name, labels, hist.sum))
+            lines.append('%s_count{%s} %d' % (name, labels, hist.count))
+        return '\n'.join(lines) + '\n'
+
+
+
+class OperationTimer(object):
+    """ Context manager that observes how long its block took - whether or
+        not it raised.
+    """
+    def __init__(self, metrics, operation):
+        self.metrics    = metrics
+        self.operation  = operation
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.operation, time.time() - self.start_time)
+
+
+
+def step_operation(step):
+    return 'step_%d_%s' % (step, STEP_NAMES[step])
+
+
+def _escape(label_value):
+    return label_value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+
+def setup_logging(log_name):
+    global logger
+    logger = logging.getLogger(log_name + '.metrics')
+
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+""" Runs many feeds in a single process - rather than a mover process per
+    feed, each with its own imports, keys & ssh connections:
+        - one scheduler runs each feed whenever it's next due to be polled,
+          on a small pool of threads - so a feed busy with a large file
+          doesn't hold up the others
+        - feeds are isolated from one another: a feed that fails is logged
+          and tried again after its polling interval while the rest carry
+          on, and each keeps its own audit, metrics & throttle
+        - feeds that connect to the same host, port & user as the same key
+          share one ssh transport - see bfq_connection.ConnectionPool.
+    source_watcher isn't used here - feeds are polled.  A resident
+    orchestrator can be steered while it runs - see bfq_control.
+"""
+
+import time
+import Queue
+import logging
+import threading
+from pprint import pprint as pp
+
+#--- our modules -------------------
+import bfq_buffguts
+import bfq_connection
+
+logger = None
+
+MAX_WAIT_SECONDS = 60   # longest the scheduler sleeps between checks for due feeds
+
+
+
+class FeedRunner(object):
+    """ One feed's scheduling state.
+    """
+    def __init__(self, name, handler, run_forever):
+        self.name        = name
+        self.handler     = handler   # HandleOneFeed
+        self.run_forever = run_forever
+        self.next_time   = 0         # due at once
+        self.busy        = False
+        self.done        = False
+        self.paused      = False
+        self.poll_now    = False     # run at once, whether or not it's due
+        self.run_cnt     = 0
+        self.error_cnt   = 0
+
+    def is_due(self, now):
+        return (not self.busy and not self.done and not self.paused
+                and (self.poll_now or self.next_time <= now))
+
+    def run_once(self, force, suppcheck):
+        """ Runs one pass of the feed - never raising, so that a feed can't
+            take down the others.
+        """
+        force         = (force and not self.run_cnt) or self.poll_now
+        self.poll_now = False
+        try:
+            if suppcheck and suppcheck.suppressed(self.handler.feed):
+                logger.warning('feed %s has been suppressed - will stop running it', self.name)
+                self.done = True
+                return
+            self.handler.run_once(force)
+            self.next_time = self.handler.next_poll_time()
+        except Exception:
+            logger.exception('feed %s failed - will retry after its polling interval', self.name)
+            self.error_cnt += 1
+            self.next_time  = time.time() + self.handler.poll_interval.seconds
+        finally:
+            self.run_cnt += 1
+        if not self.run_forever:
+            self.done = True
+
+
+
+class FeedOrchestrator(object):
+    """ Schedules a set of feeds onto max_threads threads.
+        feed_configs is a list of dicts with the HandleOneFeed arguments of
+        each feed: feed, audit_dir, config_name & key_filename.  A feed that
+        can't be set up is logged & left out.
+        Each feed's own limit_total is as for a single feed: -1 runs it
+        until stopped, while 0 or more runs it once.  limit_total, if
+        given, overrides every feed's own - as a daemon's -1 does.
+    """
+    def __init__(self, feed_configs, limit_total=None, force=False, max_threads=4, suppcheck=None):
+        setup_logging('__main__')
+        self.force       = force
+        self.max_threads = max(1, max_threads)
+        self.suppcheck   = suppcheck
+        self.pool        = bfq_connection.ConnectionPool()
+        self.due_queue   = Queue.Queue()
+        self.wakeup      = threading.Event()
+        self.stopping    = threading.Event()
+        self.runners     = []
+        for feed_config in feed_configs:
+            name = feed_config['feed']['name']
+            if limit_total is None:
+                feed_limit = feed_config['feed'].get('limit_total') or 0
+            else:
+                feed_limit = limit_total
+            try:
+                handler = bfq_buffguts.HandleOneFeed(feed_config['feed'],
+                                                     feed_config['audit_dir'],
+                                                     limit_total=feed_limit,
+                                                     config_name=feed_config['config_name'],
+                                                     key_filename=feed_config['key_filename'],
+                                                     connection_pool=self.pool)
+            except Exception:
+                logger.exception('feed %s could not be set up - will not run it', name)
+                continue
+            self.runners.append(FeedRunner(name, handler, feed_limit == -1))
+        logger.info('orchestrating %d feeds on %d threads', len(self.runners), self.max_threads)
+
+
+    def run(self):
+        """ Runs the feeds until they're done or stop() is called - then
+            closes them.
+        """
+        workers = []
+        for i in range(min(self.max_threads, len(self.runners))):
+            worker = threading.Thread(target=self._worker, name='bfq_feed_%d' % i)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        try:
+            while not self.stopping.is_set():
+                self.wakeup.clear()
+                now = time.time()
+                if all(x.done for x in self.runners):
+                    break
+                for runner in self.runners:
+                    if runner.is_due(now):
+                        runner.busy = True
+                        self.due_queue.put(runner)
+                waiting = [x.next_time for x in self.runners
+                           if not x.busy and not x.done and not x.paused]
+                timeout = min(waiting + [now + MAX_WAIT_SECONDS]) - now
+                # wakes early when a feed finishes its run:
+                self.wakeup.wait(max(timeout, 0.01))
+        finally:
+            self.stopping.set()
+            for worker in workers:
+                self.due_queue.put(None)
+            for worker in workers:
+                worker.join()
+            self.close()
+
+
+    def _worker(self):
+        while True:
+            runner = self.due_queue.get()
+            if runner is None:
+                break
+            if not self.stopping.is_set():
+                runner.run_once(self.force, self.suppcheck)
+            runner.busy = False
+            self.wakeup.set()
+
+
+    def stop(self):
+        """ Asks run() to return once the feeds now running finish their pass.
+        """
+        self.stopping.set()
+        self.wakeup.set()
+
+
+    def poll_now(self, name=None):
+        """ Has the feed - or every feed - poll as soon as a thread is free,
+            whether or not it's due, and move whatever it finds.  Returns
+            the names of the feeds.  Raises KeyError for an unknown feed.
+        """
+        runners = [self._get_runner(name)] if name else self.runners
+        for runner in runners:
+            runner.poll_now = True
+        self.wakeup.set()
+        return [x.name for x in runners]
+
+
+    def pause(self, name):
+        """ Keeps the feed from starting another pass - one under way
+            finishes.
+        """
+        self._get_runner(name).paused = True
+
+
+    def resume(self, name):
+        self._get_runner(name).paused = False
+        self.wakeup.set()
+
+
+    def _get_runner(self, name):
+        for runner in self.runners:
+            if runner.name == name:
+                return runner
+        raise KeyError('no such feed: %s' % name)
+
+
+    def status(self):
+        """ Returns {feed name: state} - for the control socket.
+        """
+        now    = time.time()
+        status = {}
+        for runner in self.runners:
+            if runner.done:
+                state = 'done'
+            elif runner.busy:
+                state = 'running'
+            elif runner.paused:
+                state = 'paused'
+            else:
+                state = 'waiting'
+            status[runner.name] = {'state':        state,
+                                   'next_poll_in': round(max(runner.next_time - now, 0), 3),
+                                   'runs':         runner.run_cnt,
+                                   'errors':       runner.error_cnt,
+                                   'files':        runner.handler.file_cnt}
+        return status
+
+
+    def close(self):
+        for runner in self.runners:
+            try:
+                runner.handler.close()
+            except Exception:
+                logger.exception('feed %s did not close cleanly', runner.name)
+        self.pool.close()
+
+
+    def summary(self):
+        """ Returns {feed name: {runs, errors, files}} - for logging.
+        """
+        return dict((x.name, {'runs':   x.run_cnt,
+                              'errors': x.error_cnt,
+                              'files':  x.handler.file_cnt}) for x in self.runners)
+
+
+
+def setup_logging(log_name):
+    global logger
+    logger = logging.getLogger(log_name + '.orchestrator')
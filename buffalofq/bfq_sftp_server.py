@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+""" A small sftp server that runs in-process over loopback - a stand-in for
+    a real ssh host so that the mover can be benchmarked without outside
+    services.  It serves the local filesystem as the user running it, only
+    accepts the one public key it was given, and runs exec requests (used by
+    bundles & crccheck) through the local shell.
+
+    Not meant for anything but local benchmarking & testing.
+"""
+
+import os
+import errno
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+from pprint import pprint as pp
+
+import paramiko
+from paramiko import SFTPServer, SFTPAttributes, SFTPHandle, SFTP_OK
+from paramiko.sftp import CMD_EXTENDED
+
+logger = None
+
+
+
+class LoopbackSFTPServer(object):
+    """ Listens on 127.0.0.1 (an ephemeral port by default) and serves each
+        connection on its own thread until close() is called.
+    """
+    def __init__(self, client_key, port=0):
+
+        setup_logging('__main__')
+        self.client_key = client_key
+        self.host_key   = paramiko.RSAKey.generate(2048)
+        self.sock       = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(100)
+        self.port       = self.sock.getsockname()[1]
+        self.transports = []
+        self.closed     = False
+        self.thread     = threading.Thread(target=self._accept_loop, name='bfq_sftp_server')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _accept_loop(self):
+        while not self.closed:
+            try:
+                (conn, _) = self.sock.accept()
+            except socket.error:
+                break
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', PosixRenameSFTPServer, LocalSFTPInterface)
+            try:
+                transport.start_server(server=SSHInterface(self.client_key))
+            except (paramiko.SSHException, EOFError, socket.error) as e:
+                logger.warning('loopback sftp server negotiation failed: %s', e)
+                transport.close()
+                continue
+            self.transports.append(transport)
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+
+
+class SSHInterface(paramiko.ServerInterface):
+
+    def __init__(self, client_key):
+        self.client_key = client_key
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if key == self.client_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=run_exec, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+
+def run_exec(channel, command):
+    """ Runs the command through the shell - streaming the channel into its
+        stdin, and returning its output & exit status once it finishes.
+    """
+    stderr = tempfile.TemporaryFile()  # so a chatty stderr can't block stdout
+    proc   = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, stderr=stderr)
+
+    def feed_stdin():
+        try:
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                proc.stdin.write(data)
+        except (IOError, socket.error):
+            pass  # command quit without reading all of its input
+        finally:
+            proc.stdin.close()
+
+    stdin_thread = threading.Thread(target=feed_stdin)
+    stdin_thread.daemon = True
+    stdin_thread.start()
+    stdout = proc.stdout.read()
+    status = proc.wait()
+    stderr.seek(0)
+    channel.sendall(stdout)
+    channel.sendall_stderr(stderr.read())
+    stderr.close()
+    channel.send_exit_status(status)
+    channel.close()
+
+
+
+class PosixRenameSFTPServer(SFTPServer):
+    """ Adds openssh's posix-rename extension - which paramiko's server
+        lacks.
+    """
+    def _process(self, t, request_number, msg):
+        if t == CMD_EXTENDED:
+            if msg.get_text() == 'posix-rename@openssh.com':
+                oldpath = msg.get_text()
+                newpath = msg.get_text()
+                self._send_status(request_number, self.server.posix_rename(oldpath, newpath))
+                return
+            msg.rewind()
+            msg.get_int()   # the request number
+        SFTPServer._process(self, t, request_number, msg)
+
+
+
+class LocalSFTPHandle(SFTPHandle):
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+
+class LocalSFTPInterface(paramiko.SFTPServerInterface):
+    """ Serves the local filesystem - paths are used as-is.
+    """
+
+    def list_folder(self, path):
+        try:
+            results = []
+            for fn in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, fn)))
+                attr.filename = fn
+                results.append(attr)
+            return results
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = LocalSFTPHandle(flags)
+        handle.filename  = path
+        handle.readfile  = os.fdopen(fd, mode)
+        handle.writefile = handle.readfile
+        return handle
+
+    def remove(self, path):
+        return _call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        # sftp's rename must not overwrite:
+        if os.path.lexists(newpath):
+            return SFTPServer.convert_errno(errno.EEXIST)
+        return _call(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        return _call(os.rename, oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        return _call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return _call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+        return SFTP_OK
+
+    def symlink(self, target_path, path):
+        return _call(os.symlink, target_path, path)
+
+    def readlink(self, path):
+        try:
+            return os.readlink(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def canonicalize(self, path):
+        return os.path.abspath(path or '/')
+
+
+
+def _call(func, *args):
+    try:
+        func(*args)
+    except OSError as e:
+        return SFTPServer.convert_errno(e.errno)
+    return SFTP_OK
+
+
+
+def setup_logging(log_name):
+    global logger
+    logger = logging.getLogger(log_name + '.sftp_server')
+
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+""" Reads source files for upload in large blocks, without the copies and
+    page cache churn of ordinary file reads:
+        - each block is read straight into one reused buffer & handed out as
+          a view of it, rather than as a new string per block
+        - the kernel is told the file is read sequentially, so it reads
+          ahead aggressively
+        - once blocks have been read their pages are dropped from the page
+          cache - so moving a large file doesn't push out the cache of
+          whatever else runs on the host.
+    posix_fadvise is used where the platform has it (os.posix_fadvise, else
+    libc through ctypes) - elsewhere the advice is simply skipped.
+    Files aren't memory-mapped, since the kernel won't drop the pages of a
+    file while they're mapped.
+"""
+
+import os
+import io
+import logging
+from pprint import pprint as pp
+
+logger = None
+
+BLOCK_SIZE       = 1048576
+DROP_BEHIND_SIZE = 8388608   # bytes read between drops of the pages behind
+try:
+    POSIX_FADV_SEQUENTIAL = os.POSIX_FADV_SEQUENTIAL   # python 3.3+
+    POSIX_FADV_DONTNEED   = os.POSIX_FADV_DONTNEED
+except AttributeError:
+    POSIX_FADV_SEQUENTIAL = 2    # linux values
+    POSIX_FADV_DONTNEED   = 4
+
+try:
+    view = buffer                # python 2 - paramiko accepts buffers
+except NameError:
+    view = lambda obj, offset, size: memoryview(obj)[offset:offset + size]
+
+
+
+def _load_fadvise():
+    """ Returns posix_fadvise(fd, offset, length, advice) - or None if the
+        platform doesn't have it.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise
+    try:
+        import ctypes
+        libc     = ctypes.CDLL(None, use_errno=True)
+        function = getattr(libc, 'posix_fadvise64', None) or libc.posix_fadvise
+    except (ImportError, OSError, AttributeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+    function.restype  = ctypes.c_int
+    def posix_fadvise(fd, offset, length, advice):
+        result = function(fd, offset, length, advice)
+        if result:
+            raise OSError(result, os.strerror(result))
+    return posix_fadvise
+
+_posix_fadvise = _load_fadvise()
+
+
+
+def fadvise(fd, offset, length, advice):
+    """ Gives the kernel advice about a file's pages - see posix_fadvise(2).
+        A length of 0 means through the end of the file.  Returns False if
+        the advice couldn't be given, which is never worth failing over.
+    """
+    if _posix_fadvise is None:
+        return False
+    try:
+        _posix_fadvise(fd, offset, length, advice)
+    except OSError as e:
+        logger.debug('fadvise failed: %s', e)
+        return False
+    return True
+
+
+
+class SourceFile(object):
+    """ A source file opened for a sequential upload.  read_view() returns
+        a view of the reusable buffer - which is only valid until the next
+        read, so it must be written out (or copied) before then.
+    """
+    def __init__(self, fqfn, block_size=BLOCK_SIZE, drop_cache=True):
+        setup_logging('__main__')
+        self.fqfn       = fqfn
+        self.drop_cache = drop_cache
+        self.buffer     = bytearray(block_size)
+        self.file       = io.open(fqfn, 'rb', buffering=0)
+        self.fd         = self.file.fileno()
+        self.position   = 0
+        self.dropped_to = 0      # pages before this have been dropped
+        fadvise(self.fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+    def seek(self, offset):
+        self.file.seek(offset)
+        self.position   = offset
+        self.dropped_to = min(self.dropped_to, offset)
+
+    def read_view(self, size=None):
+        """ Reads up to size bytes (by default the block size) and returns
+            them as a view - empty at the end of the file.
+        """
+        size = min(size or len(self.buffer), len(self.buffer))
+        if size == len(self.buffer):
+            byte_cnt = self.file.readinto(self.buffer)
+        else:
+            byte_cnt = self.file.readinto(memoryview(self.buffer)[:size])
+        self.position += byte_cnt
+        if self.drop_cache and self.position - self.dropped_to >= DROP_BEHIND_SIZE:
+            self._drop_behind()
+        return view(self.buffer, 0, byte_cnt)
+
+    def _drop_behind(self):
+        fadvise(self.fd, self.dropped_to, self.position - self.dropped_to, POSIX_FADV_DONTNEED)
+        self.dropped_to = self.position
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.drop_cache and self.position > self.dropped_to:
+            self._drop_behind()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+def setup_logging(log_name):
+    global logger
+    logger = logging.getLogger(log_name + '.sourcefile')
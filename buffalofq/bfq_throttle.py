@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+""" Bandwidth shaping with token buckets - one per feed (shared by its
+    worker threads) and optionally one for the whole host (shared by every
+    mover process through a small locked file).
+
+    Buckets let a transfer run into debt: consume() always takes the bytes,
+    then sleeps until the bucket is back to zero.  So a block larger than
+    the burst size still goes through, and concurrent users of a bucket
+    are paced in the order they arrived.
+"""
+
+from __future__ import division
+import os
+import time
+import fcntl
+import struct
+import logging
+import tempfile
+import threading
+from pprint import pprint as pp
+
+logger    = None
+THROTTLES = {}   # (feed name, rates, host bucket file) -> Throttle - see get_throttle
+STATE_FORMAT = '<dd'   # host bucket file: tokens, time of last update
+DEFAULT_HOST_BUCKET_FILE = os.path.join(tempfile.gettempdir(), 'buffalofq_bandwidth.bucket')
+
+
+
+class TokenBucket(object):
+    """ Holds up to burst bytes of tokens, refilled at rate bytes per second.
+        Thread-safe.
+    """
+    def __init__(self, rate, burst=None):
+        setup_logging('__main__')
+        self.rate      = rate
+        self.burst     = burst or rate   # one second's worth by default
+        self.tokens    = self.burst
+        self.last_time = time.time()
+        self.lock      = threading.Lock()
+
+    def reserve(self, byte_cnt):
+        """ Takes the tokens and returns how many seconds the caller must
+            wait before sending them.
+        """
+        with self.lock:
+            (self.tokens, self.last_time) = _take(self.tokens, self.last_time,
+                                                  byte_cnt, self.rate, self.burst)
+            return _wait_seconds(self.tokens, self.rate)
+
+    def close(self):
+        pass
+
+
+
+class SharedTokenBucket(TokenBucket):
+    """ A token bucket whose state lives in a file, so that every process on
+        the host draws from the same bucket.  Each reserve() holds an
+        exclusive flock on the file just long enough to update it.
+        Every process refills at its own rate - so they should all be
+        configured with the same one.
+    """
+    def __init__(self, fqfn, rate, burst=None):
+        TokenBucket.__init__(self, rate, burst)
+        self.fqfn = fqfn
+        self.fd   = os.open(fqfn, os.O_RDWR | os.O_CREAT, 0o666)
+
+    def reserve(self, byte_cnt):
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                state = os.read(self.fd, struct.calcsize(STATE_FORMAT))
+                if len(state) == struct.calcsize(STATE_FORMAT):
+                    (tokens, last_time) = struct.unpack(STATE_FORMAT, state)
+                else:
+                    (tokens, last_time) = (self.burst, time.time())  # new file
+                (tokens, last_time) = _take(tokens, last_time, byte_cnt, self.rate, self.burst)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, struct.pack(STATE_FORMAT, tokens, last_time))
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            return _wait_seconds(tokens, self.rate)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+
+class Throttle(object):
+    """ Paces a transfer against several buckets at once - the wait is that
+        of the most-limiting one.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def consume(self, byte_cnt):
+        """ Returns once byte_cnt bytes may be sent - and the seconds it
+            slept for.
+        """
+        wait = max([bucket.reserve(byte_cnt) for bucket in self.buckets])
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def close(self):
+        for bucket in self.buckets:
+            bucket.close()
+
+
+
+def get_throttle(feed):
+    """ Returns the feed's Throttle - or None if its bandwidth isn't
+        limited.  Each feed gets a single Throttle per process, so that all
+        of its workers share one bucket.
+    """
+    feed_rate = feed.get('max_bytes_per_sec') or 0
+    host_rate = feed.get('host_max_bytes_per_sec') or 0
+    if not feed_rate and not host_rate:
+        return None
+    host_fqfn = feed.get('host_bucket_file') or DEFAULT_HOST_BUCKET_FILE
+    cache_key = (feed['name'], feed_rate, host_rate, host_fqfn)
+    if cache_key not in THROTTLES:
+        buckets = []
+        if feed_rate:
+            buckets.append(TokenBucket(feed_rate))
+        if host_rate:
+            buckets.append(SharedTokenBucket(host_fqfn, host_rate))
+        THROTTLES[cache_key] = Throttle(buckets)
+    return THROTTLES[cache_key]
+
+
+
+def _take(tokens, last_time, byte_cnt, rate, burst):
+    """ Refills the bucket for the time since last_time, then takes byte_cnt
+        from it - which may leave it in debt.  Returns (tokens, now).
+    """
+    now    = time.time()
+    tokens = min(burst, tokens + max(now - last_time, 0) * rate)
+    return tokens - byte_cnt, now
+
+
+def _wait_seconds(tokens, rate):
+    return -tokens / rate if tokens < 0 else 0.0
+
+
+
+def setup_logging(log_name):
+    global logger
+    logger = logging.getLogger(log_name + '.throttle')
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+""" Picks how a feed reaches the far side of its moves - and provides a local
+    backend for when that's this same host, as when moving files between two
+    mounts.  The local backend stands in for both the ConnectionManager and
+    the sftp client, with the same interface, so the mover runs the same
+    steps either way:
+        - the temp file is still written first & renamed into place - with
+          os.rename, which replaces atomically
+        - data is copied within the kernel (copy_file_range, else sendfile)
+          rather than being encrypted, sent through sshd & decrypted.
+    The transport feed config item is one of:
+        - sftp - always connect over ssh (the default)
+        - local - the dest_dir (or source_dir when pulling) is on this host
+        - auto - local if the host is this one & the user is us, otherwise
+          sftp.
+"""
+
+import os
+import io
+import errno
+import socket
+import getpass
+import logging
+from os.path import join as pjoin
+from pprint import pprint as pp
+
+import paramiko
+
+#--- our modules -------------------
+import bfq_connection
+
+logger = None
+
+BLOCK_SIZE      = 8388608   # bytes copied per kernel call - between throttle checks
+LOCAL_HOSTS     = ('localhost', '127.0.0.1', '::1')
+FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+
+
+def get_connections(host, port, user, key_filename, transport='sftp', pool=None, **kwargs):
+    """ Returns the ConnectionManager for the host - or a local stand-in for
+        one.  Given a bfq_connection.ConnectionPool the ssh transport is
+        shared with the pool's other users.  kwargs are passed to the
+        ConnectionManager.
+    """
+    if transport == 'local' or (transport == 'auto' and is_local_host(host, user)):
+        return LocalConnectionManager(host)
+    if pool:
+        return pool.get_connections(host, port, user, key_filename, **kwargs)
+    return bfq_connection.ConnectionManager(host, port, user, key_filename, **kwargs)
+
+
+def is_local_host(host, user):
+    """ Returns True if host & user are this host & the user we run as -
+        without any dns lookups.
+    """
+    if user != getpass.getuser():
+        return False
+    return host in LOCAL_HOSTS or host == socket.gethostname()
+
+
+def is_local(sftp):
+    return isinstance(sftp, LocalClient)
+
+
+def open_batch(sftp):
+    """ Returns a batch of remove, rename & symlink requests for the client -
+        see bfq_connection.SFTPBatch.
+    """
+    if is_local(sftp):
+        return LocalBatch()
+    return bfq_connection.SFTPBatch(sftp)
+
+
+
+class LocalConnectionManager(object):
+    """ Stands in for a ConnectionManager when the files are on this host.
+    """
+    def __init__(self, host):
+        setup_logging('__main__')
+        self.host        = host
+        self.transport   = None
+        self.sftp        = None
+        self.connect_cnt = 0
+
+    def get(self):
+        if self.sftp is None:
+            self.sftp         = LocalClient()
+            self.connect_cnt += 1
+            logger.debug('moving files to & from %s locally', self.host)
+        return self.transport, self.sftp
+
+    def is_alive(self):
+        return self.sftp is not None
+
+    def open_sftp(self):
+        return LocalClient()
+
+    def close(self):
+        self.sftp = None
+
+
+
+class LocalClient(object):
+    """ Provides the parts of paramiko's SFTPClient that the mover uses, over
+        the local filesystem - along with the same IOErrors.
+    """
+    def __init__(self):
+        setup_logging('__main__')
+
+    def open(self, filename, mode='r', bufsize=-1):
+        with _as_ioerror():
+            return LocalFile(io.open(filename, mode))
+
+    def stat(self, path):
+        with _as_ioerror():
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    def lstat(self, path):
+        with _as_ioerror():
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+
+    def listdir_attr(self, path='.'):
+        with _as_ioerror():
+            return [paramiko.SFTPAttributes.from_stat(os.lstat(pjoin(path, fn)), fn)
+                    for fn in os.listdir(path)]
+
+    def remove(self, path):
+        with _as_ioerror():
+            os.remove(path)
+
+    unlink = remove
+
+    def posix_rename(self, oldpath, newpath):
+        with _as_ioerror():
+            os.rename(oldpath, newpath)
+
+    def symlink(self, source, dest):
+        with _as_ioerror():
+            os.symlink(source, dest)
+
+    def normalize(self, path):
+        return os.path.realpath(path)
+
+    def getfo(self, remotepath, fl, callback=None):
+        """ Copies remotepath to the file object fl - returning its size.
+        """
+        byte_cnt = 0
+        with self.open(remotepath, 'rb') as source_file:
+            while True:
+                data = source_file.read(1048576)
+                if not data:
+                    break
+                fl.write(data)
+                byte_cnt += len(data)
+                if callback:
+                    callback(byte_cnt, 0)
+        return byte_cnt
+
+    def copy_file(self, source_fqfn, dest_fqfn, offset=0, block_size=BLOCK_SIZE, consume=None):
+        """ Copies source_fqfn to dest_fqfn, from offset on - leaving the
+            first offset bytes of dest_fqfn as they are.  The data is copied
+            within the kernel where the platform & filesystems allow it.
+            consume, if given, is called with the size of each block copied.
+            Returns the number of bytes copied.
+        """
+        with _as_ioerror():
+            in_fd = os.open(source_fqfn, os.O_RDONLY)
+            try:
+                out_fd = os.open(dest_fqfn, os.O_WRONLY | os.O_CREAT, 0o666)
+                try:
+                    os.ftruncate(out_fd, offset)
+                    position = offset
+                    copiers  = [x for x in (_copy_file_range, _sendfile) if x] + [_read_write]
+                    while True:
+                        try:
+                            copied = copiers[0](in_fd, out_fd, position, block_size)
+                        except OSError as e:
+                            if e.errno not in FALLBACK_ERRNOS or len(copiers) == 1:
+                                raise
+                            # ex: copy_file_range across filesystems on some kernels
+                            logger.debug('%s not usable - falling back: %s', copiers[0].__name__, e)
+                            copiers.pop(0)
+                            continue
+                        if not copied:
+                            break
+                        position += copied
+                        if consume:
+                            consume(copied)
+                finally:
+                    os.close(out_fd)
+            finally:
+                os.close(in_fd)
+        return position - offset
+
+    def close(self):
+        pass
+
+
+
+class LocalFile(object):
+    """ A local file with the extra methods of paramiko's SFTPFile that the
+        mover calls.
+    """
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.file_obj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file_obj.close()
+
+
+
+class LocalBatch(object):
+    """ Runs the requests of a bfq_connection.SFTPBatch as they're made -
+        there's no round trip to save.
+    """
+    def __init__(self):
+        self.results = []
+
+    def remove(self, path):
+        self._run(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        """ Fails if newpath exists - as an sftp rename does.
+        """
+        if os.path.lexists(newpath):
+            self.results.append(IOError(errno.EEXIST, os.strerror(errno.EEXIST), newpath))
+        else:
+            self._run(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        self._run(os.rename, oldpath, newpath)
+
+    def symlink(self, source, dest):
+        self._run(os.symlink, source, dest)
+
+    def _run(self, function, *args):
+        try:
+            function(*args)
+        except (OSError, IOError) as e:
+            self.results.append(IOError(e.errno, e.strerror, e.filename))
+        else:
+            self.results.append(None)
+
+    def wait(self):
+        (results, self.results) = (self.results, [])
+        return results
+
+
+
+class _as_ioerror(object):
+    """ Re-raises OSErrors as the IOErrors that sftp raises - they're one
+        & the same on python 3.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and issubclass(exc_type, OSError) and not issubclass(exc_type, IOError):
+            raise IOError(exc_value.errno, exc_value.strerror, exc_value.filename)
+        return False
+
+
+
+def _load_copiers():
+    """ Returns the (copy_file_range, sendfile) kernel copies the platform
+        has - None for those it lacks.  Each takes (in_fd, out_fd, offset,
+        count), copies from offset in in_fd to the same offset in out_fd and
+        returns the bytes copied - 0 at the end of the file.
+    """
+    copy_file_range = None
+    sendfile        = None
+    if hasattr(os, 'copy_file_range'):                   # python 3.8+
+        def copy_file_range(in_fd, out_fd, offset, count):
+            return os.copy_file_range(in_fd, out_fd, count, offset, offset)
+    if hasattr(os, 'sendfile'):                          # python 3.3+
+        def sendfile(in_fd, out_fd, offset, count):
+            os.lseek(out_fd, offset, os.SEEK_SET)
+            return os.sendfile(out_fd, in_fd, offset, count)
+    if copy_file_range and sendfile:
+        return copy_file_range, sendfile
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+    except (ImportError, OSError):
+        return copy_file_range, sendfile
+
+    def checked(result):
+        if result < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return result
+
+    libc_copy_file_range = getattr(libc, 'copy_file_range', None)    # glibc 2.27+
+    if copy_file_range is None and libc_copy_file_range is not None:
+        libc_copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                                         ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                                         ctypes.c_size_t, ctypes.c_uint]
+        libc_copy_file_range.restype  = ctypes.c_ssize_t
+        def copy_file_range(in_fd, out_fd, offset, count):
+            (in_offset, out_offset) = (ctypes.c_longlong(offset), ctypes.c_longlong(offset))
+            return checked(libc_copy_file_range(in_fd, ctypes.byref(in_offset),
+                                                out_fd, ctypes.byref(out_offset), count, 0))
+    libc_sendfile = getattr(libc, 'sendfile64', None) or getattr(libc, 'sendfile', None)
+    if sendfile is None and libc_sendfile is not None:
+        libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                                  ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t]
+        libc_sendfile.restype  = ctypes.c_ssize_t
+        def sendfile(in_fd, out_fd, offset, count):
+            os.lseek(out_fd, offset, os.SEEK_SET)
+            in_offset = ctypes.c_longlong(offset)
+            return checked(libc_sendfile(out_fd, in_fd, ctypes.byref(in_offset), count))
+    return copy_file_range, sendfile
+
+(_copy_file_range, _sendfile) = _load_copiers()
+
+
+def _read_write(in_fd, out_fd, offset, count):
+    """ The copy of last resort - through a buffer.
+    """
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    data = os.read(in_fd, min(count, 1048576))
+    os.lseek(out_fd, offset, os.SEEK_SET)
+    written = 0
+    while written < len(data):
+        written += os.write(out_fd, data[written:])
+    return len(data)
+
+
+
+def setup_logging(log_name):
+    global logger
+    logger = logging.getLogger(log_name + '.transport')
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import os
+import errno
+import select
+import struct
+import fnmatch
+import logging
+import ctypes
+import ctypes.util
+from pprint import pprint as pp
+
+logger = None
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_Q_OVERFLOW  = 0x00004000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = 0o2000000
+EVENT_HDR      = struct.Struct('iIII')   # wd, mask, cookie, len
+
+
+
+class InotifyWatcher(object):
+    """ Wakes a feed as soon as a file matching its source_fn is finished
+        being written to (IN_CLOSE_WRITE) or is moved into (IN_MOVED_TO)
+        the source_dir - rather than waiting out the polling interval.
+        Linux only - uses libc's inotify through ctypes.
+    """
+    def __init__(self, source_dir, source_fn):
+
+        setup_logging('__main__')
+        self.source_dir = source_dir
+        self.source_fn  = source_fn
+        self.fd         = None
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd   = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(fd, source_dir, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, os.strerror(err), source_dir)
+        self.fd = fd
+
+    def wait(self, timeout):
+        """ Blocks for up to timeout seconds for a matching file to land.
+            Returns True if one did (or if the kernel's event queue
+            overflowed, in which case a rescan is needed), otherwise False.
+            All pending events are consumed.
+        """
+        try:
+            (readable, _, _) = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        if not readable:
+            return False
+        return self._read_events()
+
+    def _read_events(self):
+        found = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return found
+                raise
+            offset = 0
+            while offset + EVENT_HDR.size <= len(data):
+                (wd, mask, cookie, name_len) = EVENT_HDR.unpack_from(data, offset)
+                offset += EVENT_HDR.size
+                name    = data[offset:offset + name_len].rstrip('\0')
+                offset += name_len
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning('inotify queue overflowed - will rescan source_dir')
+                    found = True
+                elif fnmatch.fnmatch(name, self.source_fn):
+                    found = True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+
+def get_watcher(source_dir, source_fn):
+    """ Returns an InotifyWatcher for the source_dir, or None if inotify
+        isn't available - in which case the feed will fall back to polling.
+    """
+    setup_logging('__main__')
+    try:
+        return InotifyWatcher(source_dir, source_fn)
+    except (OSError, AttributeError) as e:
+        logger.warning('inotify unavailable - will rely on polling: %s' % e)
+        return None
+
+
+
+def setup_logging(log_name):
+    global logger
+    logger = logging.getLogger(log_name + '.watcher')
+
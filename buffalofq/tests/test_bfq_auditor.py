@@ -4,6 +4,10 @@ import sys
 import os
 import tempfile
 import imp
+import json
+import threading
+import pytest
+from os.path import exists, join as pjoin
 
 sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
@@ -45,8 +49,268 @@ class TestFeedAuditor(object):
         #assert self.FeedAuditor.good_to_run(5) is False
 
 
+    def test_slot_auditor(self):
+        slot = self.FeedAuditor.slot_auditor(2)
+        assert slot.status['step']   == 0
+        assert slot.status['result'] == 'pass'
+        assert self.FeedAuditor.incomplete_slots() == {}
 
+        slot.write(step=3, status='start', fn='foo.csv')
+        assert self.FeedAuditor.incomplete_slots() == {2: 'foo.csv'}
+        assert self.FeedAuditor.status['step'] == 0
 
+        # a new auditor should pick up the slot from the file:
+        auditor2 = mod.FeedAuditor(feed_name='test',
+                                   data_dir=self.audit_dir,
+                                   config_name='buffalofq.yml')
+        assert auditor2.incomplete_slots() == {2: 'foo.csv'}
 
+        slot.write(step=6, status='stop', result=True)
+        assert self.FeedAuditor.incomplete_slots() == {}
 
 
+    def test_dest_auditor(self):
+        dest = self.FeedAuditor.dest_auditor('dw')
+        assert dest.key == 'test.dest-dw'
+        dest.write(step=3, status='start', fn='foo.csv')
+        assert self.FeedAuditor.status['step'] == 0
+        assert self.FeedAuditor.incomplete_slots() == {}   # not a worker slot
+
+        # a new auditor should pick up the destination from the file:
+        auditor2 = mod.FeedAuditor(feed_name='test',
+                                   data_dir=self.audit_dir,
+                                   config_name='buffalofq.yml')
+        assert auditor2.dest_auditor('dw').status['fn']   == 'foo.csv'
+        assert auditor2.dest_auditor('dw').status['step'] == 3
+
+
+
+class TestFeedAuditorJournal(object):
+
+    def setup_method(self, method):
+        self.audit_dir     = tempfile.mkdtemp(prefix='buffalofq_ad_')
+        self.FeedAuditor   = self._get_auditor()
+
+    def _get_auditor(self, backend='journal', **kwargs):
+        return mod.FeedAuditor(feed_name='test',
+                               data_dir=self.audit_dir,
+                               config_name='buffalofq',
+                               backend=backend,
+                               **kwargs)
+
+    def test_replay(self):
+        self.FeedAuditor.write(step=0, status='start', fn='')
+        self.FeedAuditor.write(step=0, status='stop', result='pass')
+        self.FeedAuditor.write(step=1, status='start', fn='foo.csv')
+        self.FeedAuditor.slot_auditor(1).write(step=3, status='start', fn='bar.csv')
+        self.FeedAuditor.close()
+        assert not exists(self.FeedAuditor.audit_fqfn)
+
+        auditor2 = self._get_auditor()
+        assert auditor2.status['step']   == 1
+        assert auditor2.status['status'] == 'start'
+        assert auditor2.status['result'] == 'tbd'
+        assert auditor2.status['fn']     == 'foo.csv'
+        assert auditor2.mode             == 'recovery'
+        assert auditor2.incomplete_slots() == {1: 'bar.csv'}
+
+    def test_checksum(self):
+        self.FeedAuditor.write(step=3, status='stop', result=True, checksum='abc')
+        self.FeedAuditor.close()
+        auditor2 = self._get_auditor()
+        assert auditor2.status['checksum'] == 'abc'
+
+        # the checksum belongs to the prior file once the next one starts:
+        auditor2.write(step=1, status='start', fn='bar.csv')
+        assert 'checksum' not in auditor2.status
+        auditor2.close()
+        assert 'checksum' not in self._get_auditor().status
+
+    def test_torn_record_ignored(self):
+        self.FeedAuditor.write(step=1, status='start', fn='foo.csv')
+        self.FeedAuditor.write(step=1, status='stop', result='pass')
+        self.FeedAuditor.close()
+        with open(self.FeedAuditor.journal_fqfn, 'a') as f:
+            f.write('["test",2,"sta')
+
+        auditor2 = self._get_auditor()
+        assert auditor2.status['step']   == 1
+        assert auditor2.status['status'] == 'stop'
+        assert auditor2.status['result'] == 'pass'
+
+    def test_records_after_torn_record(self):
+        self.FeedAuditor.write(step=3, status='start', fn='foo.csv')
+        self.FeedAuditor.close()
+        with open(self.FeedAuditor.journal_fqfn, 'a') as f:
+            f.write('["test",3,"sto')
+
+        auditor2 = self._get_auditor()
+        assert auditor2.status['step'] == 3
+        for step in (3, 4, 5):
+            if step > 3:
+                auditor2.write(step=step, status='start')
+            auditor2.write(step=step, status='stop', result='pass')
+        auditor2.close()
+
+        auditor3 = self._get_auditor()
+        assert auditor3.status['step']   == 5
+        assert auditor3.status['status'] == 'stop'
+        assert auditor3.status['result'] == 'pass'
+        assert auditor3.journal_cnt      == 6
+
+    def test_records_after_corrupt_record(self):
+        """ A journal in which a record already ran on from a torn one.
+        """
+        self.FeedAuditor.write(step=3, status='start', fn='foo.csv')
+        self.FeedAuditor.close()
+        with open(self.FeedAuditor.journal_fqfn, 'a') as f:
+            f.write('["test",3,"sto["test",3,"stop",1,"pass",null]\n'
+                    '["test",4,"start",2,"tbd",null]\n')
+        assert self._get_auditor().status['step'] == 4
+
+    def test_read_only(self):
+        self.FeedAuditor.write(step=1, status='start', fn='foo.csv')
+        self.FeedAuditor.close()
+        with open(self.FeedAuditor.journal_fqfn, 'a') as f:
+            f.write('["test",2,"sta')
+        before = _dir_state(self.audit_dir)
+        for backend in ('json', 'journal', 'sqlite'):
+            auditor = self._get_auditor(backend=backend, read_only=True)
+            assert auditor.incomplete_files() == ['foo.csv']
+            auditor.close()
+            assert _dir_state(self.audit_dir) == before  # nothing compacted, cut off or created
+
+    def test_compaction(self):
+        auditor = self._get_auditor(journal_compact=5)
+        for step in range(1, 4):
+            auditor.write(step=step, status='start', fn='foo.csv')
+            auditor.write(step=step, status='stop', result='pass')
+        # 6 records: compacted at the 5th, 1 left in the journal
+        assert auditor.journal_cnt == 1
+        with open(auditor.audit_fqfn) as f:
+            assert json.load(f)['test']['step'] == 3
+        auditor.close()
+
+        auditor2 = self._get_auditor()
+        assert auditor2.status['step']   == 3
+        assert auditor2.status['status'] == 'stop'
+
+    def test_switch_back_to_json(self):
+        self.FeedAuditor.write(step=2, status='start', fn='foo.csv')
+        self.FeedAuditor.close()
+
+        auditor2 = self._get_auditor(backend='json')
+        assert not exists(auditor2.journal_fqfn)
+        assert auditor2.status['step'] == 2
+        with open(auditor2.audit_fqfn) as f:
+            assert json.load(f)['test']['fn'] == 'foo.csv'
+
+
+
+class TestFeedAuditorSqlite(object):
+
+    def setup_method(self, method):
+        self.audit_dir     = tempfile.mkdtemp(prefix='buffalofq_ad_')
+        self.FeedAuditor   = self._get_auditor()
+
+    def _get_auditor(self, backend='sqlite'):
+        return mod.FeedAuditor(feed_name='test',
+                               data_dir=self.audit_dir,
+                               config_name='buffalofq',
+                               backend=backend)
+
+    def test_reread(self):
+        self.FeedAuditor.write(step=1, status='start', fn='foo.csv')
+        self.FeedAuditor.write(step=3, status='stop', result=True, checksum='abc')
+        self.FeedAuditor.slot_auditor(1).write(step=3, status='start', fn='bar.csv')
+        self.FeedAuditor.close()
+
+        auditor2 = self._get_auditor()
+        assert auditor2.status['step']     == 3
+        assert auditor2.status['fn']       == 'foo.csv'
+        assert auditor2.status['checksum'] == 'abc'
+        assert auditor2.mode               == 'recovery'
+        assert auditor2.incomplete_slots() == {1: 'bar.csv'}
+        assert auditor2.incomplete_files() == ['bar.csv', 'foo.csv']
+
+    def test_incomplete_files(self):
+        for fn in ('a.csv', 'b.csv', 'c.csv'):
+            self.FeedAuditor.write(step=1, status='start', fn=fn)
+            if fn != 'b.csv':
+                self.FeedAuditor.write(step=6, status='stop', result=True)
+        # each file keeps its own row - so b is still known to be incomplete:
+        assert self.FeedAuditor.incomplete_files() == ['b.csv']
+        assert self.FeedAuditor.status['fn']       == 'c.csv'
+
+    def test_prune_while_running(self, monkeypatch):
+        monkeypatch.setattr(mod, 'DB_KEEP_SECONDS', 0)
+        monkeypatch.setattr(mod, 'DB_PRUNE_FILES', 10)
+        def file_rows():
+            return self.FeedAuditor.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        for i in range(25):
+            self.FeedAuditor.write(step=1, status='start', fn='f%d' % i)
+            self.FeedAuditor.write(step=6, status='stop', result=True)
+            assert file_rows() == (i + 1) % 10        # pruned every 10 files - not just on close
+        self.FeedAuditor.write(step=1, status='start', fn='last')
+        for i in range(10):
+            self.FeedAuditor.slot_auditor(1).write(step=1, status='start', fn='s%d' % i)
+            self.FeedAuditor.slot_auditor(1).write(step=6, status='stop', result=True)
+        assert self.FeedAuditor.incomplete_files() == ['last']
+
+    def test_concurrent_writers(self):
+        auditors = [self._get_auditor() for i in range(4)]
+        def advance(auditor, slot):
+            slot_auditor = auditor.slot_auditor(slot)
+            for i in range(25):
+                slot_auditor.write(step=1, status='start', fn='f%d_%d' % (slot, i))
+                slot_auditor.write(step=6, status='stop', result=True)
+            slot_auditor.write(step=3, status='start', fn='last%d' % slot)
+        threads = [threading.Thread(target=advance, args=(auditors[x], x)) for x in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for auditor in auditors:
+            auditor.close()
+        assert self._get_auditor().incomplete_files() == ['last0', 'last1', 'last2', 'last3']
+
+    def test_read_only(self):
+        self.FeedAuditor.write(step=1, status='start', fn='foo.csv')
+        self.FeedAuditor.close()
+        os.remove(self.FeedAuditor.audit_fqfn)
+        before = _dir_state(self.audit_dir)
+
+        auditor2 = mod.FeedAuditor(feed_name='test', data_dir=self.audit_dir,
+                                   config_name='buffalofq', backend='sqlite', read_only=True)
+        assert auditor2.incomplete_files() == ['foo.csv']
+        with pytest.raises(AssertionError):
+            auditor2.write(step=1, status='stop', result=True)
+        auditor2.close()
+        assert _dir_state(self.audit_dir) == before      # no prune, and no json snapshot
+
+    def test_migrate_from_json(self):
+        self.FeedAuditor.close()
+        os.remove(self.FeedAuditor.db_fqfn)
+        auditor = self._get_auditor(backend='json')
+        auditor.write(step=2, status='start', fn='foo.csv')
+        auditor.close()
+
+        auditor2 = self._get_auditor()
+        assert auditor2.status['step'] == 2
+        assert auditor2.incomplete_files() == ['foo.csv']
+        auditor2.write(step=2, status='stop', result=True)
+        auditor2.close()
+
+        # and back again - from the snapshot written on close:
+        assert self._get_auditor(backend='json').status['result'] == 'pass'
+
+
+
+def _dir_state(dir_name):
+    """ Returns the name & content of every file in dir_name.
+    """
+    state = {}
+    for fn in os.listdir(dir_name):
+        with open(pjoin(dir_name, fn), 'rb') as f:
+            state[fn] = f.read()
+    return state
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import sys, os
+import glob
+import tempfile
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import bfq_test_tools  as test_tools
+import buffalofq.bfq_benchmark as mod
+
+
+
+class TestRunScenario(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        mod.bfq_buffguts.setup_logging('__main__')
+
+    def teardown_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def test_small_distribution(self):
+        results = mod.run_scenario([(20, 1024), (2, 200 * 1024)])
+        assert results['files']       == 22
+        assert results['files_moved'] == 22
+        assert results['bytes']       == 20 * 1024 + 2 * 200 * 1024
+        assert results['files_per_sec'] > 0
+        assert sorted(results['steps']) == ['1', '2', '3', '4', '5', '6']
+        assert all([x['count'] == 22 for x in results['steps'].values()])
+        # at least a start & stop per step per file:
+        assert results['audit']['writes'] >= 22 * 12
+        assert results['operations']['step_3_copy']['count'] == 22
+        # nothing is left behind - and the wrappers are gone:
+        assert glob.glob(os.path.join(tempfile.gettempdir(), 'bfq_bench_*')) == []
+        assert 'timed' not in repr(mod.bfq_buffguts.HandleOneFile.__dict__['_step_runner'])
+
+    def test_parallel_workers(self):
+        results = mod.run_scenario([(20, 1024)], {'max_workers': 3})
+        assert results['files_moved'] == 20
+        assert results['feed'] == {'max_workers': 3}
+
+
+    def test_startup(self):
+        results = mod.run_startup(runs=3)
+        assert results['runs'] == 3
+        assert 0 < results['median_seconds'] <= results['max_seconds']
+        assert results['interpreter_seconds'] > 0
+        assert glob.glob(os.path.join(tempfile.gettempdir(), 'bfq_bench_*')) == []
+
+
+class TestPercentile(object):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        assert mod.percentile(values, 50)  == 50
+        assert mod.percentile(values, 95)  == 95
+        assert mod.percentile(values, 100) == 100
+        assert mod.percentile([7], 99)     == 7
+        assert mod.percentile([], 50) is None
+
+    def test_scale_distribution(self):
+        assert mod.scale_distribution([(100000, 1024), (10, 5)], 0.01) == [(1000, 1024), (1, 5)]
@@ -1,12 +1,17 @@
 #!/usr/bin/env python
 
 import sys, os
+import time
 import getpass
 import tempfile
 import shutil
 import imp
 import glob
+import hashlib
+import json
 import logging
+import threading
+import pytest
 from pprint import pprint as pp
 from os.path import dirname, basename, exists, isdir, isfile, join as pjoin
 
@@ -107,6 +112,112 @@ class TestLocalToRemoteCopy(object):
 
 
 
+    def test_file_sorting_by_typed_keys(self):
+        feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        OneFeed = mod.HandleOneFeed(feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        files = ['a_seq-10.csv', 'b_seq-9.csv', 'c_seq-100.csv', 'd.csv']
+        OneFeed.feed['sort_key'] = 'field:seq'
+        assert OneFeed._sort_files(files) == ['d.csv', 'a_seq-10.csv', 'c_seq-100.csv', 'b_seq-9.csv']
+        OneFeed.feed['sort_key'] = 'field:seq:int'
+        assert OneFeed._sort_files(files) == ['d.csv', 'b_seq-9.csv', 'a_seq-10.csv', 'c_seq-100.csv']
+        OneFeed.feed['sort_key'] = 'field:seq:int,desc'
+        assert OneFeed._sort_files(files) == ['c_seq-100.csv', 'a_seq-10.csv', 'b_seq-9.csv', 'd.csv']
+        assert OneFeed._sort_files(iter(files), 2) == ['c_seq-100.csv', 'a_seq-10.csv']
+
+        files = ['x_date-20150102T0304_seq-2.csv', 'x_date-2015_seq-9.csv',
+                 'x_date-20150102T0304_seq-10.csv', 'x_date-201412_seq-1.csv']
+        OneFeed.feed['sort_key'] = 'field:date:ts,field:seq:int,desc'
+        assert OneFeed._sort_files(files) == ['x_date-201412_seq-1.csv', 'x_date-2015_seq-9.csv',
+                                              'x_date-20150102T0304_seq-10.csv',
+                                              'x_date-20150102T0304_seq-2.csv']
+        OneFeed.feed['sort_key'] = 'field:date:ts,desc,name'
+        assert OneFeed._sort_files(files)[:2] == ['x_date-20150102T0304_seq-10.csv',
+                                                  'x_date-20150102T0304_seq-2.csv']
+
+        OneFeed.feed['sort_key'] = 'field:seq:bigint'
+        with pytest.raises(ValueError):
+            OneFeed._sort_files(files)
+
+        OneFeed.close()
+
+
+
+    def test_parse_sort_key(self):
+        assert mod.parse_sort_key('name') == [(None, 'str', False)]
+        assert mod.parse_sort_key('field:date') == [('date', 'str', False)]
+        assert mod.parse_sort_key('field:date:ts, field:seq:int,desc') == [('date', 'ts', False),
+                                                                           ('seq', 'int', True)]
+        for sort_key in ['desc', 'time', 'field:', 'field:seq:int:x', 'field:seq:bigint', 'name,,']:
+            with pytest.raises(ValueError):
+                mod.parse_sort_key(sort_key)
+
+
+
+    def test_filename_fields(self):
+        assert mod.get_filename_fields('/a/foo_date-2015_seq-9_seq-10.csv') == {'date': '2015', 'seq': '9'}
+        assert mod.get_filename_fields('/a/foo_date-2015_seq-9_seq-10.csv') is \
+               mod.get_filename_fields('/a/foo_date-2015_seq-9_seq-10.csv')
+        assert mod.filename_field_get('foo_date-2015.csv', 'date') == '2015'
+        assert mod.filename_field_get('foo_date-2015.csv', 'seq') is None
+        assert mod.convert_field('20150102T030405Z', 'ts') == (2015, 1, 2, 3, 4, 5)
+        assert mod.convert_field('2015-01', 'ts') is None
+        assert mod.convert_field('x9', 'int') is None
+
+
+
+    def test_file_sorting_with_limit(self):
+        feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        OneFeed = mod.HandleOneFeed(feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        files = ['foo_date-2015.csv', 'bar_date-2016.csv', 'mook_date-2014.csv']
+        OneFeed.feed['sort_key'] = 'field:date'
+        assert OneFeed._sort_files(iter(files), 2) == ['mook_date-2014.csv', 'foo_date-2015.csv']
+        OneFeed.feed['sort_key'] = 'name'
+        assert OneFeed._sort_files(iter(files), 2) == ['bar_date-2016.csv', 'foo_date-2015.csv']
+        assert OneFeed._sort_files(iter(files), 0) == []
+        OneFeed.feed['sort_key'] = None
+        assert OneFeed._sort_files(iter(files), 1) == ['foo_date-2015.csv']
+        assert OneFeed._sort_files(iter(files)) == files
+
+        OneFeed.close()
+
+
+
+    def test_get_files_to_move_with_limit(self):
+        """ Tests that only the next limit_total files are selected.
+        """
+        for x in range(10):
+            with open(pjoin(self.source_data_dir, 'good_seq-%02d.dat' % x), 'w') as f:
+                f.write('foo\n')
+        feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        OneFeed = mod.HandleOneFeed(feed, self.feed_audit_dir, limit_total=4,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        OneFeed._check_prereqs()
+        assert OneFeed._get_files_to_move() == sorted(glob.glob1(self.source_data_dir, 'good*'))[:4]
+        OneFeed.file_cnt = 3
+        assert len(OneFeed._get_files_to_move()) == 1
+        OneFeed.close()
+
+
+
+    def test_scan_dir(self):
+        files = sorted(mod.scan_dir(self.source_data_dir, 'good*'))
+        assert len(files) == 3
+        assert all([x.startswith('good_') for x in files])
+        assert list(mod.scan_dir(self.source_data_dir, '*.nomatch')) == []
+
+    def test_scan_dir_without_scandir(self, monkeypatch):
+        warnings = []
+        monkeypatch.setattr(mod, 'scandir', None)
+        monkeypatch.setattr(mod, 'LISTDIR_LOGGED', False)
+        monkeypatch.setattr(mod.logger, 'warning', lambda *args: warnings.append(args))
+        for i in range(2):
+            assert len(list(mod.scan_dir(self.source_data_dir, 'good*'))) == 3
+        assert len(warnings) == 1              # said once, not on every poll
+
+
+
     def test_copy_many_files(self):
         """ Tests copying many files from source to dest
             AND leaving source files alone afterwards
@@ -132,6 +243,137 @@ class TestLocalToRemoteCopy(object):
         assert len(glob.glob(pjoin(self.dest_data_dir,'bad*')))     == 0
 
 
+    @pytest.mark.parametrize('audit_backend', ['json', 'sqlite'])
+    def test_copy_many_files_parallel(self, audit_backend):
+        """ Tests copying many files from source to dest over multiple
+            workers AND archiving source files afterwards.
+        """
+        for i in range(10):
+            _make_file(self.source_data_dir,  'good')
+        feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        feed['max_workers']        = 4
+        feed['audit_backend']      = audit_backend
+        feed['source_post_dir']    = self.source_arc_dir
+        feed['source_post_action'] = 'move'
+
+        OneFeed = mod.HandleOneFeed(feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        OneFeed.run(force=True)
+        OneFeed.close()
+
+        assert len(glob.glob(pjoin(self.source_data_dir,'good*'))) == 0
+        assert len(glob.glob(pjoin(self.source_arc_dir,'good*')))  == 13
+        assert len(glob.glob(pjoin(self.dest_data_dir,'good*')))   == 13
+        assert len(glob.glob(pjoin(self.dest_data_dir,'*.temp')))  == 0
+        assert OneFeed.auditor.incomplete_slots() == {}
+        assert OneFeed.auditor.incomplete_files() == []
+
+
+    def test_copy_parallel_slot_recovery(self):
+        """ Tests that a file left in progress by a worker slot gets finished
+            on the next run, even if max_workers has since been lowered.
+        """
+        feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        feed['max_workers']        = 2
+        feed['source_post_dir']    = self.source_arc_dir
+        feed['source_post_action'] = 'move'
+        broken_file = sorted(os.listdir(self.source_data_dir))[0]
+
+        OneFeed = mod.HandleOneFeed(feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        OneFeed.auditor.slot_auditor(3).write(step=3, status='start', fn=broken_file)
+        assert OneFeed.auditor.incomplete_slots() == {3: broken_file}
+        OneFeed.run(force=True)
+        OneFeed.close()
+
+        assert OneFeed.auditor.incomplete_slots() == {}
+        assert len(glob.glob(pjoin(self.source_data_dir,'good*'))) == 0
+        assert len(glob.glob(pjoin(self.source_arc_dir,'good*')))  == 3
+        assert len(glob.glob(pjoin(self.dest_data_dir,'good*')))   == 3
+
+
+    def test_copy_slot_recovery_with_one_worker(self):
+        """ Tests that slot records are finished off once max_workers has been
+            lowered to 1 - so they don't count as incomplete for good.
+        """
+        feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        feed['max_workers']        = 1
+        feed['source_post_dir']    = self.source_arc_dir
+        feed['source_post_action'] = 'move'
+        broken_file = sorted(os.listdir(self.source_data_dir))[0]
+
+        OneFeed = mod.HandleOneFeed(feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        OneFeed.auditor.slot_auditor(2).write(step=3, status='start', fn=broken_file)
+        assert OneFeed.auditor.incomplete_files() == [broken_file]
+        OneFeed.run(force=True)
+        OneFeed.close()
+
+        assert OneFeed.auditor.incomplete_slots() == {}
+        assert OneFeed.auditor.incomplete_files() == []
+        assert len(glob.glob(pjoin(self.source_data_dir,'good*'))) == 0
+        assert len(glob.glob(pjoin(self.dest_data_dir,'good*')))   == 3
+
+
+    def test_copy_tuned_upload(self):
+        """ Tests copying a multi-block file with non-default transport
+            & upload settings - and that the dest matches the source.
+        """
+        source_fqfn = pjoin(self.source_data_dir, 'good_big.dat')
+        with open(source_fqfn, 'wb') as f:
+            f.write(os.urandom(3 * 1048576 + 17))
+        for pipelined in [True, False]:
+            feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+            feed['buffer_size']     = 65536 + 7
+            feed['pipelined']       = pipelined
+            feed['window_size']     = 4194304
+            feed['max_packet_size'] = 65536
+
+            OneFeed = mod.HandleOneFeed(feed, self.feed_audit_dir, limit_total=0,
+                                        config_name=None, key_filename='id_buffalofq_rsa')
+            OneFeed.run(force=True)
+            OneFeed.close()
+
+            with open(source_fqfn, 'rb') as f1:
+                with open(pjoin(self.dest_data_dir, 'good_big.dat'), 'rb') as f2:
+                    assert f1.read() == f2.read()
+            os.remove(pjoin(self.dest_data_dir, 'good_big.dat'))
+
+
+    def test_step_metrics(self):
+        """ Tests that every step, audit write, scan & connection setup is
+            timed - and written to the metrics file.
+        """
+        feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        feed['metrics_file']   = pjoin(self.feed_audit_dir, 'bfq.json')
+        feed['metrics_format'] = 'json'
+        OneFeed = mod.HandleOneFeed(feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        OneFeed.run(force=True)
+
+        with open(feed['metrics_file']) as f:
+            operations = json.load(f)['operations']
+        assert operations['get_files_to_move']['count'] == 1
+        assert operations['setup_connection']['count']  == 1
+        for step in range(1, 7):
+            assert operations[mod.bfq_metrics.step_operation(step)]['count'] == 3
+        assert operations['audit_write']['count'] == 3 * 6 * 2
+        assert operations['step_3_copy']['p99'] > 0
+
+
+    def test_copy_bandwidth_limit(self):
+        feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        feed['max_bytes_per_sec'] = 60
+        start_time = time.time()
+        OneFeed = mod.HandleOneFeed(feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        OneFeed.run(force=True)
+        OneFeed.close()
+        # 3 files of 46 bytes, with the first 60 free:
+        assert time.time() - start_time > 1.0
+        assert len(glob.glob(pjoin(self.dest_data_dir, 'good*'))) == 3
+        assert OneFeed.metrics.summary()['throttle_wait']['count'] >= 1
+
     def test_source_post_action_delete(self):
         """ Tests copying many files from source to dest
             AND deleting source files
@@ -221,8 +463,767 @@ class TestLocalToRemoteCopy(object):
 
 
 
+class TestDedup(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+        self.source_arc_dir  = tempfile.mkdtemp(prefix='bfq_sa_')
+        self.dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+        self.feed_audit_dir  = tempfile.mkdtemp(prefix='bfq_fa_')
+        for i in range(3):
+            _make_file(self.source_data_dir, 'good')   # all with the same content
+        with open(pjoin(self.source_data_dir, 'good_unique.dat'), 'w') as f:
+            f.write('unique\n')
+        self.feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        self.feed['source_post_dir']    = self.source_arc_dir
+        self.feed['source_post_action'] = 'move'
+        setup_logging()
+
+    def teardown_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def _run(self):
+        OneFeed = mod.HandleOneFeed(self.feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        try:
+            OneFeed.run(force=True)
+        finally:
+            OneFeed.close()
+        return OneFeed
+
+    def test_skip(self):
+        self.feed['dedup'] = 'skip'
+        OneFeed = self._run()
+        assert OneFeed.file_cnt == 4
+        assert len(glob.glob(pjoin(self.source_arc_dir, 'good*'))) == 4
+        dest_files = sorted(os.listdir(self.dest_data_dir))
+        assert len(dest_files) == 2        # one of the 3 copies & the unique one
+        assert 'good_unique.dat' in dest_files
+
+        # a replay under a new name is skipped as well:
+        shutil.copy(pjoin(self.source_arc_dir, dest_files[0]),
+                    pjoin(self.source_data_dir, 'good_replay.dat'))
+        self._run()
+        assert sorted(os.listdir(self.dest_data_dir)) == dest_files
+        assert not os.listdir(self.source_data_dir)
+
+    def test_symlink(self):
+        self.feed['dedup'] = 'symlink'
+        self._run()
+        dest_files = os.listdir(self.dest_data_dir)
+        links      = [x for x in dest_files if os.path.islink(pjoin(self.dest_data_dir, x))]
+        assert len(dest_files) == 4
+        assert len(links)      == 2
+        for fn in dest_files:
+            with open(pjoin(self.dest_data_dir, fn)) as f1:
+                with open(pjoin(self.source_arc_dir, fn)) as f2:
+                    assert f1.read() == f2.read()
+
+    def test_delivered_file_gone(self):
+        self.feed['dedup'] = 'skip'
+        self._run()
+        for fn in os.listdir(self.dest_data_dir):
+            os.remove(pjoin(self.dest_data_dir, fn))
+        shutil.copy(pjoin(self.source_arc_dir, 'good_unique.dat'),
+                    pjoin(self.source_data_dir, 'good_unique2.dat'))
+        self._run()
+        assert os.listdir(self.dest_data_dir) == ['good_unique2.dat']
+
+
+    @pytest.mark.parametrize('dedup', ['skip', 'symlink'])
+    def test_content_sent_back_over_a_change(self, dedup):
+        """ A, then B, then A again under the same name: the third must be
+            sent, since the A delivered first was overwritten by B.
+        """
+        self.feed['dedup'] = dedup
+        for fn in os.listdir(self.source_data_dir):
+            os.remove(pjoin(self.source_data_dir, fn))
+        for data in ('AAAA\n', 'BBBB\n', 'AAAA\n'):
+            with open(pjoin(self.source_data_dir, 'good_data.csv'), 'w') as f:
+                f.write(data)
+            self._run()
+            assert not os.listdir(self.source_data_dir)
+            with open(pjoin(self.dest_data_dir, 'good_data.csv')) as f:
+                assert f.read() == data
+
+    def test_delivered_file_changed(self):
+        """ Changed at the dest without a delivery - so the index still holds
+            it, but its size no longer matches.
+        """
+        self.feed['dedup'] = 'skip'
+        self._run()
+        with open(pjoin(self.dest_data_dir, 'good_unique.dat'), 'w') as f:
+            f.write('changed by someone else\n')
+        shutil.copy(pjoin(self.source_arc_dir, 'good_unique.dat'),
+                    pjoin(self.source_data_dir, 'good_unique2.dat'))
+        self._run()
+        with open(pjoin(self.dest_data_dir, 'good_unique2.dat')) as f:
+            assert f.read() == 'unique\n'
+
+    @pytest.mark.parametrize('source_post_action', ['move', 'delete'])
+    def test_recovery_after_source_post_action(self, source_post_action):
+        """ A run that dies in step 6 after the source has gone is recovered
+            - without the delivery being recorded from the missing source.
+        """
+        self.feed['dedup']              = 'skip'
+        self.feed['source_post_action'] = source_post_action
+        (mod.FAIL_STEP, mod.FAIL_SUBSTEP) = (6, 'd')
+        try:
+            with pytest.raises(SystemExit):
+                self._run()
+        finally:
+            (mod.FAIL_STEP, mod.FAIL_SUBSTEP) = (-1, -1)
+        assert len(os.listdir(self.source_data_dir)) == 3
+        for i in range(2):
+            OneFeed = self._run()
+            assert OneFeed.auditor.status['step']   == 6
+            assert OneFeed.auditor.status['result'] == 'pass'
+        assert os.listdir(self.source_data_dir) == []
+        assert len(os.listdir(self.dest_data_dir)) == 2
+
+
+class TestDelta(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+        self.source_arc_dir  = tempfile.mkdtemp(prefix='bfq_sa_')
+        self.dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+        self.feed_audit_dir  = tempfile.mkdtemp(prefix='bfq_fa_')
+        self.feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        self.feed['source_post_dir']    = self.source_arc_dir
+        self.feed['source_post_action'] = 'move'
+        self.feed['delta']              = True
+        self.feed['delta_block_size']   = 4096
+        self.feed['checksum_type']      = 'md5'
+        self.data = os.urandom(300000)
+        setup_logging()
+
+    def teardown_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def _run(self, data):
+        with open(pjoin(self.source_data_dir, 'good_daily.dat'), 'wb') as f:
+            f.write(data)
+        OneFeed = mod.HandleOneFeed(self.feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        try:
+            OneFeed.run(force=True)
+        finally:
+            OneFeed.close()
+        with open(pjoin(self.dest_data_dir, 'good_daily.dat'), 'rb') as f:
+            assert f.read() == data
+        assert not os.listdir(self.source_data_dir)
+
+    def test_sends_changes_only(self, monkeypatch):
+        sent = []
+        apply_delta = mod.bfq_delta.apply_delta
+        def counting_apply_delta(*args, **kwargs):
+            sent.append(apply_delta(*args, **kwargs))
+            return sent[-1]
+        monkeypatch.setattr(mod.bfq_delta, 'apply_delta', counting_apply_delta)
+        # signatures come from the data read for the copy - not another read:
+        monkeypatch.setattr(mod.bfq_delta, 'file_signature', None)
+
+        self._run(self.data)
+        assert sent == []                    # nothing to diff the first one with
+        changed = self.data[:100000] + 'changed' + self.data[100007:] + 'appended'
+        self._run(changed)
+        assert len(sent) == 1
+        assert sent[0] < 10000               # a block, the tail & the append
+        self._run(changed + 'again')         # against the signature built by the delta
+        assert len(sent) == 2
+        assert sent[1] < 10000
+
+    def test_dest_changed(self, monkeypatch):
+        self._run(self.data)
+        with open(pjoin(self.dest_data_dir, 'good_daily.dat'), 'ab') as f:
+            f.write('changed by someone else')
+        monkeypatch.setattr(mod.bfq_delta, 'apply_delta', None)   # must not be used
+        self._run(self.data + 'appended')
+
+
+
+class TestPollInterval(object):
+
+    def setup_method(self, method):
+        setup_logging()
+
+    def test_fixed(self):
+        interval = mod.PollInterval('10')
+        assert interval.update(True)  == 10
+        assert interval.update(False) == 10
+
+    def test_adaptive(self):
+        interval = mod.PollInterval(60, min_seconds=1)
+        assert interval.seconds == 1
+        assert [interval.update(False) for i in range(8)] == [2, 4, 8, 16, 32, 60, 60, 60]
+        assert [interval.update(True) for i in range(8)]  == [30, 15, 7.5, 3.75, 1.875, 1, 1, 1]
+
+    def test_adaptive_polling_gate(self):
+        feed = _make_default_feed(tempfile.gettempdir(), tempfile.gettempdir())
+        feed['polling_seconds']     = 300
+        feed['polling_min_seconds'] = 1
+        OneFeed = mod.HandleOneFeed(feed, tempfile.mkdtemp(prefix='bfq_fa_'), limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        OneFeed.poll_last_time = time.time() - 2
+        OneFeed._check_prereqs()
+        assert OneFeed.poll_good            # would wait 300 seconds if fixed
+        OneFeed.poll_interval.update(False)
+        OneFeed.poll_interval.update(False)
+        OneFeed._check_prereqs()
+        assert not OneFeed.poll_good
+        OneFeed.close()
+
+
+
+class TestWriteBlocks(object):
+
+    def test_one_request_at_a_time(self):
+        class FakeFile(object):
+            def __init__(self):
+                self.writes = []
+            def write(self, data):
+                self.writes.append(bytes(data))
+        data      = os.urandom(mod.SFTP_REQUEST_SIZE * 3 + 10)
+        dest_file = FakeFile()
+        mod.write_blocks(dest_file, buffer(bytearray(data)))
+        assert [len(x) for x in dest_file.writes] == [mod.SFTP_REQUEST_SIZE] * 3 + [10]
+        assert ''.join(dest_file.writes) == data
+
+
+
+class TestCrcCheck(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+        self.dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+        self.feed_audit_dir  = tempfile.mkdtemp(prefix='bfq_fa_')
+        self.source_fqfn     = _make_file(self.source_data_dir,  'good')
+        self.fn              = basename(self.source_fqfn)
+        with open(self.source_fqfn, 'rb') as f:
+            self.checksum    = hashlib.sha256(f.read()).hexdigest()
+        self.feed            = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        self.feed['dest_post_action'] = 'crccheck'
+        setup_logging()
+
+    def teardown_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def _get_feed(self):
+        return mod.HandleOneFeed(self.feed, self.feed_audit_dir, limit_total=0,
+                                 config_name=None, key_filename='id_buffalofq_rsa')
+
+    def test_crccheck(self):
+        OneFeed = self._get_feed()
+        OneFeed.run(force=True)
+        OneFeed.close()
+
+        assert len(glob.glob(pjoin(self.dest_data_dir,'good*'))) == 1
+        assert OneFeed.auditor.status['step']     == 6
+        assert OneFeed.auditor.status['result']   == 'pass'
+        assert OneFeed.auditor.status['checksum'] == self.checksum
+
+    def test_crccheck_mismatch(self):
+        OneFeed = self._get_feed()
+        OneFeed.run(force=True)
+        (transport, sftp) = OneFeed.connections.get()
+        assert mod.task_verify_dest_checksum(sftp, pjoin(self.dest_data_dir, self.fn),
+                                             'sha256', self.checksum) is True
+        assert mod.task_verify_dest_checksum(sftp, pjoin(self.dest_data_dir, self.fn),
+                                             'sha256', 'foo') is False
+        OneFeed.close()
+
+    def test_crccheck_without_copy_checksum(self):
+        """ Recovery at step 5 has no checksum from the copy - so the source
+            has to be read for it.
+        """
+        OneFeed = self._get_feed()
+        (transport, sftp) = OneFeed.connections.get()
+        one_file = mod.HandleOneFile(self.feed, self.fn, OneFeed.auditor, sftp)
+        assert one_file._copy_file() is True
+        assert one_file._rename_dest_file() is True
+        assert one_file.checksum == self.checksum
+
+        one_file = mod.HandleOneFile(self.feed, self.fn, OneFeed.auditor, sftp)
+        assert 'checksum' not in OneFeed.auditor.status
+        assert one_file._do_dest_post_actions() is True
+        OneFeed.close()
+
+
+
+class TestResumeCopy(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+        self.dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+        self.feed_audit_dir  = tempfile.mkdtemp(prefix='bfq_fa_')
+        self.fn              = 'good_big.dat'
+        self.data            = os.urandom(300000)
+        with open(pjoin(self.source_data_dir, self.fn), 'wb') as f:
+            f.write(self.data)
+        self.feed            = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        setup_logging()
+
+    def teardown_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def _run_after_crash(self, partial_data):
+        """ Leaves the feed as if it had crashed part way through the copy,
+            then runs it again.
+        """
+        with open(pjoin(self.dest_data_dir, self.fn + '.temp'), 'wb') as f:
+            f.write(partial_data)
+        OneFeed = mod.HandleOneFeed(self.feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        OneFeed.auditor.write(step=3, status='start', fn=self.fn)
+        OneFeed.run(force=True)
+        OneFeed.close()
+        assert OneFeed.auditor.status['step']   == 6
+        assert OneFeed.auditor.status['result'] == 'pass'
+        assert not exists(pjoin(self.dest_data_dir, self.fn + '.temp'))
+        with open(pjoin(self.dest_data_dir, self.fn), 'rb') as f:
+            return f.read()
+
+    def test_resume(self):
+        # the start of the partial file is changed to confirm that it isn't
+        # sent again - only its tail is checked:
+        partial_data = 'x' * 10 + self.data[10:200000]
+        assert self._run_after_crash(partial_data) == partial_data + self.data[200000:]
+
+    def test_restart_on_mismatch(self):
+        partial_data = self.data[:199990] + 'x' * 10
+        assert self._run_after_crash(partial_data) == self.data
+
+    def test_restart_on_oversize(self):
+        partial_data = self.data + 'x' * 10
+        assert self._run_after_crash(partial_data) == self.data
+
+
+
+class TestBundles(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+        self.source_arc_dir  = tempfile.mkdtemp(prefix='bfq_sa_')
+        self.dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+        self.dest_link_dir   = tempfile.mkdtemp(prefix='bfq_dl_')
+        self.feed_audit_dir  = tempfile.mkdtemp(prefix='bfq_fa_')
+        for i in range(10):
+            _make_file(self.source_data_dir,  'good')
+        _make_file(self.source_data_dir,  'bad')
+        self.feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        self.feed['bundle_max_files']   = 4
+        self.feed['source_post_dir']    = self.source_arc_dir
+        self.feed['source_post_action'] = 'move'
+        setup_logging()
+
+    def teardown_method(self, method):
+        mod.FAIL_STEP    = -1
+        mod.FAIL_SUBSTEP = -1
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def _run(self, limit_total=0):
+        OneFeed = mod.HandleOneFeed(self.feed, self.feed_audit_dir, limit_total=limit_total,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        try:
+            OneFeed.run(force=True)
+        finally:
+            OneFeed.close()
+        return OneFeed
+
+    def _assert_all_moved(self):
+        assert len(glob.glob(pjoin(self.source_data_dir,'good*'))) == 0
+        assert len(glob.glob(pjoin(self.source_data_dir,'bad*')))  == 1
+        assert len(glob.glob(pjoin(self.source_arc_dir,'good*')))  == 10
+        assert len(glob.glob(pjoin(self.dest_data_dir,'good*')))   == 10
+        assert len(glob.glob(pjoin(self.dest_data_dir,'*.temp')))  == 0
+
+    def test_bundles(self):
+        self.feed['dest_post_action'] = 'symlink'
+        self.feed['dest_post_dir']    = self.dest_link_dir
+        self.feed['dest_post_fn']     = None
+        OneFeed = self._run()
+        self._assert_all_moved()
+        assert len(glob.glob(pjoin(self.dest_link_dir,'good*'))) == 10
+        assert OneFeed.file_cnt == 10
+        assert OneFeed.auditor.status['step']   == 6
+        assert OneFeed.auditor.status['result'] == 'pass'
+        assert len(OneFeed.auditor.status['members']) == 2
+        for fn in os.listdir(self.dest_data_dir):
+            with open(pjoin(self.dest_data_dir, fn)) as f1:
+                with open(pjoin(self.source_arc_dir, fn)) as f2:
+                    assert f1.read() == f2.read()
+
+    def test_bundles_move(self):
+        self.feed['dest_post_action'] = 'move'
+        self.feed['dest_post_dir']    = self.dest_link_dir
+        self.feed['dest_post_fn']     = None
+        _make_file(self.dest_link_dir, 'good')   # is replaced if names collide
+        shutil.copy(glob.glob(pjoin(self.source_data_dir, 'good*'))[0], self.dest_link_dir)
+        self._run()
+        assert len(glob.glob(pjoin(self.dest_data_dir,'good*'))) == 0
+        assert len(glob.glob(pjoin(self.dest_link_dir,'good*'))) == 11
+        assert len(glob.glob(pjoin(self.source_arc_dir,'good*'))) == 10
+
+    def test_bundles_limit_total(self):
+        OneFeed = self._run(limit_total=6)
+        assert OneFeed.file_cnt == 6
+        assert len(glob.glob(pjoin(self.dest_data_dir,'good*')))   == 6
+
+    def test_bundles_crccheck(self):
+        self.feed['dest_post_action'] = 'crccheck'
+        self._run()
+        self._assert_all_moved()
+
+    def test_bundle_recovery(self):
+        mod.FAIL_STEP    = 4
+        mod.FAIL_SUBSTEP = 'd'
+        try:
+            self._run()
+        except SystemExit:
+            pass
+        assert len(glob.glob(pjoin(self.dest_data_dir,'*.temp'))) == 0
+        assert len(glob.glob(pjoin(self.source_data_dir,'good*'))) == 10
+
+        mod.FAIL_STEP    = -1
+        mod.FAIL_SUBSTEP = -1
+        OneFeed = self._run()
+        assert OneFeed.file_cnt == 4    # recovery only handles the broken bundle
+        OneFeed = self._run()
+        self._assert_all_moved()
+
+
+
+class TestPullCopy(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+        self.source_arc_dir  = tempfile.mkdtemp(prefix='bfq_sa_')
+        self.dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+        self.dest_link_dir   = tempfile.mkdtemp(prefix='bfq_dl_')
+        self.feed_audit_dir  = tempfile.mkdtemp(prefix='bfq_fa_')
+        for i in range(6):
+            _make_file(self.source_data_dir,  'good')
+        _make_file(self.source_data_dir,  'bad')
+        os.mkdir(pjoin(self.source_data_dir, 'good_dir'))   # not a file - ignored
+        self.feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        self.feed['direction']          = 'pull'
+        self.feed['source_post_dir']    = self.source_arc_dir
+        self.feed['source_post_action'] = 'move'
+        setup_logging()
+
+    def teardown_method(self, method):
+        mod.FAIL_STEP    = -1
+        mod.FAIL_SUBSTEP = -1
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def _run(self, limit_total=0):
+        OneFeed = mod.HandleOneFeed(self.feed, self.feed_audit_dir, limit_total=limit_total,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        try:
+            OneFeed.run(force=True)
+        finally:
+            OneFeed.close()
+        return OneFeed
+
+    def _assert_all_moved(self):
+        assert len(glob.glob(pjoin(self.source_data_dir,'good_*.dat'))) == 0
+        assert len(glob.glob(pjoin(self.source_data_dir,'bad*')))       == 1
+        assert len(glob.glob(pjoin(self.source_arc_dir,'good*')))       == 6
+        assert len(glob.glob(pjoin(self.dest_data_dir,'good*')))        == 6
+        assert len(glob.glob(pjoin(self.dest_data_dir,'*.temp')))       == 0
+        for fn in os.listdir(self.dest_data_dir):
+            with open(pjoin(self.dest_data_dir, fn)) as f1:
+                with open(pjoin(self.source_arc_dir, fn)) as f2:
+                    assert f1.read() == f2.read()
+
+    def test_pull(self):
+        OneFeed = self._run()
+        self._assert_all_moved()
+        assert OneFeed.file_cnt == 6
+        assert OneFeed.file_class is mod.PullOneFile
+
+    def test_pull_parallel_crccheck(self):
+        self.feed['max_workers']      = 3
+        self.feed['dest_post_action'] = 'crccheck'
+        self._run()
+        self._assert_all_moved()
+
+    def test_pull_symlink_and_delete(self):
+        self.feed['source_post_action'] = 'delete'
+        self.feed['dest_post_action']   = 'symlink'
+        self.feed['dest_post_dir']      = self.dest_link_dir
+        self.feed['dest_post_fn']       = None
+        self._run(limit_total=4)
+        assert len(glob.glob(pjoin(self.source_data_dir,'good_*.dat'))) == 2
+        assert len(glob.glob(pjoin(self.dest_data_dir,'good*')))        == 4
+        assert len(glob.glob(pjoin(self.dest_link_dir,'good*')))        == 4
+        assert len(glob.glob(pjoin(self.source_arc_dir,'good*')))       == 0
+
+    def test_pull_recovery(self):
+        mod.FAIL_STEP    = 3
+        mod.FAIL_SUBSTEP = 'd'
+        try:
+            self._run()
+        except SystemExit:
+            pass
+        assert len(glob.glob(pjoin(self.dest_data_dir,'*.temp'))) == 1
+
+        mod.FAIL_STEP    = -1
+        mod.FAIL_SUBSTEP = -1
+        OneFeed = self._run()
+        assert OneFeed.file_cnt == 1    # recovery only handles the broken file
+        self._run()
+        self._assert_all_moved()
+
+
+
+class TestLocalTransport(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+        self.source_arc_dir  = tempfile.mkdtemp(prefix='bfq_sa_')
+        self.dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+        self.dest_post_dir   = tempfile.mkdtemp(prefix='bfq_dl_')
+        self.feed_audit_dir  = tempfile.mkdtemp(prefix='bfq_fa_')
+        for i in range(4):
+            _make_file(self.source_data_dir, 'good')
+        self.feed = _make_default_feed(self.source_data_dir, self.dest_data_dir)
+        self.feed['transport']          = 'local'
+        self.feed['source_post_dir']    = self.source_arc_dir
+        self.feed['source_post_action'] = 'move'
+        setup_logging()
+
+    def teardown_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def _run(self, monkeypatch):
+        def no_ssh(*args, **kwargs):
+            raise AssertionError('the local transport must not connect over ssh')
+        monkeypatch.setattr(mod.paramiko, 'Transport', no_ssh)
+        OneFeed = mod.HandleOneFeed(self.feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        try:
+            OneFeed.run(force=True)
+        finally:
+            OneFeed.close()
+        assert OneFeed.file_cnt == 4
+        return OneFeed
+
+    def _assert_all_moved(self, dest_dir):
+        assert not os.listdir(self.source_data_dir)
+        assert sorted(os.listdir(dest_dir)) == sorted(os.listdir(self.source_arc_dir))
+        for fn in os.listdir(dest_dir):
+            with open(pjoin(dest_dir, fn)) as f1:
+                with open(pjoin(self.source_arc_dir, fn)) as f2:
+                    assert f1.read() == f2.read()
+
+    def test_push(self, monkeypatch):
+        self._run(monkeypatch)
+        self._assert_all_moved(self.dest_data_dir)
+
+    def test_push_parallel_crccheck(self, monkeypatch):
+        self.feed['max_workers']      = 2
+        self.feed['dest_post_action'] = 'crccheck'
+        self._run(monkeypatch)
+        self._assert_all_moved(self.dest_data_dir)
+
+    def test_push_move(self, monkeypatch):
+        self.feed['dest_post_action'] = 'move'
+        self.feed['dest_post_dir']    = self.dest_post_dir
+        self.feed['dest_post_fn']     = None
+        self._run(monkeypatch)
+        assert not os.listdir(self.dest_data_dir)
+        self._assert_all_moved(self.dest_post_dir)
+
+    def test_pull_symlink(self, monkeypatch):
+        self.feed['direction']        = 'pull'
+        self.feed['dest_post_action'] = 'symlink'
+        self.feed['dest_post_dir']    = self.dest_post_dir
+        self.feed['dest_post_fn']     = None
+        self._run(monkeypatch)
+        self._assert_all_moved(self.dest_data_dir)
+        assert len(os.listdir(self.dest_post_dir)) == 4
+
+    def test_auto(self):
+        self.feed['transport'] = 'auto'
+        OneFeed = mod.HandleOneFeed(self.feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        assert OneFeed.local                # localhost & our own user
+        OneFeed.close()
+
+
+
+class TestFanOut(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+        self.source_arc_dir  = tempfile.mkdtemp(prefix='bfq_sa_')
+        self.dest_a_dir      = tempfile.mkdtemp(prefix='bfq_dd_')
+        self.dest_b_dir      = tempfile.mkdtemp(prefix='bfq_dd_')
+        self.dest_link_dir   = tempfile.mkdtemp(prefix='bfq_dl_')
+        self.feed_audit_dir  = tempfile.mkdtemp(prefix='bfq_fa_')
+        for i in range(4):
+            _make_file(self.source_data_dir,  'good')
+        self.feed = _make_default_feed(self.source_data_dir, self.dest_a_dir)
+        self.feed['source_post_dir']    = self.source_arc_dir
+        self.feed['source_post_action'] = 'move'
+        self.feed['dest_post_action']   = 'crccheck'
+        self.feed['destinations']       = [{'name': 'a'},
+                                           {'name': 'b', 'dest_dir': self.dest_b_dir,
+                                            'dest_post_action': 'symlink',
+                                            'dest_post_dir': self.dest_link_dir,
+                                            'dest_post_fn': None}]
+        setup_logging()
+
+    def teardown_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def _run(self):
+        OneFeed = mod.HandleOneFeed(self.feed, self.feed_audit_dir, limit_total=0,
+                                    config_name=None, key_filename='id_buffalofq_rsa')
+        try:
+            OneFeed.run(force=True)
+        finally:
+            OneFeed.close()
+        return OneFeed
+
+    def _assert_moved(self, dir_name, cnt):
+        assert len(glob.glob(pjoin(dir_name, 'good*')))   == cnt
+        assert len(glob.glob(pjoin(dir_name, '*.temp')))  == 0
+        for fn in os.listdir(dir_name):
+            with open(pjoin(dir_name, fn)) as f1:
+                with open(pjoin(self.source_arc_dir, fn)) as f2:
+                    assert f1.read() == f2.read()
+
+    def test_fan_out(self):
+        OneFeed = self._run()
+        assert OneFeed.file_cnt == 4
+        assert len(glob.glob(pjoin(self.source_data_dir, 'good*'))) == 0
+        self._assert_moved(self.dest_a_dir, 4)
+        self._assert_moved(self.dest_b_dir, 4)
+        assert len(glob.glob(pjoin(self.dest_link_dir, 'good*'))) == 4
+        for dest in ('a', 'b'):
+            assert OneFeed.auditor.dest_auditor(dest).status['step'] == 6
+
+    def test_failed_dest_does_not_block_others(self):
+        os.rmdir(self.dest_b_dir)      # b's copies will fail
+        OneFeed = self._run()
+        assert OneFeed.file_cnt == 0                        # none can leave the source yet
+        source_fns = sorted(os.listdir(self.source_data_dir))
+        assert sorted(os.listdir(self.dest_a_dir)) == source_fns   # a still got every file
+        assert OneFeed.auditor.dest_auditor('a').status['delivered'] == source_fns
+        assert not mod.bfq_auditor.is_complete(OneFeed.auditor.dest_auditor('b').status)
+
+        # a later poll sends nothing more to a - b only catches up once back:
+        a_mtimes = dict((x, os.path.getmtime(pjoin(self.dest_a_dir, x))) for x in source_fns)
+        OneFeed = self._run()
+        assert OneFeed.file_cnt == 0
+        assert len(os.listdir(self.source_data_dir)) == 4
+        os.mkdir(self.dest_b_dir)
+        OneFeed = self._run()
+        assert OneFeed.file_cnt == 4
+        assert not os.listdir(self.source_data_dir)
+        assert sorted(os.listdir(self.dest_b_dir)) == source_fns
+        assert a_mtimes == dict((x, os.path.getmtime(pjoin(self.dest_a_dir, x))) for x in source_fns)
+        self._assert_moved(self.dest_a_dir, 4)
+        self._assert_moved(self.dest_b_dir, 4)
+        for dest in ('a', 'b'):
+            assert OneFeed.auditor.dest_auditor(dest).status['delivered'] == []
+
+    def test_delivered_file_gone_from_source(self):
+        """ A held file removed from the source isn't taken as delivered when
+            a new one of the same name arrives.
+        """
+        os.rmdir(self.dest_b_dir)
+        self._run()
+        fn = sorted(os.listdir(self.source_data_dir))[0]
+        os.remove(pjoin(self.source_data_dir, fn))
+        self._run()
+        with open(pjoin(self.source_data_dir, fn), 'w') as f:
+            f.write('new content\n')
+        os.mkdir(self.dest_b_dir)
+        self._run()
+        assert not os.listdir(self.source_data_dir)
+        for dir_name in (self.dest_a_dir, self.dest_b_dir):
+            with open(pjoin(dir_name, fn)) as f:
+                assert f.read() == 'new content\n'
+
+    def test_recovery_after_dests_finished(self):
+        """ A run that stops after the destinations finish, but before the
+            source post actions, sends the file again to neither.
+        """
+        (mod.FAIL_STEP, mod.FAIL_SUBSTEP) = (6, 'a')
+        try:
+            with pytest.raises(SystemExit):
+                self._run()
+        finally:
+            (mod.FAIL_STEP, mod.FAIL_SUBSTEP) = (-1, -1)
+        fn      = sorted(os.listdir(self.dest_a_dir))[0]
+        a_mtime = os.path.getmtime(pjoin(self.dest_a_dir, fn))
+        OneFeed = self._run()
+        assert OneFeed.file_cnt == 1                          # the recovered file alone
+        assert os.path.getmtime(pjoin(self.dest_a_dir, fn)) == a_mtime
+        self._run()
+        self._assert_moved(self.dest_a_dir, 4)
+        self._assert_moved(self.dest_b_dir, 4)
+
+    def test_chunk_stream_detaches_slow_consumer(self):
+        fqfn   = _make_file(self.source_data_dir, 'stream')
+        stream = mod.ChunkStream(fqfn, buffer_size=4, max_blocks=2,
+                                 hasher=hashlib.new('md5'))
+        fast   = stream.add_consumer()
+        slow   = stream.add_consumer()
+        fast_data = []
+        thread = threading.Thread(target=lambda: fast_data.extend(fast.chunks()))
+        thread.start()
+        stream.run()      # slow isn't reading yet, so is detached
+        thread.join()
+        with open(fqfn) as f:
+            source_data = f.read()
+        assert ''.join(fast_data)      == source_data
+        assert ''.join(slow.chunks())  == source_data
+        assert stream.checksum == hashlib.md5(source_data).hexdigest()
+
+    def test_chunk_stream_waits_for_uniformly_slow_consumers(self, monkeypatch):
+        fqfn   = _make_file(self.source_data_dir, 'stream')
+        opened = []
+        def counting_open(*args):
+            opened.append(args[0])
+            return open(*args)
+        monkeypatch.setattr(mod, 'open', counting_open, raising=False)
+        stream    = mod.ChunkStream(fqfn, buffer_size=4, max_blocks=2)
+        consumers = [stream.add_consumer() for i in range(3)]
+        results   = [[] for x in consumers]
+        def read_slowly(consumer, result):
+            for data in consumer.chunks():
+                time.sleep(0.02)
+                result.append(data)
+        threads = [threading.Thread(target=read_slowly, args=x) for x in zip(consumers, results)]
+        for thread in threads:
+            thread.start()
+        stream.run()      # none falls behind the others, so none is detached
+        for thread in threads:
+            thread.join()
+        with open(fqfn) as f:
+            source_data = f.read()
+        assert [''.join(x) for x in results] == [source_data] * 3
+        assert opened == [fqfn]                       # the source was read just once
+
+
+
 class TestTaskRecovery(object):
 
+    audit_backend = 'json'
+
     def setup_method(self, method):
         setup_logging()
         test_tools.remove_all_buffalofq_temp_dirs()
@@ -318,6 +1319,7 @@ class TestTaskRecovery(object):
                                        self.dirs['dest_data']['name'])
         self.feed['source_post_dir']    = self.dirs['source_arc']['name']
         self.feed['source_post_action'] = 'move'
+        self.feed['audit_backend']      = self.audit_backend
 
         mod.FAIL_STEP    = failstep
         mod.FAIL_SUBSTEP = failsubstep
@@ -589,6 +1591,12 @@ class TestTaskRecovery(object):
 
 
 
+class TestTaskRecoveryJournal(TestTaskRecovery):
+    """ Runs all recovery tests against the journal audit backend.
+    """
+    audit_backend = 'journal'
+
+
 
 def _make_default_feed(source_data_dir, dest_data_dir):
     feed = {}
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import sys, os
+import errno
+import getpass
+import tempfile
+from os.path import join as pjoin
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import bfq_test_tools  as test_tools
+import buffalofq.bfq_connection as mod
+import buffalofq.bfq_sftp_server as bfq_sftp_server
+
+DEST_USER = getpass.getuser()
+
+
+
+class TestConnectionManager(object):
+
+    def setup_method(self, method):
+        self.connections = mod.ConnectionManager('localhost', 22, DEST_USER,
+                                                 'id_buffalofq_rsa',
+                                                 keepalive_seconds=30)
+
+    def teardown_method(self, method):
+        self.connections.close()
+
+    def test_key_cache(self):
+        assert mod.get_key('id_buffalofq_rsa') is mod.get_key('id_buffalofq_rsa')
+
+    def test_reuse_across_gets(self):
+        (transport1, sftp1) = self.connections.get()
+        (transport2, sftp2) = self.connections.get()
+        assert transport1 is transport2
+        assert sftp1 is sftp2
+        assert self.connections.connect_cnt == 1
+
+    def test_reconnect_after_dead_session(self):
+        (transport1, sftp1) = self.connections.get()
+        transport1.close()
+        assert not self.connections.is_alive()
+        (transport2, sftp2) = self.connections.get()
+        assert transport2 is not transport1
+        assert transport2.is_active()
+        assert self.connections.connect_cnt == 2
+
+    def test_close(self):
+        self.connections.get()
+        self.connections.close()
+        assert self.connections.transport is None
+        assert not self.connections.is_alive()
+
+
+
+class TestConnectionPool(object):
+
+    def setup_method(self, method):
+        self.pool = mod.ConnectionPool()
+
+    def teardown_method(self, method):
+        self.pool.close()
+
+    def test_shared_transport(self):
+        feed1 = self.pool.get_connections('localhost', 22, DEST_USER, 'id_buffalofq_rsa')
+        feed2 = self.pool.get_connections('localhost', 22, DEST_USER, 'id_buffalofq_rsa')
+        (transport1, sftp1) = feed1.get()
+        (transport2, sftp2) = feed2.get()
+        assert transport1 is transport2
+        assert sftp1 is not sftp2               # each feed has its own channel
+        assert feed1.get() == (transport1, sftp1)
+        assert self.pool.transport_cnt() == 1
+        assert feed1.connect_cnt == 1
+
+        feed1.close()                           # just its channel
+        assert transport2.is_active()
+        assert sftp2.normalize('.')
+
+    def test_reopens_after_reconnect(self):
+        feed = self.pool.get_connections('localhost', 22, DEST_USER, 'id_buffalofq_rsa')
+        (transport1, sftp1) = feed.get()
+        transport1.close()
+        (transport2, sftp2) = feed.get()
+        assert transport2 is not transport1
+        assert sftp2 is not sftp1
+        assert sftp2.normalize('.')
+
+
+
+class TestSFTPBatch(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.dest_dir = tempfile.mkdtemp(prefix='bfq_dd_')
+        key           = mod.get_key('id_buffalofq_rsa')
+        self.server   = bfq_sftp_server.LoopbackSFTPServer(key).start()
+        self.connections = mod.ConnectionManager('127.0.0.1', self.server.port, DEST_USER,
+                                                 'id_buffalofq_rsa')
+        (_, self.sftp) = self.connections.get()
+        for fn in ['a', 'b', 'c']:
+            with open(pjoin(self.dest_dir, fn), 'w') as f:
+                f.write(fn)
+
+    def teardown_method(self, method):
+        self.connections.close()
+        self.server.close()
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def test_pipelined_results_in_order(self):
+        batch = mod.SFTPBatch(self.sftp)
+        batch.remove(pjoin(self.dest_dir, 'missing'))
+        batch.rename(pjoin(self.dest_dir, 'a'), pjoin(self.dest_dir, 'a2'))
+        batch.rename(pjoin(self.dest_dir, 'b'), pjoin(self.dest_dir, 'c'))
+        batch.symlink(pjoin(self.dest_dir, 'c'), pjoin(self.dest_dir, 'c_link'))
+        results = batch.wait()
+        assert results[0].errno == errno.ENOENT
+        assert results[1] is None
+        assert isinstance(results[2], IOError)   # sftp rename won't overwrite
+        assert results[3] is None
+        assert sorted(os.listdir(self.dest_dir)) == ['a2', 'b', 'c', 'c_link']
+        assert batch.wait() == []
+
+    def test_posix_rename(self):
+        batch = mod.SFTPBatch(self.sftp)
+        batch.posix_rename(pjoin(self.dest_dir, 'b'), pjoin(self.dest_dir, 'c'))
+        assert batch.wait() == [None]
+        assert sorted(os.listdir(self.dest_dir)) == ['a', 'c']
+        with open(pjoin(self.dest_dir, 'c')) as f:
+            assert f.read() == 'b'
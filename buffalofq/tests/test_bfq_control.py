@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import sys, os
+import time
+import glob
+import socket
+import tempfile
+import threading
+from os.path import join as pjoin
+
+import pytest
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import bfq_test_tools  as test_tools
+import test_bfq_buffguts
+import buffalofq.bfq_orchestrator as bfq_orchestrator
+import buffalofq.bfq_control      as mod
+
+
+
+class TestControlServer(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        test_bfq_buffguts.setup_logging()
+        self.audit_dir   = tempfile.mkdtemp(prefix='bfq_fa_')
+        self.socket_fqfn = pjoin(self.audit_dir, 'mover.sock')
+        feed_configs     = []
+        self.feeds       = []
+        for i in range(2):
+            source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+            dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+            test_bfq_buffguts._make_file(source_data_dir, 'good')
+            feed = test_bfq_buffguts._make_default_feed(source_data_dir, dest_data_dir)
+            feed['name']            = 'feed%d' % i
+            feed['polling_seconds'] = 3600     # only a poll command gets a second pass
+            self.feeds.append(feed)
+            feed_configs.append({'feed':         feed,
+                                 'audit_dir':    self.audit_dir,
+                                 'config_name':  feed['name'],
+                                 'key_filename': 'id_buffalofq_rsa'})
+        self.orchestrator = bfq_orchestrator.FeedOrchestrator(feed_configs, limit_total=-1)
+        self.control      = mod.ControlServer(self.socket_fqfn, self.orchestrator)
+        self.runner       = threading.Thread(target=self.orchestrator.run)
+
+    def teardown_method(self, method):
+        self.orchestrator.stop()
+        if self.runner.is_alive():
+            self.runner.join()
+        self.control.close()
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def _moved_cnt(self, feed):
+        return len(glob.glob(pjoin(feed['dest_dir'], 'good*')))
+
+    def _wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline and not condition():
+            time.sleep(0.05)
+        return condition()
+
+    def test_commands(self):
+        self.control.start()
+        assert oct(os.stat(self.socket_fqfn).st_mode & 0o777) == oct(0o600)
+        self.runner.start()
+        assert self._wait_for(lambda: [self._moved_cnt(x) for x in self.feeds] == [1, 1])
+        assert self._wait_for(lambda: all(x['state'] == 'waiting' for x in
+                                          mod.send_command(self.socket_fqfn, 'status')['feeds'].values()))
+
+        # a new file waits for the next poll - unless one is asked for:
+        test_bfq_buffguts._make_file(self.feeds[0]['source_dir'], 'good')
+        time.sleep(0.5)
+        assert self._moved_cnt(self.feeds[0]) == 1
+        assert mod.send_command(self.socket_fqfn, 'poll feed0') == {'ok': True, 'feeds': ['feed0']}
+        assert self._wait_for(lambda: self._moved_cnt(self.feeds[0]) == 2)
+
+        # a paused feed doesn't poll until resumed:
+        assert mod.send_command(self.socket_fqfn, 'pause feed1') == {'ok': True}
+        test_bfq_buffguts._make_file(self.feeds[1]['source_dir'], 'good')
+        mod.send_command(self.socket_fqfn, 'poll')
+        time.sleep(0.5)
+        assert self._moved_cnt(self.feeds[1]) == 1
+        status = mod.send_command(self.socket_fqfn, 'status')
+        assert status['feeds']['feed1']['state'] == 'paused'
+        assert status['feeds']['feed1']['files'] == 1
+        assert not status['draining']
+        assert mod.send_command(self.socket_fqfn, 'resume feed1') == {'ok': True}
+        assert self._wait_for(lambda: self._moved_cnt(self.feeds[1]) == 2)
+
+        assert mod.send_command(self.socket_fqfn, 'drain') == {'ok': True}
+        self.runner.join(10)
+        assert not self.runner.is_alive()
+
+    def test_bad_commands(self):
+        assert not self.control.handle('')['ok']
+        assert not self.control.handle('launch feed0')['ok']
+        assert not self.control.handle('pause')['ok']
+        assert self.control.handle('pause nosuchfeed') == {'ok': False, 'error': 'no such feed: nosuchfeed'}
+        self.orchestrator.close()
+
+    def test_invalid_bytes(self):
+        self.control.start()
+        reply = mod.send_command(self.socket_fqfn, 'launch \xff\xfe')
+        assert reply == {'ok': False, 'error': u'invalid command: launch \ufffd\ufffd'}
+        reply = mod.send_command(self.socket_fqfn, 'pause \xff')
+        assert reply == {'ok': False, 'error': u'no such feed: \ufffd'}
+        assert mod.send_command(self.socket_fqfn, 'status')['ok']
+        self.orchestrator.close()
+
+    def test_failed_command(self, monkeypatch):
+        self.control.start()
+        monkeypatch.setattr(self.orchestrator, 'status', lambda: 1 // 0)
+        assert not mod.send_command(self.socket_fqfn, 'status')['ok']
+        monkeypatch.undo()
+        assert mod.send_command(self.socket_fqfn, 'status')['ok']
+        self.orchestrator.close()
+
+    def test_socket_in_use(self):
+        self.control.start()
+        with pytest.raises(socket.error):
+            mod.ControlServer(self.socket_fqfn, self.orchestrator).start()
+        self.control.close()
+        assert not os.path.exists(self.socket_fqfn)
+        self.orchestrator.close()
+
+    def test_stale_socket_is_replaced(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_fqfn)
+        stale.close()                      # leaves the file behind, as a killed mover would
+        self.control.start()
+        assert mod.send_command(self.socket_fqfn, 'status')['ok']
+        self.orchestrator.close()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import sys, os
+import time
+import shutil
+import sqlite3
+import tempfile
+from os.path import join as pjoin
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import buffalofq.bfq_dedup as mod
+
+
+
+class TestDedupIndex(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp(prefix='bfq_dx_')
+        self.fqfn     = pjoin(self.temp_dir, 'dedup.sqlite')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def test_find(self):
+        index = mod.DedupIndex(self.fqfn)
+        index.add('dw', 'sha256:abc', 10, '/data/a.csv', 100.0)
+        assert index.has_size('dw', 10)
+        assert not index.has_size('dw', 11)
+        assert not index.has_size('other', 10)      # per destination
+        assert index.find('dw', 'sha256:abc') == ('/data/a.csv', 10, 100.0)
+        assert index.find('dw', 'sha256:xyz') is None
+        index.remove('dw', 'sha256:abc')
+        assert index.find('dw', 'sha256:abc') is None
+        index.close()
+
+    def test_path_overwritten(self):
+        index = mod.DedupIndex(self.fqfn)
+        index.add('dw', 'sha256:aaa', 4, '/data/data.csv', 100.0)
+        index.add('other', 'sha256:aaa', 4, '/data/data.csv', 100.0)
+        index.add('dw', 'sha256:bbb', 4, '/data/data.csv', 200.0)
+        assert index.find('dw', 'sha256:aaa') is None        # that content is no longer there
+        assert index.find('dw', 'sha256:bbb') == ('/data/data.csv', 4, 200.0)
+        assert index.find('other', 'sha256:aaa') == ('/data/data.csv', 4, 100.0)
+        index.close()
+
+    def test_index_without_mtimes(self):
+        db = sqlite3.connect(self.fqfn)
+        db.execute('CREATE TABLE delivered '
+                   '(dest TEXT NOT NULL, checksum TEXT NOT NULL, size INTEGER NOT NULL, '
+                   ' fqfn TEXT NOT NULL, time REAL NOT NULL, PRIMARY KEY (dest, checksum))')
+        db.execute("INSERT INTO delivered VALUES ('dw', 'sha256:abc', 10, '/data/a.csv', ?)",
+                   (time.time(),))
+        db.commit()
+        db.close()
+        index = mod.DedupIndex(self.fqfn)
+        assert index.find('dw', 'sha256:abc') == ('/data/a.csv', 10, None)
+        index.close()
+
+    def test_persists(self):
+        index = mod.DedupIndex(self.fqfn)
+        index.add('dw', 'sha256:abc', 10, '/data/a.csv', 100.0)
+        index.close()
+        assert mod.DedupIndex(self.fqfn).find('dw', 'sha256:abc') == ('/data/a.csv', 10, 100.0)
+
+    def test_evict_by_count(self):
+        index = mod.DedupIndex(self.fqfn, max_entries=3)
+        for i in range(5):
+            index.add('dw', 'sha256:%d' % i, i, '/data/%d.csv' % i, 100.0)
+            time.sleep(0.01)
+        index.evict()
+        assert [index.find('dw', 'sha256:%d' % i) is not None for i in range(5)] \
+               == [False, False, True, True, True]
+
+    def test_evict_by_age(self):
+        index = mod.DedupIndex(self.fqfn, keep_days=1)
+        index.add('dw', 'sha256:old', 1, '/data/old.csv', 100.0)
+        index.add('dw', 'sha256:new', 1, '/data/new.csv', 100.0)
+        with index.db:
+            index.db.execute("UPDATE delivered SET time = time - 2 * 86400 WHERE checksum = 'sha256:old'")
+        index.evict()
+        assert index.find('dw', 'sha256:old') is None
+        assert index.find('dw', 'sha256:new') == ('/data/new.csv', 1, 100.0)
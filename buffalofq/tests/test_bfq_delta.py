@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import sys, os
+import random
+import shutil
+import hashlib
+import tempfile
+from os.path import join as pjoin
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import buffalofq.bfq_delta as mod
+
+BLOCK_SIZE = 4096
+
+
+
+class TestComputeDelta(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp(prefix='bfq_dl_')
+        rand          = random.Random(0)
+        self.old_data = ''.join(chr(rand.randint(0, 255)) for i in range(BLOCK_SIZE * 20 + 100))
+        self.old_fqfn = pjoin(self.temp_dir, 'old.dat')
+        self.new_fqfn = pjoin(self.temp_dir, 'new.dat')
+        with open(self.old_fqfn, 'wb') as f:
+            f.write(self.old_data)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def _delta(self, new_data):
+        with open(self.new_fqfn, 'wb') as f:
+            f.write(new_data)
+        signature = mod.file_signature(self.old_fqfn, BLOCK_SIZE)
+        (ops, checksum) = mod.compute_delta(self.new_fqfn, signature, 'sha256')
+        assert checksum == hashlib.sha256(new_data).hexdigest()
+        assert _rebuild(self.old_data, new_data, ops) == new_data
+        return ops
+
+    def test_signature(self):
+        signature = mod.file_signature(self.old_fqfn, BLOCK_SIZE)
+        assert signature['size']       == len(self.old_data)
+        assert signature['block_size'] == BLOCK_SIZE
+        assert len(signature['blocks']) == 20          # the partial block is left out
+
+    def test_signature_built_as_read(self):
+        # reads that split blocks, as a copy's buffer size may:
+        builder = mod.SignatureBuilder(len(self.old_data), BLOCK_SIZE)
+        for offset in range(0, len(self.old_data), 1000):
+            builder.update(buffer(self.old_data, offset, 1000))
+        assert builder.signature() == mod.file_signature(self.old_fqfn, BLOCK_SIZE)
+
+        short = mod.SignatureBuilder(len(self.old_data) + 1, BLOCK_SIZE)
+        short.update(self.old_data)
+        assert short.signature() is None             # the file changed as it was read
+
+    def test_signature_built_by_delta(self):
+        builder = mod.SignatureBuilder(len(self.old_data), BLOCK_SIZE)
+        with open(self.new_fqfn, 'wb') as f:
+            f.write(self.old_data)
+        mod.compute_delta(self.new_fqfn, mod.file_signature(self.old_fqfn, BLOCK_SIZE),
+                          'sha256', builder)
+        assert builder.signature() == mod.file_signature(self.old_fqfn, BLOCK_SIZE)
+
+    def test_unchanged(self):
+        ops = self._delta(self.old_data)
+        assert ops == [('copy', 0, 0, BLOCK_SIZE * 20), ('data', BLOCK_SIZE * 20, 100)]
+
+    def test_appended(self):
+        ops = self._delta(self.old_data + 'x' * 5000)
+        assert ops[0] == ('copy', 0, 0, BLOCK_SIZE * 20)
+        assert _data_bytes(ops) == 100 + 5000
+
+    def test_changed_in_middle(self):
+        new_data = self.old_data[:BLOCK_SIZE * 5 + 10] + 'changed' + self.old_data[BLOCK_SIZE * 5 + 17:]
+        ops      = self._delta(new_data)
+        assert mod.copy_runs(ops) == 2
+        assert _data_bytes(ops) == BLOCK_SIZE + 100
+
+    def test_inserted(self):
+        # everything after the insert shifts - the rolling checksum finds it:
+        new_data = self.old_data[:BLOCK_SIZE * 3 + 50] + 'inserted' + self.old_data[BLOCK_SIZE * 3 + 50:]
+        ops      = self._delta(new_data)
+        assert mod.copy_runs(ops) == 2
+        assert _data_bytes(ops) == BLOCK_SIZE + len('inserted') + 100
+
+    def test_unrelated(self):
+        ops = self._delta(os.urandom(len(self.old_data)))
+        assert mod.copy_runs(ops) == 0
+
+    def test_empty(self):
+        assert self._delta('') == []
+
+
+
+class TestDeltaCache(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp(prefix='bfq_dc_')
+        mod.setup_logging('__main__')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_put(self):
+        cache = mod.DeltaCache(pjoin(self.temp_dir, 'delta'))
+        assert cache.get('dw', '/data/a.csv') is None
+        cache.put('dw', '/data/a.csv', {'size': 1, 'blocks': []})
+        assert cache.get('dw', '/data/a.csv') == {'size': 1, 'blocks': []}
+        assert cache.get('other', '/data/a.csv') is None   # per destination
+        cache.put('dw', '/data/a.csv', {'size': 2, 'blocks': []})
+        assert mod.DeltaCache(pjoin(self.temp_dir, 'delta')).get('dw', '/data/a.csv')['size'] == 2
+
+
+
+def _rebuild(old_data, new_data, ops):
+    """ Applies ops locally - checking that they cover the new file in order.
+    """
+    rebuilt = []
+    for op in ops:
+        if op[0] == 'copy':
+            assert op[2] == sum(len(x) for x in rebuilt)
+            rebuilt.append(old_data[op[1]:op[1] + op[3]])
+        else:
+            assert op[1] == sum(len(x) for x in rebuilt)
+            rebuilt.append(new_data[op[1]:op[1] + op[2]])
+    return ''.join(rebuilt)
+
+
+def _data_bytes(ops):
+    return sum(op[2] for op in ops if op[0] == 'data')
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import sys, os
+import time
+import json
+import tempfile
+from os.path import join as pjoin
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import bfq_test_tools  as test_tools
+import buffalofq.bfq_metrics as mod
+
+
+
+class TestHistogram(object):
+
+    def test_empty(self):
+        hist = mod.Histogram()
+        assert hist.quantile(0.5) is None
+        assert hist.summary()['p99'] is None
+
+    def test_quantiles(self):
+        hist = mod.Histogram()
+        for x in range(1, 1001):
+            hist.observe(x / 1000.0)
+        assert hist.count == 1000
+        assert abs(hist.sum - 500.5) < 0.001
+        # estimates are within a bucket's width (~19%) of the actual:
+        assert abs(hist.quantile(0.5)  - 0.5)  < 0.5  * 0.19
+        assert abs(hist.quantile(0.95) - 0.95) < 0.95 * 0.19
+        assert abs(hist.quantile(0.99) - 0.99) < 0.99 * 0.19
+        assert hist.quantile(1.0) == 1.0
+
+    def test_out_of_range_values(self):
+        hist = mod.Histogram()
+        hist.observe(0)
+        hist.observe(mod.BUCKET_MAX * 2)
+        assert hist.quantile(0.5) <= mod.BUCKET_MIN
+        assert hist.quantile(1.0) == mod.BUCKET_MAX * 2
+
+
+
+class TestFeedMetrics(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.metrics_dir = tempfile.mkdtemp(prefix='bfq_md_')
+
+    def teardown_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def test_timer(self):
+        metrics = mod.FeedMetrics('feed1')
+        with metrics.timer('step_3_copy'):
+            time.sleep(0.01)
+        try:
+            with metrics.timer('step_3_copy'):
+                raise ValueError('failed copy')
+        except ValueError:
+            pass
+        summary = metrics.summary()
+        assert summary['step_3_copy']['count'] == 2
+        assert summary['step_3_copy']['max'] >= 0.01
+        metrics.write()  # no file - nothing happens
+
+    def test_prometheus_file(self):
+        metrics_file = pjoin(self.metrics_dir, 'bfq.prom')
+        metrics = mod.FeedMetrics('feed1', metrics_file=metrics_file)
+        metrics.observe('step_3_copy', 0.5)
+        metrics.observe('audit_write', 0.001)
+        metrics.write()
+        with open(metrics_file) as f:
+            lines = f.read().splitlines()
+        assert '# TYPE buffalofq_operation_seconds summary' in lines
+        assert 'buffalofq_operation_seconds_count{feed="feed1",operation="step_3_copy"} 1' in lines
+        assert 'buffalofq_operation_seconds_sum{feed="feed1",operation="step_3_copy"} 0.5' in lines
+        assert [x for x in lines
+                if x.startswith('buffalofq_operation_seconds{feed="feed1",operation="audit_write",quantile="0.99"}')]
+        assert os.listdir(self.metrics_dir) == ['bfq.prom']
+        assert oct(os.stat(metrics_file).st_mode & 0o777) == oct(0o644)
+
+    def test_periodic_json_rewrite(self):
+        metrics_file = pjoin(self.metrics_dir, 'bfq.json')
+        metrics = mod.FeedMetrics('feed1', metrics_file=metrics_file,
+                                  metrics_format='json', write_seconds=0)
+        metrics.observe('step_1_source_pre', 0.1)
+        with open(metrics_file) as f:
+            assert json.load(f)['operations']['step_1_source_pre']['count'] == 1
+        metrics.observe('step_1_source_pre', 0.1)
+        with open(metrics_file) as f:
+            results = json.load(f)
+        assert results['feed'] == 'feed1'
+        assert results['operations']['step_1_source_pre']['count'] == 2
+
+    def test_not_yet_time_to_rewrite(self):
+        metrics_file = pjoin(self.metrics_dir, 'bfq.json')
+        metrics = mod.FeedMetrics('feed1', metrics_file=metrics_file,
+                                  metrics_format='json', write_seconds=60)
+        metrics.observe('step_1_source_pre', 0.1)
+        assert not os.path.exists(metrics_file)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import sys, os
+import time
+import glob
+import tempfile
+import threading
+from os.path import join as pjoin
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import bfq_test_tools  as test_tools
+import test_bfq_buffguts
+import buffalofq.bfq_orchestrator as mod
+
+
+
+class TestFeedOrchestrator(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        test_bfq_buffguts.setup_logging()
+        self.audit_dir = tempfile.mkdtemp(prefix='bfq_fa_')
+        self.feeds     = []
+        for i in range(3):
+            source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+            dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+            for j in range(2):
+                test_bfq_buffguts._make_file(source_data_dir, 'good')
+            feed = test_bfq_buffguts._make_default_feed(source_data_dir, dest_data_dir)
+            feed['name'] = 'feed%d' % i
+            self.feeds.append(feed)
+
+    def teardown_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def _feed_configs(self):
+        return [{'feed':         x,
+                 'audit_dir':    self.audit_dir,
+                 'config_name':  x['name'],
+                 'key_filename': 'id_buffalofq_rsa'} for x in self.feeds]
+
+    def _moved_cnt(self, feed):
+        return len(glob.glob(pjoin(feed['dest_dir'], 'good*')))
+
+    def test_run_once(self):
+        orchestrator = mod.FeedOrchestrator(self._feed_configs(), limit_total=0,
+                                            force=True, max_threads=2)
+        assert orchestrator.pool.transport_cnt() == 1    # all feeds go to the same dest
+        orchestrator.run()
+        assert [self._moved_cnt(x) for x in self.feeds] == [2, 2, 2]
+        assert [x.handler.connections.connect_cnt for x in orchestrator.runners] == [1, 1, 1]
+        assert orchestrator.summary()['feed1'] == {'runs': 1, 'errors': 0, 'files': 2}
+
+    def test_failed_feed_is_isolated(self):
+        orchestrator = mod.FeedOrchestrator(self._feed_configs(), limit_total=0,
+                                            force=True, max_threads=1)
+        def broken(force):
+            raise RuntimeError('feed1 is broken')
+        orchestrator.runners[1].handler.run_once = broken
+        orchestrator.run()
+        assert [self._moved_cnt(x) for x in self.feeds] == [2, 0, 2]
+        assert orchestrator.summary()['feed1'] == {'runs': 1, 'errors': 1, 'files': 0}
+
+    def test_unusable_feed_is_left_out(self):
+        del self.feeds[1]['polling_seconds']
+        orchestrator = mod.FeedOrchestrator(self._feed_configs(), limit_total=0, force=True)
+        assert [x.name for x in orchestrator.runners] == ['feed0', 'feed2']
+        orchestrator.close()
+
+    def test_each_feed_keeps_its_limit(self):
+        """ Without an override each feed runs as its own limit_total says -
+            whatever order the feeds are listed in.
+        """
+        for (feed, limit_total) in zip(self.feeds, [1, -1, 0]):
+            feed['limit_total']     = limit_total
+            feed['polling_seconds'] = 0.1
+        orchestrator = mod.FeedOrchestrator(self._feed_configs(), force=True, max_threads=2)
+        runner = threading.Thread(target=orchestrator.run)
+        runner.start()
+        try:
+            deadline = time.time() + 10
+            while time.time() < deadline and not (orchestrator.runners[0].done
+                                                  and orchestrator.runners[2].done):
+                time.sleep(0.1)
+            assert not orchestrator.runners[1].done          # runs until stopped
+        finally:
+            orchestrator.stop()
+            runner.join()
+        assert [self._moved_cnt(x) for x in self.feeds] == [1, 2, 2]
+
+    def test_continuous(self):
+        for feed in self.feeds:
+            feed['polling_seconds'] = 0.1
+        orchestrator = mod.FeedOrchestrator(self._feed_configs(), limit_total=-1, max_threads=2)
+        runner = threading.Thread(target=orchestrator.run)
+        runner.start()
+        try:
+            deadline = time.time() + 10
+            while time.time() < deadline and [self._moved_cnt(x) for x in self.feeds] != [2, 2, 2]:
+                time.sleep(0.1)
+            # a file arriving later is picked up on a later poll:
+            test_bfq_buffguts._make_file(self.feeds[0]['source_dir'], 'good')
+            while time.time() < deadline and self._moved_cnt(self.feeds[0]) != 3:
+                time.sleep(0.1)
+        finally:
+            orchestrator.stop()
+            runner.join()
+        assert [self._moved_cnt(x) for x in self.feeds] == [3, 2, 2]
+        assert orchestrator.summary()['feed0']['runs'] > 1
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import sys, os
+import shutil
+import tempfile
+from os.path import join as pjoin
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import buffalofq.bfq_sourcefile as mod
+
+
+
+class TestSourceFile(object):
+
+    def setup_method(self, method):
+        mod.setup_logging('__main__')
+        self.temp_dir = tempfile.mkdtemp(prefix='bfq_sf_')
+        self.fqfn     = pjoin(self.temp_dir, 'source.dat')
+        self.data     = os.urandom(100000)
+        with open(self.fqfn, 'wb') as f:
+            f.write(self.data)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def _read_all(self, source_file):
+        blocks = []
+        while True:
+            data = source_file.read_view()
+            if not data:
+                break
+            blocks.append(bytes(data))   # views are only valid until the next read
+        return blocks
+
+    def test_read(self):
+        with mod.SourceFile(self.fqfn, block_size=4096) as source_file:
+            blocks = self._read_all(source_file)
+        assert b''.join(blocks) == self.data
+        assert set(len(x) for x in blocks[:-1]) == set([4096])
+
+    def test_read_size_and_seek(self):
+        with mod.SourceFile(self.fqfn, block_size=4096) as source_file:
+            assert bytes(source_file.read_view(10)) == self.data[:10]
+            assert len(source_file.read_view(10000)) == 4096
+            source_file.seek(50000)
+            assert b''.join(self._read_all(source_file)) == self.data[50000:]
+
+    def test_drop_behind(self, monkeypatch):
+        advice = []
+        monkeypatch.setattr(mod, 'fadvise', lambda *args: advice.append(args[1:]))
+        monkeypatch.setattr(mod, 'DROP_BEHIND_SIZE', 40000)
+        with mod.SourceFile(self.fqfn, block_size=8192) as source_file:
+            self._read_all(source_file)
+        assert advice == [(0, 0, mod.POSIX_FADV_SEQUENTIAL),
+                          (0, 40960, mod.POSIX_FADV_DONTNEED),
+                          (40960, 40960, mod.POSIX_FADV_DONTNEED),
+                          (81920, 18080, mod.POSIX_FADV_DONTNEED)]   # the rest, at close
+
+    def test_keep_cache(self, monkeypatch):
+        advice = []
+        monkeypatch.setattr(mod, 'fadvise', lambda *args: advice.append(args[1:]))
+        with mod.SourceFile(self.fqfn, block_size=8192, drop_cache=False) as source_file:
+            self._read_all(source_file)
+        assert advice == [(0, 0, mod.POSIX_FADV_SEQUENTIAL)]
+
+    def test_fadvise(self):
+        # either applied or quietly skipped - never an error:
+        with open(self.fqfn, 'rb') as f:
+            assert mod.fadvise(f.fileno(), 0, 0, mod.POSIX_FADV_DONTNEED) in (True, False)
+            assert mod.fadvise(-1, 0, 0, mod.POSIX_FADV_DONTNEED) is False
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import sys, os
+import time
+import shutil
+import tempfile
+from os.path import join as pjoin
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import buffalofq.bfq_throttle as mod
+
+
+
+class TestTokenBucket(object):
+
+    def test_burst_then_debt(self):
+        bucket = mod.TokenBucket(1000)
+        assert bucket.reserve(600) == 0           # within the burst
+        wait = bucket.reserve(1400)               # 1000 bytes into debt
+        assert 0.9 < wait <= 1.0
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = mod.TokenBucket(1000, burst=100)
+        bucket.last_time -= 60                    # a long idle spell
+        assert bucket.reserve(100) == 0
+        assert bucket.reserve(100) > 0.09
+
+    def test_throttle_paces_to_rate(self):
+        throttle   = mod.Throttle([mod.TokenBucket(10000)])
+        start_time = time.time()
+        for i in range(5):
+            throttle.consume(5000)                # 15000 beyond the burst
+        assert 1.4 < time.time() - start_time < 2.0
+
+
+
+class TestSharedTokenBucket(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp(prefix='bfq_th_')
+        self.fqfn     = pjoin(self.temp_dir, 'bandwidth.bucket')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def test_shared_across_buckets(self):
+        # as if in two processes:
+        bucket1 = mod.SharedTokenBucket(self.fqfn, 1000)
+        bucket2 = mod.SharedTokenBucket(self.fqfn, 1000)
+        try:
+            assert bucket1.reserve(1000) == 0
+            assert 0.9 < bucket2.reserve(1000) <= 1.0   # bucket1 emptied it
+        finally:
+            bucket1.close()
+            bucket2.close()
+
+
+
+class TestGetThrottle(object):
+
+    def test_unlimited(self):
+        assert mod.get_throttle({'name': 'feed1'}) is None
+        assert mod.get_throttle({'name': 'feed1', 'max_bytes_per_sec': 0}) is None
+
+    def test_one_per_feed(self):
+        feed = {'name': 'feed1', 'max_bytes_per_sec': 1000}
+        assert mod.get_throttle(feed) is mod.get_throttle(dict(feed))
+        assert mod.get_throttle(feed) is not mod.get_throttle(dict(feed, name='feed2'))
+        assert len(mod.get_throttle(feed).buckets) == 1
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import sys, os
+import errno
+import getpass
+import shutil
+import tempfile
+import pytest
+from os.path import join as pjoin
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import buffalofq.bfq_transport as mod
+
+
+
+class TestLocalClient(object):
+
+    def setup_method(self, method):
+        mod.setup_logging('__main__')
+        self.temp_dir    = tempfile.mkdtemp(prefix='bfq_tr_')
+        self.source_fqfn = pjoin(self.temp_dir, 'source.dat')
+        self.dest_fqfn   = pjoin(self.temp_dir, 'dest.dat')
+        self.data        = os.urandom(300000)
+        with open(self.source_fqfn, 'wb') as f:
+            f.write(self.data)
+        self.client      = mod.LocalClient()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def _dest_data(self):
+        with open(self.dest_fqfn, 'rb') as f:
+            return f.read()
+
+    def test_copy_file(self):
+        consumed = []
+        assert self.client.copy_file(self.source_fqfn, self.dest_fqfn, block_size=65536,
+                                     consume=consumed.append) == len(self.data)
+        assert self._dest_data() == self.data
+        assert sum(consumed) == len(self.data)
+
+    def test_copy_file_resumed(self):
+        with open(self.dest_fqfn, 'wb') as f:
+            f.write(self.data[:100000] + 'beyond the resume offset')
+        assert self.client.copy_file(self.source_fqfn, self.dest_fqfn, offset=100000) == 200000
+        assert self._dest_data() == self.data
+
+    def test_copy_file_fallback(self, monkeypatch):
+        def cross_device(in_fd, out_fd, offset, count):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        monkeypatch.setattr(mod, '_copy_file_range', cross_device)
+        monkeypatch.setattr(mod, '_sendfile', None)
+        assert self.client.copy_file(self.source_fqfn, self.dest_fqfn) == len(self.data)
+        assert self._dest_data() == self.data
+
+    def test_sftp_errors(self):
+        # callers expect the IOErrors of an sftp client:
+        with pytest.raises(IOError) as e:
+            self.client.stat(pjoin(self.temp_dir, 'missing'))
+        assert e.value.errno == errno.ENOENT
+        with pytest.raises(IOError):
+            self.client.remove(pjoin(self.temp_dir, 'missing'))
+
+    def test_listdir_attr(self):
+        os.symlink(self.source_fqfn, pjoin(self.temp_dir, 'link.dat'))
+        attrs = dict((x.filename, x) for x in self.client.listdir_attr(self.temp_dir))
+        assert sorted(attrs) == ['link.dat', 'source.dat']
+        assert attrs['source.dat'].st_size == len(self.data)
+        assert attrs['link.dat'].st_size != len(self.data)   # the link itself
+
+    def test_open(self):
+        with self.client.open(self.dest_fqfn, 'wb') as dest_file:
+            dest_file.set_pipelined(True)
+            dest_file.write(buffer(bytearray(b'abc')))
+        with self.client.open(self.dest_fqfn, 'rb') as dest_file:
+            assert dest_file.read() == b'abc'
+
+
+
+class TestLocalBatch(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp(prefix='bfq_tr_')
+        for fn in ('a', 'b'):
+            with open(pjoin(self.temp_dir, fn), 'w') as f:
+                f.write(fn)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def test_results(self):
+        batch = mod.open_batch(mod.LocalClient())
+        batch.rename(pjoin(self.temp_dir, 'a'), pjoin(self.temp_dir, 'b'))   # exists
+        batch.posix_rename(pjoin(self.temp_dir, 'a'), pjoin(self.temp_dir, 'b'))
+        batch.remove(pjoin(self.temp_dir, 'a'))
+        batch.symlink(pjoin(self.temp_dir, 'b'), pjoin(self.temp_dir, 'c'))
+        results = batch.wait()
+        assert [x.errno if x else None for x in results] == [errno.EEXIST, None, errno.ENOENT, None]
+        with open(pjoin(self.temp_dir, 'c')) as f:
+            assert f.read() == 'a'
+        assert batch.wait() == []
+
+
+
+class TestGetConnections(object):
+
+    def test_choice(self):
+        user = getpass.getuser()
+        assert isinstance(mod.get_connections('localhost', 22, user, 'key', transport='local'),
+                          mod.LocalConnectionManager)
+        assert isinstance(mod.get_connections('localhost', 22, user, 'key', transport='auto'),
+                          mod.LocalConnectionManager)
+        assert isinstance(mod.get_connections('dw', 22, user, 'key', transport='local'),
+                          mod.LocalConnectionManager)
+        for (host, user, transport) in [('localhost', user, 'sftp'),
+                                        ('dw', user, 'auto'),
+                                        ('localhost', user + 'x', 'auto')]:
+            assert isinstance(mod.get_connections(host, 22, user, 'key', transport=transport),
+                              mod.bfq_connection.ConnectionManager)
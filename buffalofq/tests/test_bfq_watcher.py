@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import sys, os
+import time
+import tempfile
+from os.path import join as pjoin
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import bfq_test_tools  as test_tools
+import buffalofq.bfq_watcher as mod
+
+
+
+class TestInotifyWatcher(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+        self.other_dir       = tempfile.mkdtemp(prefix='bfq_od_')
+        self.watcher         = mod.get_watcher(self.source_data_dir, 'good*')
+        assert self.watcher is not None
+
+    def teardown_method(self, method):
+        self.watcher.close()
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def test_timeout(self):
+        start_time = time.time()
+        assert self.watcher.wait(0.2) is False
+        assert time.time() - start_time >= 0.2
+
+    def test_matching_file_written(self):
+        with open(pjoin(self.source_data_dir, 'good_1.dat'), 'w') as f:
+            f.write('foo\n')
+        assert self.watcher.wait(1) is True
+        # events are consumed:
+        assert self.watcher.wait(0.1) is False
+
+    def test_matching_file_moved_in(self):
+        with open(pjoin(self.other_dir, 'good_1.dat'), 'w') as f:
+            f.write('foo\n')
+        os.rename(pjoin(self.other_dir, 'good_1.dat'),
+                  pjoin(self.source_data_dir, 'good_1.dat'))
+        assert self.watcher.wait(1) is True
+
+    def test_nonmatching_file_ignored(self):
+        with open(pjoin(self.source_data_dir, 'bad_1.dat'), 'w') as f:
+            f.write('foo\n')
+        assert self.watcher.wait(0.2) is False
+
@@ -11,6 +11,7 @@
 """
 import sys, os, getpass, shutil, time
 import tempfile
+import subprocess
 import imp
 import glob
 import yaml
@@ -21,6 +22,10 @@ import envoy
 
 import test_tools
 
+sys.path.insert(0, dirname(dirname(dirname(os.path.abspath(__file__)))))
+import buffalofq.bfq_auditor as bfq_auditor
+import buffalofq.bfq_control as bfq_control
+
 USER = getpass.getuser()
 verbose = False
 
@@ -277,9 +282,172 @@ class TestLocalToRemoteCopy(object):
 
 
 
-def _make_default_config(config_dir, log_dir, **kwargs):
+class TestConfigDir(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.config_dir = tempfile.mkdtemp(prefix='bfq_c_')
+        self.log_dir    = tempfile.mkdtemp(prefix='bfq_l_')
+        self.pgm_path   = pjoin(dirname(os.path.split(os.path.abspath(__file__))[0]), 'buffalofq_mover')
+
+    def teardown_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def test_all_feeds_in_one_process(self):
+        dirs = []
+        for i in range(3):
+            source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+            dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+            for j in range(2):
+                _make_file(source_data_dir, 'good')
+            _make_default_config(self.config_dir,
+                                 self.log_dir,
+                                 config_fn='feed%d.yml' % i,
+                                 name='feed%d' % i,
+                                 source_dir=source_data_dir,
+                                 dest_dir=dest_data_dir)
+            dirs.append((source_data_dir, dest_data_dir))
+        # an invalid config mustn't stop the others:
+        with open(pjoin(self.config_dir, 'broken.yml'), 'w') as f:
+            f.write(yaml.dump({'name': 'broken', 'status': 'enabled'}))
+
+        time.sleep(2) # must wait 2 seconds because config has polling dir of 1 sec
+        os.system('%s --config-dir %s --feed-threads 2' % (self.pgm_path, self.config_dir))
+
+        for (source_data_dir, dest_data_dir) in dirs:
+            assert len(glob.glob(pjoin(source_data_dir,'good*'))) == 2
+            assert len(glob.glob(pjoin(dest_data_dir,'good*')))   == 2
+        for i in range(3):
+            assert exists(pjoin(self.config_dir, 'feed%d_audit.json' % i))
+
+    def test_daemon(self):
+        source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+        dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+        _make_file(source_data_dir, 'good')
+        _make_default_config(self.config_dir,
+                             self.log_dir,
+                             polling_seconds=3600,
+                             source_dir=source_data_dir,
+                             dest_dir=dest_data_dir)
+        socket_fqfn = pjoin(self.config_dir, 'mover.sock')
+        mover = subprocess.Popen([self.pgm_path, '--config-fqfn', pjoin(self.config_dir, 'buffalofq.yml'),
+                                  '--daemon', '--control-socket', socket_fqfn, '--no-console-log'])
+        try:
+            assert _wait_for(lambda: len(glob.glob(pjoin(dest_data_dir, 'good*'))) == 1)
+            assert _wait_for(lambda: exists(socket_fqfn))
+            # an immediate delivery, rather than in an hour:
+            _make_file(source_data_dir, 'good')
+            assert bfq_control.send_command(socket_fqfn, 'poll')['ok']
+            assert _wait_for(lambda: len(glob.glob(pjoin(dest_data_dir, 'good*'))) == 2)
+            assert bfq_control.send_command(socket_fqfn, 'drain')['ok']
+            assert _wait_for(lambda: mover.poll() is not None)
+        finally:
+            if mover.poll() is None:
+                mover.kill()
+        assert mover.returncode == 0
+        assert not exists(socket_fqfn)
+
+
+class TestStartup(object):
+
+    def setup_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+        self.config_dir      = tempfile.mkdtemp(prefix='bfq_c_')
+        self.log_dir         = tempfile.mkdtemp(prefix='bfq_l_')
+        self.source_data_dir = tempfile.mkdtemp(prefix='bfq_sd_')
+        self.dest_data_dir   = tempfile.mkdtemp(prefix='bfq_dd_')
+        self.pgm_path        = pjoin(dirname(os.path.split(os.path.abspath(__file__))[0]), 'buffalofq_mover')
+        self.config_fqfn     = pjoin(self.config_dir, 'buffalofq.yml')
+        _make_default_config(self.config_dir,
+                             self.log_dir,
+                             source_dir=self.source_data_dir,
+                             dest_dir=self.dest_data_dir)
+
+    def teardown_method(self, method):
+        test_tools.remove_all_buffalofq_temp_dirs()
+
+    def _run_mover(self):
+        """ Runs the mover in a new interpreter - returning the top-level
+            modules it imported.
+        """
+        argv = [self.pgm_path, '--config-fqfn', self.config_fqfn, '--no-console-log']
+        code = ('import sys\n'
+                'sys.argv = %r\n'
+                'try:\n'
+                '    execfile(%r, {"__name__": "__main__", "__file__": %r})\n'
+                'except SystemExit as e:\n'
+                '    assert not e.code, e.code\n'
+                'print(" ".join(set(x.split(".")[0] for x in sys.modules)))\n'
+                % (argv, self.pgm_path, self.pgm_path))
+        return subprocess.check_output([sys.executable, '-c', code]).split()
+
+    def test_idle_runs_skip_the_heavy_imports(self):
+        assert 'paramiko' in self._run_mover()       # validates & caches the config
+        assert exists(pjoin(self.config_dir, 'buffalofq_config_cache.json'))
+        modules = self._run_mover()
+        assert 'paramiko' not in modules
+        assert 'yaml' not in modules
+        # but a file to move gets a full run:
+        _make_file(self.source_data_dir, 'good')
+        assert 'paramiko' in self._run_mover()
+        assert len(glob.glob(pjoin(self.dest_data_dir, 'good*'))) == 1
+
+    def test_slot_left_by_more_workers_is_finished(self):
+        """ A slot record left when max_workers was higher is recovered by
+            the next full run - after which idle runs are quick again.
+        """
+        _make_default_config(self.config_dir,
+                             self.log_dir,
+                             source_post_action='delete',
+                             source_dir=self.source_data_dir,
+                             dest_dir=self.dest_data_dir)
+        broken_file = basename(_make_file(self.source_data_dir, 'good'))
+        auditor = bfq_auditor.FeedAuditor('source_2_dest', self.config_dir, config_name='buffalofq')
+        auditor.slot_auditor(2).write(step=3, status='start', fn=broken_file)
+        auditor.close()
+
+        assert 'paramiko' in self._run_mover()
+        assert os.listdir(self.source_data_dir) == []
+        assert len(glob.glob(pjoin(self.dest_data_dir, 'good*'))) == 1
+        assert 'paramiko' not in self._run_mover()
+
+    def test_idle_runs_write_no_audit_files(self):
+        """ The idle check runs before the pidfile is locked - so mustn't
+            touch what a running mover may own.
+        """
+        _make_default_config(self.config_dir,
+                             self.log_dir,
+                             audit_backend='sqlite',
+                             source_post_action='delete',
+                             source_dir=self.source_data_dir,
+                             dest_dir=self.dest_data_dir)
+        _make_file(self.source_data_dir, 'good')
+        self._run_mover()
+        audit_fqfns = glob.glob(pjoin(self.config_dir, 'buffalofq_audit*'))
+        before      = dict((x, os.stat(x).st_mtime) for x in audit_fqfns)
+        time.sleep(0.01)
+        assert 'paramiko' not in self._run_mover()
+        assert glob.glob(pjoin(self.config_dir, 'buffalofq_audit*')) == audit_fqfns
+        assert dict((x, os.stat(x).st_mtime) for x in audit_fqfns) == before
+
+    def test_changed_config_is_validated_again(self):
+        self._run_mover()
+        _make_default_config(self.config_dir,
+                             self.log_dir,
+                             polling_seconds=99999,     # over the maximum
+                             source_dir=self.source_data_dir,
+                             dest_dir=self.dest_data_dir)
+        with open(os.devnull, 'w') as devnull:
+            assert subprocess.call([self.pgm_path, '--config-fqfn', self.config_fqfn],
+                                   stdout=devnull, stderr=devnull) != 0
+
+
+
+
+def _make_default_config(config_dir, log_dir, config_fn='buffalofq.yml', **kwargs):
     """ Inputs:
         - config_dir
+        - config_fn
         - kwargs - used to override config fields.  Note that
           source_dir and dest_dir must be provided.
     """
@@ -316,12 +484,20 @@ def _make_default_config(config_dir, log_dir, **kwargs):
     config_dict = feed
 
     pp(config_dict)
-    with open(pjoin(config_dir, 'buffalofq.yml'), 'w') as config_fqfn:
+    with open(pjoin(config_dir, config_fn), 'w') as config_fqfn:
         config_fqfn.write( yaml.dump(config_dict))
     ##os.system('cat %s' % pjoin(config_dir, 'buffalofq.yml'))
 
 
 
+def _wait_for(condition, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline and not condition():
+        time.sleep(0.1)
+    return condition()
+
+
+
 def _make_file(dir, prefix):
     adjusted_prefix = '%s_' % prefix
     (fd, fqfn) = tempfile.mkstemp(dir=dir, prefix=adjusted_prefix, suffix='.dat')